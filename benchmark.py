@@ -0,0 +1,464 @@
+"""
+Throughput benchmarks of ALOCC on synthetic data (no dataset needed)
+
+# steps/sec of the UCSD training step: legacy (several sess.run, G update only), legacy with a separate D update
+# run, and fused (D and G updates in one sess.run); the speedup compares fused with the D+G legacy step
+python benchmark.py train_step --batch_size 64 --n_steps 20
+
+# scoring patches/sec of one graph at several batch sizes
+python benchmark.py batch_sizes --batch_sizes 1 64 512
+
+# frames/sec of whole-frame scoring vs per-patch scoring
+python benchmark.py whole_frame --n_frames 10 --stride 10
+
+# frame loading time of the serial readers vs the process-pool readers
+python benchmark.py readers --n_frames 60 --workers 1 2 4 8
+
+# startup time / memory of the precomputed noisy copy and step time with in-graph noise
+python benchmark.py noise --n_frames 60
+
+# the whole suite (data path, default and fused training steps, f_test_frozen_model across batch sizes and strides) on synthetic
+# UCSD and MNIST geometry, with the hardware and commit, as json to compare runs across commits
+python benchmark.py suite --output ./export/benchmark_results.json
+
+# data-parallel training steps/sec and scaling efficiency from 1 to N local worker processes
+python benchmark.py data_parallel --workers 1 2 4 8
+
+# import time and resident memory of the train, test and scoring entry points, each in a fresh interpreter
+python benchmark.py startup --n_repeats 5
+"""
+import argparse
+import json
+import multiprocessing
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+
+import imageio
+import numpy as np
+import tensorflow as tf
+
+from kh_tools import get_image_patches, get_noisy_data, read_lst_images, read_lst_images_w_noise, \
+  read_lst_images_without_noise2, read_lst_images_parallel, read_lst_images_w_noise_parallel
+from models import ALOCC_Model
+from distributed import measure_scaling
+from utils import montage
+
+
+def build_synthetic_model(sess, n_batch_size, nd_patch_size=(45, 45), b_fold_batch_norm=False):
+    """
+    ALOCC_Model with UCSD geometry that does not touch any dataset
+    """
+    s_tmp_dir = tempfile.mkdtemp(prefix='alocc_bench_')
+    return ALOCC_Model(sess,
+                       input_height=nd_patch_size[0], input_width=nd_patch_size[1],
+                       output_height=nd_patch_size[0], output_width=nd_patch_size[1],
+                       batch_size=n_batch_size, sample_num=n_batch_size,
+                       is_training=False,
+                       dataset_name='UCSD', dataset_address=s_tmp_dir, input_fname_pattern='*',
+                       checkpoint_dir=s_tmp_dir, log_dir=s_tmp_dir, sample_dir=s_tmp_dir,
+                       nd_patch_size=nd_patch_size, n_stride=10, n_fetch_data=0, b_fold_batch_norm=b_fold_batch_norm)
+
+
+def time_calls(fn, n_steps, n_warmup):
+    """
+    :return: mean seconds per call of fn() after n_warmup untimed calls
+    """
+    for _ in range(n_warmup):
+        fn()
+    f_start = time.time()
+    for _ in range(n_steps):
+        fn()
+    return (time.time() - f_start) / n_steps
+
+
+def bench_train_step(n_batch_size=64, n_steps=20, n_warmup=3, f_learning_rate=0.002):
+    """
+    steps/sec of f_train_step_ucsd vs f_train_step_fused on random patches. f_train_step_ucsd only updates G while
+    f_train_step_fused updates D and G, so 'legacy_dg' runs d_optim before f_train_step_ucsd as the baseline
+    of the same work, and the speedup is fused over legacy_dg
+    """
+    dic_results = {}
+    for s_mode in ['legacy', 'legacy_dg', 'fused']:
+        tf.reset_default_graph()
+        with tf.Session() as sess:
+            model = build_synthetic_model(sess, n_batch_size)
+            model.build_train_ops(f_learning_rate, b_fused_step=(s_mode == 'fused'))
+            tf.global_variables_initializer().run()
+
+            batch_images = np.random.uniform(0, 1, [n_batch_size, 45, 45, 1]).astype(np.float32)
+            batch_noise_images = np.clip(batch_images + np.random.normal(0, 0.155, batch_images.shape), 0, 1).astype(np.float32)
+
+            # scalar and histogram summaries on every step, as the training loop used to do
+            lst_summary_ops = model.dic_summaries['scalar'] + model.dic_summaries['histogram']
+            if s_mode == 'fused':
+                fn_step = model.f_train_step_fused
+            elif s_mode == 'legacy_dg':
+                def fn_step(batch_images, batch_noise_images, lst_summary_ops):
+                    model.sess.run(model.d_optim, feed_dict={model.inputs: batch_images, model.z: batch_noise_images})
+                    return model.f_train_step_ucsd(batch_images, batch_noise_images, lst_summary_ops)
+            else:
+                fn_step = model.f_train_step_ucsd
+            f_step_time = time_calls(lambda: fn_step(batch_images, batch_noise_images, lst_summary_ops), n_steps, n_warmup)
+            dic_results[s_mode] = {'sec_per_step': f_step_time, 'steps_per_sec': 1. / f_step_time,
+                                   'updates': 'G' if s_mode == 'legacy' else 'D+G'}
+
+    dic_results['speedup'] = dic_results['fused']['steps_per_sec'] / dic_results['legacy_dg']['steps_per_sec']
+    print('train step (batch {}): legacy G only {:.2f} steps/s, legacy D+G {:.2f} steps/s, fused D+G {:.2f} steps/s, '
+          'x{:.2f} over legacy D+G'.format(n_batch_size, dic_results['legacy']['steps_per_sec'],
+                                            dic_results['legacy_dg']['steps_per_sec'],
+                                            dic_results['fused']['steps_per_sec'], dic_results['speedup']))
+    return dic_results
+
+
+def bench_batch_sizes(lst_batch_sizes=(1, 16, 64, 256, 512, 1024), n_patches=2048, n_repeats=3):
+    """
+    patches/sec of f_score_patches at several batch sizes on one graph built with batch_size 64
+    """
+    dic_results = {}
+    tf.reset_default_graph()
+    with tf.Session() as sess:
+        model = build_synthetic_model(sess, 64)
+        tf.global_variables_initializer().run()
+        nd_patches = np.random.uniform(0, 1, [n_patches, 45, 45, 1]).astype(np.float32)
+
+        for n_batch_size in lst_batch_sizes:
+            model.batch_size = n_batch_size
+            f_time = time_calls(lambda: model.f_score_patches(nd_patches, ['D']), n_repeats, 1)
+            dic_results[n_batch_size] = {'sec_per_call': f_time, 'patches_per_sec': n_patches / f_time}
+            print('score batch {:5d}: {:9.1f} patches/s'.format(n_batch_size, n_patches / f_time))
+    return dic_results
+
+
+def bench_whole_frame(n_frames=10, nd_frame_size=(140, 360), n_stride=10, n_batch_size=64):
+    """
+    frames/sec of the whole-frame model vs the patch path of test.process_frame, plus the score agreement
+    """
+    tf.reset_default_graph()
+    with tf.Session() as sess:
+        # whole-frame scoring needs the moving-average (folded) batch-norm on both paths
+        model = build_synthetic_model(sess, n_batch_size, b_fold_batch_norm=True)
+        model.patch_step = (n_stride, n_stride)
+        model.build_frame_model(nd_frame_size)
+        tf.global_variables_initializer().run()
+        nd_frames = np.random.uniform(0, 1, (n_frames,) + tuple(nd_frame_size)).astype(np.float32)
+
+        def score_patches():
+            for frame in nd_frames:
+                nd_patches, _ = get_image_patches([frame], model.patch_size, model.patch_step)
+                model.f_score_patches(nd_patches[:, 0], ['D'])
+
+        def score_frames():
+            for frame in nd_frames:
+                model.f_score_frame(frame, ['D'])
+
+        f_patch_time = time_calls(score_patches, 1, 1) / n_frames
+        f_frame_time = time_calls(score_frames, 1, 1) / n_frames
+        b_ok, dic_diff = model.f_check_frame_equivalence(nd_frames[0])
+
+    dic_results = {'patches_frames_per_sec': 1. / f_patch_time, 'whole_frame_frames_per_sec': 1. / f_frame_time,
+                   'speedup': f_patch_time / f_frame_time, 'max_abs_diff': dic_diff, 'equivalent': b_ok}
+    print('stride {}: patches {:.2f} frames/s, whole frame {:.2f} frames/s, x{:.1f}'.format(
+        n_stride, dic_results['patches_frames_per_sec'], dic_results['whole_frame_frames_per_sec'], dic_results['speedup']))
+    return dic_results
+
+
+def write_synthetic_frames(s_dataset_dir, n_videos=2, n_frames=20, nd_frame_size=(240, 360)):
+    """
+    Random uint8 .tif frames laid out like UCSD (s_dataset_dir/Train001/001.tif, ...)
+    :return: list of the frame paths
+    """
+    lst_paths = []
+    for n_video in range(n_videos):
+        s_video_dir = os.path.join(s_dataset_dir, 'Train%03d' % (n_video + 1))
+        if not os.path.exists(s_video_dir):
+            os.makedirs(s_video_dir)
+        for n_frame in range(n_frames):
+            s_path = os.path.join(s_video_dir, '%03d.tif' % (n_frame + 1))
+            imageio.imwrite(s_path, np.random.randint(0, 256, nd_frame_size).astype(np.uint8))
+            lst_paths.append(s_path)
+    return lst_paths
+
+
+def bench_readers(n_frames=60, lst_workers=None, nd_patch_size=(45, 45), n_stride=10):
+    """
+    seconds to load n_frames synthetic UCSD frames with the serial and the process-pool readers
+    """
+    if lst_workers is None:
+        lst_workers = sorted(set([1, 2, 4, multiprocessing.cpu_count()]))
+    lst_paths = write_synthetic_frames(tempfile.mkdtemp(prefix='alocc_frames_'), 1, n_frames)
+    nd_patch_step = (n_stride, n_stride)
+
+    dic_results = {'serial': None, 'workers': {}}
+    f_start = time.time()
+    read_lst_images(lst_paths, nd_patch_size, nd_patch_step)
+    read_lst_images_w_noise(lst_paths, nd_patch_size, nd_patch_step)
+    dic_results['serial'] = time.time() - f_start
+    print('serial readers: {:.2f}s'.format(dic_results['serial']))
+
+    for n_workers in lst_workers:
+        f_start = time.time()
+        read_lst_images_parallel(lst_paths, nd_patch_size, nd_patch_step, n_workers=n_workers)
+        read_lst_images_w_noise_parallel(lst_paths, nd_patch_size, nd_patch_step, n_workers=n_workers)
+        f_time = time.time() - f_start
+        dic_results['workers'][n_workers] = {'sec': f_time, 'speedup': dic_results['serial'] / f_time,
+                                             'efficiency': dic_results['serial'] / f_time / n_workers}
+        print('{:3d} workers: {:.2f}s, x{:.2f} ({:.0f}% efficiency)'.format(
+            n_workers, f_time, dic_results['serial'] / f_time, 100. * dic_results['workers'][n_workers]['efficiency']))
+    return dic_results
+
+
+def bench_noise(n_frames=60, n_batch_size=64, n_steps=20, nd_patch_size=(45, 45), n_stride=10):
+    """
+    Startup time and memory of the precomputed noisy copy (read_lst_images_w_noise) that in-graph noise
+    no longer needs, and the step time of the fused training step with z fed vs z noised in the graph
+    """
+    lst_paths = write_synthetic_frames(tempfile.mkdtemp(prefix='alocc_frames_'), 1, n_frames)
+    nd_patch_step = (n_stride, n_stride)
+
+    f_start = time.time()
+    sample_w_noise, _ = read_lst_images_w_noise(lst_paths, nd_patch_size, nd_patch_step)
+    sample_w_noise = np.array(sample_w_noise).reshape(-1, nd_patch_size[0], nd_patch_size[1], 1)
+    dic_results = {'precomputed_sec': time.time() - f_start, 'precomputed_mb': sample_w_noise.nbytes / 2. ** 20}
+    print('precomputed noisy copy of {} patches: {:.2f}s, {:.1f} MB (both saved by in-graph noise)'.format(
+        len(sample_w_noise), dic_results['precomputed_sec'], dic_results['precomputed_mb']))
+
+    tf.reset_default_graph()
+    with tf.Session() as sess:
+        model = build_synthetic_model(sess, n_batch_size, nd_patch_size)
+        model.build_train_ops(0.002, b_fused_step=True)
+        tf.global_variables_initializer().run()
+
+        batch_images = sample_w_noise[:n_batch_size].astype(np.float32)
+        batch_noise_images = sample_w_noise[n_batch_size:2 * n_batch_size].astype(np.float32)
+        dic_results['fed_sec_per_step'] = time_calls(
+            lambda: model.f_train_step_fused(batch_images, batch_noise_images), n_steps, 3)
+        dic_results['in_graph_sec_per_step'] = time_calls(
+            lambda: model.f_train_step_fused(batch_images), n_steps, 3)
+    print('fused step (batch {}): z fed {:.1f} ms, z in graph {:.1f} ms'.format(
+        n_batch_size, 1e3 * dic_results['fed_sec_per_step'], 1e3 * dic_results['in_graph_sec_per_step']))
+    return dic_results
+
+
+# entry point -> module imported to start it
+DIC_ENTRY_POINTS = {'train': 'train', 'test': 'test', 'inference': 'inference', 'numpy_scoring': 'numpy_engine'}
+
+# modules that only some code paths need, the entry points should not import them up front
+LST_HEAVY_MODULES = ['tensorflow', 'tensorflow.contrib.slim', 'tensorflow.examples.tutorials.mnist', 'matplotlib.pyplot',
+                     'scipy.misc', 'scipy.ndimage', 'skimage', 'PIL.Image', 'imageio']
+
+S_STARTUP_SCRIPT = """
+import json, resource, sys, time
+f_start = time.time()
+import {module}
+f_import_sec = time.time() - f_start
+n_rss_pages = int(open('/proc/self/statm').read().split()[1]) if sys.platform.startswith('linux') else 0
+print(json.dumps({{'import_sec': f_import_sec, 'rss_mb': n_rss_pages * resource.getpagesize() / 2. ** 20,
+                  'max_rss_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / (2. ** 20 if sys.platform == 'darwin' else 2. ** 10),
+                  'n_modules': len(sys.modules), 'heavy_modules': [s for s in {heavy} if s in sys.modules]}}))
+"""
+
+
+def bench_startup(lst_entry_points=None, n_repeats=3, s_output_path=None):
+    """
+    Import time, resident memory (current and peak) and loaded heavy modules of each entry point, measured in a
+    new interpreter for every repeat so that nothing is imported yet. The wall time of the whole process
+    (interpreter start included) is reported next to the import time.
+    :return: dict entry point -> medians over the repeats and the heavy modules it imported
+    """
+    s_repo_dir = os.path.dirname(os.path.abspath(__file__))
+    dic_results = {}
+    for s_entry in lst_entry_points or sorted(DIC_ENTRY_POINTS):
+        s_script = S_STARTUP_SCRIPT.format(module=DIC_ENTRY_POINTS[s_entry], heavy=LST_HEAVY_MODULES)
+        lst_runs = []
+        for _ in range(n_repeats):
+            f_start = time.time()
+            s_output = subprocess.check_output([sys.executable, '-c', s_script], cwd=s_repo_dir, stderr=subprocess.DEVNULL)
+            dic_run = json.loads(s_output.decode().strip().splitlines()[-1])
+            dic_run['process_sec'] = time.time() - f_start
+            lst_runs.append(dic_run)
+        dic_result = {s_key: float(np.median([dic_run[s_key] for dic_run in lst_runs]))
+                      for s_key in ['import_sec', 'process_sec', 'rss_mb', 'max_rss_mb', 'n_modules']}
+        dic_result['heavy_modules'] = lst_runs[-1]['heavy_modules']
+        dic_results[s_entry] = dic_result
+        print('{:>14}: import {:.3f}s (process {:.3f}s), RSS {:.1f} MB (peak {:.1f} MB), {:.0f} modules, heavy: {}'.format(
+            s_entry, dic_result['import_sec'], dic_result['process_sec'], dic_result['rss_mb'], dic_result['max_rss_mb'],
+            dic_result['n_modules'], ', '.join(dic_result['heavy_modules']) or '-'))
+
+    if s_output_path:
+        with open(s_output_path, 'w') as f:
+            json.dump({'hardware': get_hardware_info(), 'n_repeats': n_repeats, 'entry_points': dic_results}, f, indent=2)
+    return dic_results
+
+
+def get_hardware_info():
+    """
+    Machine, library versions and commit the numbers were measured on
+    """
+    dic_info = {'platform': platform.platform(), 'processor': platform.processor(), 'cpu_count': multiprocessing.cpu_count(),
+                'python': platform.python_version(), 'numpy': np.__version__, 'tensorflow': tf.__version__}
+    try:
+        from tensorflow.python.client import device_lib
+        dic_info['devices'] = [device.physical_device_desc or device.name for device in device_lib.list_local_devices()]
+    except Exception as e:
+        dic_info['devices'] = 'unavailable ({})'.format(e)
+    try:
+        dic_info['commit'] = subprocess.check_output(['git', 'rev-parse', 'HEAD'], stderr=subprocess.STDOUT,
+                                                     cwd=os.path.dirname(os.path.abspath(__file__))).decode().strip()
+    except Exception:
+        dic_info['commit'] = None
+    return dic_info
+
+
+def bench_suite(s_output_path=None, lst_batch_sizes=(16, 64, 256), lst_strides=(10, 25), n_frames=20, n_repeats=3):
+    """
+    Every benchmark of the suite on synthetic UCSD (240x360 frames cropped to 140x360, 45x45 patches) and
+    MNIST (28x28) data, written as json to s_output_path
+    :return: dict with the hardware info and, per benchmark, seconds per call (and throughput where it applies)
+    """
+    dic_results = {'hardware': get_hardware_info(), 'time': time.strftime('%Y-%m-%d %H:%M:%S'),
+                   'config': {'batch_sizes': list(lst_batch_sizes), 'strides': list(lst_strides), 'n_frames': n_frames},
+                   'benchmarks': {}}
+    dic_bench = dic_results['benchmarks']
+    s_tmp_dir = tempfile.mkdtemp(prefix='alocc_suite_')
+
+    def record(s_name, f_sec, n_items=None, s_unit='items'):
+        dic_bench[s_name] = {'sec_per_call': f_sec}
+        if n_items is not None:
+            dic_bench[s_name][s_unit + '_per_sec'] = n_items / f_sec
+        print('{:55s} {:10.4f}s{}'.format(s_name, f_sec, '' if n_items is None else
+                                          '  {:10.1f} {}/s'.format(n_items / f_sec, s_unit)))
+
+    nd_ucsd_frames = np.random.uniform(0, 1, (n_frames, 140, 360))
+    nd_mnist_images = np.random.uniform(0, 1, (1000, 28, 28, 1)).astype(np.float32)
+    lst_paths = write_synthetic_frames(os.path.join(s_tmp_dir, 'frames'), 1, n_frames)
+
+    # numpy data path
+    for n_stride in lst_strides:
+        nd_stride = (n_stride, n_stride)
+        record('get_image_patches/ucsd/stride_{}'.format(n_stride),
+               time_calls(lambda: get_image_patches(nd_ucsd_frames, (45, 45), nd_stride), n_repeats, 1), n_frames, 'frames')
+        record('read_lst_images/ucsd/stride_{}'.format(n_stride),
+               time_calls(lambda: read_lst_images(lst_paths, (45, 45), nd_stride), n_repeats, 1), n_frames, 'frames')
+        record('read_lst_images_w_noise/ucsd/stride_{}'.format(n_stride),
+               time_calls(lambda: read_lst_images_w_noise(lst_paths, (45, 45), nd_stride), n_repeats, 1), n_frames, 'frames')
+    record('get_image_patches/mnist',
+           time_calls(lambda: get_image_patches(nd_mnist_images[:, :, :, 0], (28, 28), (28, 28)), n_repeats, 1),
+           len(nd_mnist_images), 'images')
+    record('read_lst_images_without_noise2/ucsd',
+           time_calls(lambda: read_lst_images_without_noise2(lst_paths, (45, 45), (10, 10)), n_repeats, 1), n_frames, 'frames')
+    record('get_noisy_data/mnist', time_calls(lambda: get_noisy_data(nd_mnist_images), n_repeats, 1),
+           len(nd_mnist_images), 'images')
+    nd_montage_patches = np.random.uniform(0, 1, (256, 45, 45))
+    record('montage/256x45x45', time_calls(lambda: montage(nd_montage_patches, os.path.join(s_tmp_dir, 'montage.png')),
+                                           n_repeats, 1), len(nd_montage_patches), 'patches')
+
+    # graph: the default (f_train_step_ucsd, G update only) and fused (D and G updates) training steps, and
+    # f_test_frozen_model for both geometries
+    for s_geometry, nd_patch_size in [('ucsd', (45, 45)), ('mnist', (28, 28))]:
+        for n_batch_size in lst_batch_sizes:
+            for s_step in ['default', 'fused']:
+                tf.reset_default_graph()
+                with tf.Session() as sess:
+                    model = build_synthetic_model(sess, n_batch_size, nd_patch_size)
+                    model.build_train_ops(0.002, b_fused_step=(s_step == 'fused'))
+                    tf.global_variables_initializer().run()
+
+                    batch_images = np.random.uniform(0, 1, [n_batch_size] + list(nd_patch_size) + [1]).astype(np.float32)
+                    fn_step = model.f_train_step_fused if s_step == 'fused' else model.f_train_step_ucsd
+                    record('train_step/{}/batch_{}/{}'.format(s_geometry, n_batch_size, s_step),
+                           time_calls(lambda: fn_step(batch_images), n_repeats * 3, 2), n_batch_size, 'patches')
+
+                    if s_geometry != 'ucsd' or s_step != 'fused':
+                        continue
+                    for n_stride in lst_strides:
+                        nd_patches, _ = get_image_patches(nd_ucsd_frames[:4], nd_patch_size, (n_stride, n_stride))
+                        nd_frame_patches = nd_patches.transpose([1, 0, 2, 3])
+                        record('f_test_frozen_model/{}/batch_{}/stride_{}'.format(s_geometry, n_batch_size, n_stride),
+                               time_calls(lambda: model.f_test_frozen_model(nd_frame_patches), n_repeats, 1),
+                               nd_frame_patches.shape[0] * nd_frame_patches.shape[1], 'patches')
+
+    if s_output_path is not None:
+        s_output_dir = os.path.dirname(s_output_path)
+        if s_output_dir and not os.path.exists(s_output_dir):
+            os.makedirs(s_output_dir)
+        with open(s_output_path, 'w') as f:
+            json.dump(dic_results, f, indent=2, sort_keys=True)
+        print('results written to {}'.format(s_output_path))
+    return dic_results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    subparsers = parser.add_subparsers(dest='benchmark')
+
+    parser_step = subparsers.add_parser('train_step', help='legacy (G only), legacy D+G and fused (D+G) UCSD training steps')
+    parser_step.add_argument('--batch_size', type=int, default=64)
+    parser_step.add_argument('--n_steps', type=int, default=20)
+    parser_step.add_argument('--n_warmup', type=int, default=3)
+
+    parser_batch = subparsers.add_parser('batch_sizes', help='scoring throughput of one graph across batch sizes')
+    parser_batch.add_argument('--batch_sizes', type=int, nargs='+', default=[1, 16, 64, 256, 512, 1024])
+    parser_batch.add_argument('--n_patches', type=int, default=2048)
+
+    parser_frame = subparsers.add_parser('whole_frame', help='whole-frame model vs per-patch scoring')
+    parser_frame.add_argument('--n_frames', type=int, default=10)
+    parser_frame.add_argument('--stride', type=int, default=10)
+
+    parser_readers = subparsers.add_parser('readers', help='serial vs process-pool frame readers')
+    parser_readers.add_argument('--n_frames', type=int, default=60)
+    parser_readers.add_argument('--workers', type=int, nargs='+', default=None)
+
+    parser_noise = subparsers.add_parser('noise', help='precomputed noisy copy vs in-graph noise')
+    parser_noise.add_argument('--n_frames', type=int, default=60)
+    parser_noise.add_argument('--batch_size', type=int, default=64)
+
+    parser_suite = subparsers.add_parser('suite', help='every benchmark on synthetic data, written to json')
+    parser_suite.add_argument('--output', default='benchmark_results.json')
+    parser_suite.add_argument('--batch_sizes', type=int, nargs='+', default=[16, 64, 256])
+    parser_suite.add_argument('--strides', type=int, nargs='+', default=[10, 25])
+    parser_suite.add_argument('--n_frames', type=int, default=20)
+    parser_suite.add_argument('--n_repeats', type=int, default=3)
+
+    parser_parallel = subparsers.add_parser('data_parallel', help='data-parallel training scaling over worker processes')
+    parser_parallel.add_argument('--workers', type=int, nargs='+', default=[1, 2, 4])
+    parser_parallel.add_argument('--batch_size', type=int, default=64)
+    parser_parallel.add_argument('--n_steps', type=int, default=10)
+    parser_parallel.add_argument('--threads_per_worker', type=int, default=None)
+    parser_parallel.add_argument('--output', default=None)
+
+    parser_startup = subparsers.add_parser('startup', help='import time and memory of the entry points in fresh interpreters')
+    parser_startup.add_argument('--entry_points', nargs='+', default=None, choices=sorted(DIC_ENTRY_POINTS))
+    parser_startup.add_argument('--n_repeats', type=int, default=3)
+    parser_startup.add_argument('--output', default=None)
+
+    args = parser.parse_args()
+    if args.benchmark == 'train_step':
+        bench_train_step(args.batch_size, args.n_steps, args.n_warmup)
+    elif args.benchmark == 'batch_sizes':
+        bench_batch_sizes(args.batch_sizes, args.n_patches)
+    elif args.benchmark == 'whole_frame':
+        bench_whole_frame(args.n_frames, n_stride=args.stride)
+    elif args.benchmark == 'readers':
+        bench_readers(args.n_frames, args.workers)
+    elif args.benchmark == 'noise':
+        bench_noise(args.n_frames, args.batch_size)
+    elif args.benchmark == 'suite':
+        bench_suite(args.output, args.batch_sizes, args.strides, args.n_frames, args.n_repeats)
+    elif args.benchmark == 'data_parallel':
+        dic_results = measure_scaling(args.workers, args.batch_size, args.n_steps, n_threads_per_worker=args.threads_per_worker)
+        if args.output:
+            with open(args.output, 'w') as f:
+                json.dump({'hardware': get_hardware_info(), 'batch_size_per_worker': args.batch_size,
+                           'workers': {str(n_workers): dic_result for n_workers, dic_result in dic_results.items()}}, f, indent=2)
+    elif args.benchmark == 'startup':
+        bench_startup(args.entry_points, args.n_repeats, args.output)
+    else:
+        parser.print_help()
+
+
+if __name__ == '__main__':
+    main()
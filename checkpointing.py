@@ -0,0 +1,186 @@
+"""
+Checkpoints written from a weight snapshot, a weights-only export and the state needed to resume training.
+
+CheckpointManager.save() copies the variables of the training session to host memory between two steps and
+writes them from a separate graph, in a background thread when b_background. The checkpoint keeps the
+variable names of the training graph (ALOCC_Model.load and f_check_checkpoint read it as before) but no
+meta graph. Next to every checkpoint it writes:
+  <prefix>-<step>.state.json     epoch, batch index, sampled frame list and RNG states (see read_resume_state)
+  <prefix>-<step>.weights.npz    with b_weights_only_export: the model weights without the Adam slots
+                                 (see restore_weights)
+"""
+import json
+import os
+import threading
+
+import numpy as np
+import tensorflow as tf
+
+
+def weight_variables(graph):
+    """
+    :return: variables of graph needed for inference: the trainable ones and the batch-norm moving statistics,
+             not the optimizer slots
+    """
+    set_trainable = set(graph.get_collection(tf.GraphKeys.TRAINABLE_VARIABLES))
+    return [var for var in graph.get_collection(tf.GraphKeys.GLOBAL_VARIABLES)
+            if var in set_trainable or 'moving_' in var.op.name]
+
+
+def read_checkpoint_values(s_checkpoint_path):
+    """
+    :return: dict variable name -> numpy value of a checkpoint prefix or of a weights-only .npz export
+    """
+    if s_checkpoint_path.endswith('.npz'):
+        with np.load(s_checkpoint_path) as npz:
+            return {s_name: npz[s_name] for s_name in npz.files}
+    reader = tf.train.NewCheckpointReader(s_checkpoint_path)
+    return {s_name: reader.get_tensor(s_name) for s_name in reader.get_variable_to_shape_map()}
+
+
+def load_values(sess, dic_values):
+    """
+    Load dic_values into the variables of sess.graph that have the same names
+    :return: names of the variables of the graph missing from dic_values
+    """
+    lst_missing = []
+    for var in sess.graph.get_collection(tf.GraphKeys.GLOBAL_VARIABLES):
+        if var.op.name in dic_values:
+            var.load(dic_values[var.op.name], sess)
+        else:
+            lst_missing.append(var.op.name)
+    return lst_missing
+
+
+def restore_weights(sess, s_npz_path):
+    """
+    Load a weights-only export into the variables of sess.graph that have the same names
+    (the training graph, an inference-only graph or a frame model)
+    :return: names of the variables of the graph missing from the export
+    """
+    return load_values(sess, read_checkpoint_values(s_npz_path))
+
+
+def read_resume_state(s_checkpoint_path):
+    """
+    :return: the state dict saved with checkpoint s_checkpoint_path, None if it has none
+    """
+    if s_checkpoint_path is None or not os.path.exists(s_checkpoint_path + '.state.json'):
+        return None
+    with open(s_checkpoint_path + '.state.json') as f:
+        return json.load(f)
+
+
+def get_random_states():
+    """
+    :return: json-serializable states of the numpy and python global RNGs
+    """
+    import random
+    s_name, nd_keys, n_pos, n_has_gauss, f_cached_gaussian = np.random.get_state()
+    n_version, tpl_internal, f_gauss_next = random.getstate()
+    return {'numpy': [s_name, nd_keys.tolist(), int(n_pos), int(n_has_gauss), float(f_cached_gaussian)],
+            'python': [n_version, list(tpl_internal), f_gauss_next]}
+
+
+def set_random_states(dic_states):
+    import random
+    s_name, lst_keys, n_pos, n_has_gauss, f_cached_gaussian = dic_states['numpy']
+    np.random.set_state((s_name, np.array(lst_keys, dtype=np.uint32), n_pos, n_has_gauss, f_cached_gaussian))
+    n_version, lst_internal, f_gauss_next = dic_states['python']
+    random.setstate((n_version, tuple(lst_internal), f_gauss_next))
+
+
+class CheckpointManager(object):
+    """
+    Saves the variables of a training session under s_checkpoint_dir/s_model_name-<step>, keeping the last
+    n_max_to_keep checkpoints. Only one write runs at a time: save() first waits for the previous one, and an
+    error of a background write is raised by the next save(), wait() or close().
+    """
+    def __init__(self, train_sess, s_checkpoint_dir, s_model_name='ALOCC_Model.model', n_max_to_keep=40,
+                 b_background=True, b_weights_only_export=False):
+        self.train_sess = train_sess
+        self.s_checkpoint_dir = s_checkpoint_dir
+        self.s_prefix = os.path.join(s_checkpoint_dir, s_model_name)
+        self.b_background = b_background
+        self.b_weights_only_export = b_weights_only_export
+        self.thread = None
+        self.lst_errors = []
+        if not os.path.exists(s_checkpoint_dir):
+            os.makedirs(s_checkpoint_dir)
+
+        self.lst_train_vars = train_sess.graph.get_collection(tf.GraphKeys.GLOBAL_VARIABLES)
+        set_weights = set(weight_variables(train_sess.graph))
+        self.lst_weight_names = [var.op.name for var in self.lst_train_vars if var in set_weights]
+
+        # one variable per training variable, saved under the training name
+        self.graph = tf.Graph()
+        with self.graph.as_default():
+            self.lst_placeholders = [tf.placeholder(var.dtype.base_dtype, var.get_shape()) for var in self.lst_train_vars]
+            lst_snapshot_vars = [tf.Variable(placeholder, trainable=False, collections=[], name='snapshot_%d' % i)
+                                 for i, placeholder in enumerate(self.lst_placeholders)]
+            self.load_op = tf.group(*[var.initializer for var in lst_snapshot_vars])
+            self.saver = tf.train.Saver({var.op.name: snapshot_var for var, snapshot_var
+                                         in zip(self.lst_train_vars, lst_snapshot_vars)}, max_to_keep=n_max_to_keep)
+        self.sess = tf.Session(graph=self.graph)
+
+        # checkpoints of a previous run count towards n_max_to_keep
+        ckpt = tf.train.get_checkpoint_state(s_checkpoint_dir)
+        if ckpt is not None:
+            self.saver.recover_last_checkpoints(list(ckpt.all_model_checkpoint_paths))
+
+    def save(self, n_step, dic_state=None):
+        """
+        Snapshot the variables now and write them (in the background if b_background) with dic_state
+        """
+        self.wait()
+        lst_values = self.train_sess.run(self.lst_train_vars)
+        if not self.b_background:
+            self._write(lst_values, n_step, dic_state)
+            return
+
+        self.thread = threading.Thread(target=self._write, args=(lst_values, n_step, dic_state), name='alocc-checkpoint')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def _write(self, lst_values, n_step, dic_state):
+        try:
+            self.sess.run(self.load_op, feed_dict=dict(zip(self.lst_placeholders, lst_values)))
+            # the side files go first: the checkpoint index only ever points to a complete set
+            s_checkpoint_path = '{}-{}'.format(self.s_prefix, n_step)
+            if self.b_weights_only_export:
+                dic_values = dict(zip([var.op.name for var in self.lst_train_vars], lst_values))
+                np.savez(s_checkpoint_path + '.weights.npz', **{s_name: dic_values[s_name] for s_name in self.lst_weight_names})
+            if dic_state is not None:
+                dic_state = dict(dic_state, step=n_step, checkpoint=os.path.basename(s_checkpoint_path))
+                with open(s_checkpoint_path + '.state.json.tmp', 'w') as f:
+                    json.dump(dic_state, f)
+                os.replace(s_checkpoint_path + '.state.json.tmp', s_checkpoint_path + '.state.json')
+
+            lst_previous = list(self.saver.last_checkpoints)
+            self.saver.save(self.sess, self.s_prefix, global_step=n_step, write_meta_graph=False)
+
+            # the files next to the checkpoints the saver just dropped
+            for s_dropped_path in set(lst_previous) - set(self.saver.last_checkpoints):
+                for s_suffix in ['.state.json', '.weights.npz']:
+                    if os.path.exists(s_dropped_path + s_suffix):
+                        os.remove(s_dropped_path + s_suffix)
+        except Exception as e:
+            if not self.b_background:
+                raise
+            self.lst_errors.append(e)
+
+    def wait(self):
+        """
+        Block until the background write, if any, is done
+        """
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+        if self.lst_errors:
+            raise self.lst_errors.pop(0)
+
+    def close(self):
+        try:
+            self.wait()
+        finally:
+            self.sess.close()
@@ -0,0 +1,381 @@
+"""
+Data-parallel training of ALOCC_Model in local worker processes.
+
+Every worker process builds the training graph in its own tf.Session, limited to its share of the cores,
+and holds one shard of the training patches. A step is synchronous:
+  1. the parameter server (this process) sends the current weights and batch-norm moving statistics,
+  2. every worker computes the D and G gradients on its next batch, from one forward pass as in
+     ALOCC_Model.f_train_step_fused,
+  3. the parameter server averages the gradients, applies Adam in numpy (same update as tf.train.AdamOptimizer)
+     and averages the moving statistics.
+Weights and gradients go through multiprocessing pipes, so everything runs on one machine without a network.
+The global batch is n_workers * n_batch_size.
+
+    python train.py --n_train_workers 4
+    python benchmark.py data_parallel --workers 1 2 4 8
+"""
+import multiprocessing
+import os
+import tempfile
+import time
+import traceback
+
+import numpy as np
+import tensorflow as tf
+
+from kh_tools import read_lst_patches_uint8, to_float_images
+from metrics import MetricsRegistry
+from checkpointing import CheckpointManager, read_resume_state, get_random_states, set_random_states
+
+# ALOCC_Model arguments a worker needs to build the same graph
+LST_MODEL_ARGUMENTS = ['input_height', 'input_width', 'output_height', 'output_width', 'batch_size',
+                       'gf_dim', 'df_dim', 'c_dim', 'r_alpha']
+
+
+def get_model_kwargs(model):
+    """
+    :return: ALOCC_Model keyword arguments of a worker graph with the geometry of model
+    """
+    dic_kwargs = {s_name: getattr(model, s_name) for s_name in LST_MODEL_ARGUMENTS}
+    dic_kwargs.update(nd_patch_size=tuple(model.patch_size), n_stride=model.patch_step[0],
+                      f_noise_sigma=model.noise_sigma, n_noise_seed=model.noise_seed)
+    return dic_kwargs
+
+
+class NumpyAdam(object):
+    """
+    Adam with the update of tf.train.AdamOptimizer, on a list of numpy arrays
+    """
+    def __init__(self, lst_values, f_learning_rate=0.001, f_beta1=0.9, f_beta2=0.999, f_epsilon=1e-8):
+        self.f_learning_rate = f_learning_rate
+        self.f_beta1 = f_beta1
+        self.f_beta2 = f_beta2
+        self.f_epsilon = f_epsilon
+        self.n_step = 0
+        self.lst_m = [np.zeros_like(value) for value in lst_values]
+        self.lst_v = [np.zeros_like(value) for value in lst_values]
+
+    def apply(self, lst_values, lst_grads):
+        """
+        Update lst_values in place
+        """
+        self.n_step += 1
+        f_lr = self.f_learning_rate * np.sqrt(1 - self.f_beta2 ** self.n_step) / (1 - self.f_beta1 ** self.n_step)
+        for value, grad, m, v in zip(lst_values, lst_grads, self.lst_m, self.lst_v):
+            m *= self.f_beta1
+            m += (1 - self.f_beta1) * grad
+            v *= self.f_beta2
+            v += (1 - self.f_beta2) * np.square(grad)
+            value -= f_lr * m / (np.sqrt(v) + self.f_epsilon)
+
+
+def _load_shard(dic_shard, nd_patch_size, nd_patch_step):
+    """
+    uint8 patches (N, h, w, 1) of a shard: {'frame_paths': [...]} or {'n_random': N, 'seed': n}
+    """
+    if 'frame_paths' in dic_shard:
+        nd_patches, _ = read_lst_patches_uint8(dic_shard['frame_paths'], nd_patch_size, nd_patch_step)
+    else:
+        rng = np.random.RandomState(dic_shard.get('seed', 0))
+        nd_patches = rng.randint(0, 256, (dic_shard['n_random'],) + tuple(nd_patch_size)).astype(np.uint8)
+    return nd_patches[..., np.newaxis]
+
+
+def _worker_main(n_worker, conn, dic_model_kwargs, dic_shard, n_threads, n_seed, n_skip_steps=0):
+    """
+    Worker process: answers ('step',) messages with gradients until ('stop',). The batch sequence depends on
+    n_seed only, n_skip_steps batches of it are skipped to continue an interrupted run.
+    """
+    try:
+        # the model is only needed here, the parameter server does not build a graph
+        from models import ALOCC_Model
+
+        config = tf.ConfigProto(intra_op_parallelism_threads=n_threads, inter_op_parallelism_threads=1)
+        s_tmp_dir = tempfile.mkdtemp(prefix='alocc_worker_')
+        with tf.Session(config=config) as sess:
+            dic_kwargs = dict(dic_model_kwargs)
+            if dic_kwargs.get('n_noise_seed') is not None:
+                dic_kwargs['n_noise_seed'] += n_worker
+            model = ALOCC_Model(sess, is_training=False, dataset_name='UCSD', dataset_address=s_tmp_dir,
+                                input_fname_pattern='*', checkpoint_dir=s_tmp_dir, log_dir=s_tmp_dir,
+                                sample_dir=s_tmp_dir, n_fetch_data=0, **dic_kwargs)
+
+            lst_train_vars = list(model.d_vars) + [var for var in model.g_vars if var not in model.d_vars]
+            lst_state_vars = [var for var in tf.global_variables() if 'moving_' in var.op.name]
+            d_grads = tf.gradients(model.d_loss, model.d_vars)
+            g_grads = tf.gradients(model.g_loss, model.g_vars)
+            dic_grads = {}
+            for var, grad in list(zip(model.d_vars, d_grads)) + list(zip(model.g_vars, g_grads)):
+                if grad is not None:
+                    dic_grads[var] = dic_grads[var] + grad if var in dic_grads else grad
+            lst_grads = [dic_grads.get(var, tf.zeros_like(var)) for var in lst_train_vars]
+
+            lst_all_vars = lst_train_vars + lst_state_vars
+            lst_placeholders = [tf.placeholder(var.dtype.base_dtype, var.get_shape()) for var in lst_all_vars]
+            load_op = tf.group(*[tf.assign(var, placeholder) for var, placeholder in zip(lst_all_vars, lst_placeholders)])
+            tf.global_variables_initializer().run()
+
+            nd_patches = _load_shard(dic_shard, model.patch_size, model.patch_step)
+            rng = np.random.RandomState(n_seed + n_worker)
+            nd_order = rng.permutation(len(nd_patches))
+            n_position = 0
+            n_batch_size = model.batch_size
+            for _ in range(n_skip_steps):
+                if n_position + n_batch_size > len(nd_order):
+                    nd_order = rng.permutation(len(nd_patches))
+                    n_position = 0
+                n_position += n_batch_size
+
+            conn.send(('ready', len(nd_patches), [var.op.name for var in lst_train_vars],
+                       [var.op.name for var in lst_state_vars], sess.run(lst_all_vars)))
+            while True:
+                tpl_message = conn.recv()
+                if tpl_message[0] == 'stop':
+                    break
+                _, lst_values = tpl_message
+                sess.run(load_op, feed_dict=dict(zip(lst_placeholders, lst_values)))
+
+                if n_position + n_batch_size > len(nd_order):
+                    nd_order = rng.permutation(len(nd_patches))
+                    n_position = 0
+                batch_images = to_float_images(nd_patches[nd_order[n_position:n_position + n_batch_size]])
+                n_position += n_batch_size
+
+                f_start = time.time()
+                lst_results = sess.run(lst_grads + [model.d_loss_fake, model.d_loss_real, model.g_loss],
+                                       feed_dict={model.inputs: batch_images})
+                # the moving averages are updated by that run (see ops.batch_norm)
+                lst_states = sess.run(lst_state_vars)
+                conn.send(('grads', lst_results[:len(lst_grads)], lst_states, lst_results[len(lst_grads):],
+                           len(batch_images), time.time() - f_start))
+    except Exception:
+        conn.send(('error', n_worker, traceback.format_exc()))
+    finally:
+        conn.close()
+
+
+class DataParallelTrainer(object):
+    """
+    Parameter server of n_workers = len(lst_shards) worker processes, each training on one shard.
+    lst_shards items are {'frame_paths': [...]} (UCSD frames, patched in the worker) or {'n_random': N}.
+    The workers draw their batches from a sequence fixed by n_seed, of which the first n_skip_steps are skipped.
+    """
+    def __init__(self, dic_model_kwargs, lst_shards, f_learning_rate=0.0002, n_threads_per_worker=None, n_seed=0,
+                 n_skip_steps=0):
+        self.n_workers = len(lst_shards)
+        if n_threads_per_worker is None:
+            n_threads_per_worker = max(1, multiprocessing.cpu_count() // self.n_workers)
+
+        # TensorFlow does not survive a fork, the workers start from a fresh interpreter
+        context = multiprocessing.get_context('spawn')
+        self.lst_conns = []
+        self.lst_processes = []
+        for n_worker, dic_shard in enumerate(lst_shards):
+            conn, worker_conn = context.Pipe()
+            process = context.Process(target=_worker_main, name='alocc-worker-%d' % n_worker,
+                                      args=(n_worker, worker_conn, dic_model_kwargs, dic_shard, n_threads_per_worker, n_seed,
+                                            n_skip_steps))
+            process.daemon = True
+            process.start()
+            self.lst_conns.append(conn)
+            self.lst_processes.append(process)
+
+        lst_ready = [self._receive(conn) for conn in self.lst_conns]
+        self.lst_shard_sizes = [tpl_ready[1] for tpl_ready in lst_ready]
+        self.lst_train_names, self.lst_state_names = lst_ready[0][2], lst_ready[0][3]
+        lst_initial = lst_ready[0][4]
+        self.lst_values = lst_initial[:len(self.lst_train_names)]
+        self.lst_states = lst_initial[len(self.lst_train_names):]
+        self.optimizer = NumpyAdam(self.lst_values, f_learning_rate)
+        self.n_batch_size = dic_model_kwargs['batch_size']
+
+    def _receive(self, conn):
+        tpl_message = conn.recv()
+        if tpl_message[0] == 'error':
+            self.stop()
+            raise Exception('[!] training worker {} failed:\n{}'.format(tpl_message[1], tpl_message[2]))
+        return tpl_message
+
+    @property
+    def n_steps_per_epoch(self):
+        return min(self.lst_shard_sizes) // self.n_batch_size
+
+    def set_values(self, dic_values):
+        """
+        Replace weights and moving statistics by the arrays of dic_values {variable name: value} (e.g. a restored
+        checkpoint); the Adam moments start again from zero
+        """
+        self.lst_values = [np.array(dic_values[s_name], np.float32) for s_name in self.lst_train_names]
+        self.lst_states = [np.array(dic_values[s_name], np.float32) for s_name in self.lst_state_names]
+        self.optimizer = NumpyAdam(self.lst_values, self.optimizer.f_learning_rate)
+
+    def get_values(self):
+        return dict(zip(self.lst_train_names + self.lst_state_names, self.lst_values + self.lst_states))
+
+    def step(self):
+        """
+        One synchronous step on all workers
+        :return: dict with the averaged losses, the number of patches, the wall time and the mean compute time of the workers
+        """
+        f_start = time.time()
+        lst_message = self.lst_values + self.lst_states
+        for conn in self.lst_conns:
+            conn.send(('step', lst_message))
+        lst_replies = [self._receive(conn) for conn in self.lst_conns]
+
+        lst_mean_grads = [np.mean(tpl_grads, axis=0) for tpl_grads in zip(*[tpl_reply[1] for tpl_reply in lst_replies])]
+        self.optimizer.apply(self.lst_values, lst_mean_grads)
+        self.lst_states = [np.mean(tpl_states, axis=0) for tpl_states in zip(*[tpl_reply[2] for tpl_reply in lst_replies])]
+
+        nd_losses = np.mean([tpl_reply[3] for tpl_reply in lst_replies], axis=0)
+        return {'d_loss_fake': float(nd_losses[0]), 'd_loss_real': float(nd_losses[1]), 'g_loss': float(nd_losses[2]),
+                'n_patches': sum(tpl_reply[4] for tpl_reply in lst_replies), 'sec': time.time() - f_start,
+                'worker_compute_sec': float(np.mean([tpl_reply[5] for tpl_reply in lst_replies]))}
+
+    def stop(self):
+        for conn, process in zip(self.lst_conns, self.lst_processes):
+            if process.is_alive():
+                try:
+                    conn.send(('stop',))
+                except (OSError, IOError):
+                    pass
+        for process in self.lst_processes:
+            process.join(10)
+            if process.is_alive():
+                process.terminate()
+
+
+def shard_list(lst_items, n_shards):
+    """
+    Round-robin split of lst_items into n_shards lists
+    """
+    return [lst_items[i::n_shards] for i in range(n_shards)]
+
+
+def train_data_parallel(model, config):
+    """
+    ALOCC_Model.train with config.n_train_workers worker processes (UCSD): frames of model.data are sharded over
+    the workers, the metrics go to the same registry files, and the weights are copied back into model.sess and
+    checkpointed at the end of every epoch (and every checkpoint_every_steps steps). A checkpoint keeps the epoch,
+    step, frame sample and worker batch sequence, so that with config.resume a restarted job continues where it
+    stopped; the Adam moments of the parameter server are not saved and start again from zero.
+    """
+    n_workers = config.n_train_workers
+    model.build_train_ops(config.learning_rate)
+    tf.global_variables_initializer().run(session=model.sess)
+    model.saver = tf.train.Saver(max_to_keep=40)
+    could_load, counter = model.load(model.checkpoint_dir)
+    counter = counter if could_load else 1
+
+    dic_resume_state = None
+    if could_load and getattr(config, 'resume', True):
+        dic_resume_state = read_resume_state(tf.train.latest_checkpoint(os.path.join(model.checkpoint_dir, model.model_dir)))
+    n_start_epoch, n_start_idx, n_worker_steps = 0, 0, 0
+    n_worker_seed = np.random.randint(2 ** 31 - 1)
+    if dic_resume_state is not None:
+        n_start_epoch = dic_resume_state['epoch']
+        if dic_resume_state['data'] is not None:
+            # the frames sampled by the interrupted run, so the shards are the same
+            model.data = dic_resume_state['data']
+        if dic_resume_state.get('n_train_workers') == n_workers:
+            n_start_idx = dic_resume_state['batch_index']
+            n_worker_seed, n_worker_steps = dic_resume_state['worker_seed'], dic_resume_state['worker_steps']
+        else:
+            # written with another number of workers (or by train): the interrupted epoch starts over
+            print(" [!] Checkpoint state is not from {} workers, restarting epoch {}".format(n_workers, n_start_epoch))
+        print(" [*] Resuming at epoch %d, batch %d (step %d)" % (n_start_epoch, n_start_idx, counter))
+
+    trainer = DataParallelTrainer(get_model_kwargs(model), [{'frame_paths': lst_shard} for lst_shard in shard_list(model.data, n_workers)],
+                                  config.learning_rate, getattr(config, 'n_threads_per_worker', None) or None,
+                                  n_worker_seed, n_worker_steps)
+    # the workers start from the weights of model.sess, restored from the latest checkpoint if there is one
+    dic_model_vars = {var.op.name: var for var in model.sess.graph.get_collection(tf.GraphKeys.GLOBAL_VARIABLES)}
+    lst_names = trainer.lst_train_names + trainer.lst_state_names
+    trainer.set_values(dict(zip(lst_names, model.sess.run([dic_model_vars[s_name] for s_name in lst_names]))))
+
+    log_dir = os.path.join(model.log_dir, model.model_dir)
+    s_metrics_dir = getattr(config, 'metrics_dir', None) or log_dir
+    registry = MetricsRegistry(os.path.join(s_metrics_dir, 'metrics.jsonl'), os.path.join(s_metrics_dir, 'metrics.prom'),
+                               getattr(config, 'metrics_export_secs', 30.), getattr(config, 'print_every_secs', 10.))
+    # the Adam moments live in the parameter server, the slots of the checkpoint are those of model.sess
+    checkpoints = CheckpointManager(model.sess, os.path.join(config.checkpoint_dir, model.model_dir),
+                                    b_background=getattr(config, 'async_checkpoint', True),
+                                    b_weights_only_export=getattr(config, 'export_weights', False))
+    n_checkpoint_every = getattr(config, 'checkpoint_every_steps', 0)
+
+    def save(n_epoch, n_batch_index):
+        for s_name, value in trainer.get_values().items():
+            dic_model_vars[s_name].load(value, model.sess)
+        # pipeline_* keep the state readable by ALOCC_Model.train
+        checkpoints.save(counter, {'epoch': n_epoch, 'batch_index': n_batch_index, 'n_train_workers': n_workers,
+                                   'worker_seed': n_worker_seed, 'worker_steps': n_worker_steps,
+                                   'pipeline_batches': 0, 'pipeline_seed': n_worker_seed, 'noise_seed': model.noise_seed,
+                                   'data': model.data, 'random_states': get_random_states()})
+
+    if dic_resume_state is not None:
+        set_random_states(dic_resume_state['random_states'])
+    print(' [*] Data-parallel training: {} workers, shards of {} patches, {} steps per epoch'.format(
+        n_workers, trainer.lst_shard_sizes, trainer.n_steps_per_epoch))
+    try:
+        for epoch in range(n_start_epoch, config.epoch):
+            f_epoch_start_time = time.time()
+            n_epoch_patches = 0
+            for idx in range(n_start_idx if epoch == n_start_epoch else 0, trainer.n_steps_per_epoch):
+                dic_step = trainer.step()
+                counter += 1
+                n_worker_steps += 1
+                n_epoch_patches += dic_step['n_patches']
+                registry.histogram('step_seconds').observe(dic_step['sec'])
+                registry.histogram('worker_compute_seconds').observe(dic_step['worker_compute_sec'])
+                registry.counter('steps_total').inc()
+                registry.counter('patches_total').inc(dic_step['n_patches'])
+                registry.gauge('patches_per_second').set(n_epoch_patches / max(time.time() - f_epoch_start_time, 1e-12))
+                for s_name in ['d_loss_fake', 'd_loss_real', 'g_loss']:
+                    registry.gauge(s_name).set(dic_step[s_name])
+                if registry.should_print():
+                    print("Epoch:[%2d][%4d/%4d]--> %s" % (epoch, idx, trainer.n_steps_per_epoch, registry.format_line(
+                        ['d_loss_fake', 'd_loss_real', 'g_loss', 'step_seconds', 'worker_compute_seconds', 'patches_per_second'])))
+                registry.maybe_export(counter)
+                if n_checkpoint_every and counter % n_checkpoint_every == 0 and idx + 1 < trainer.n_steps_per_epoch:
+                    save(epoch, idx + 1)
+
+            save(epoch + 1, 0)
+    finally:
+        trainer.stop()
+        registry.close(counter)
+        checkpoints.close()
+
+
+def measure_scaling(lst_n_workers=(1, 2, 4), n_batch_size=64, n_steps=10, n_warmup=2, n_patches_per_worker=1024,
+                    nd_patch_size=(45, 45), n_threads_per_worker=None):
+    """
+    Weak scaling on random patches: every worker keeps n_batch_size patches per step
+    :return: {n_workers: {steps_per_sec, patches_per_sec, worker_compute_sec, efficiency}}, where efficiency is
+             patches_per_sec / (n_workers * patches/sec per worker of the first entry of lst_n_workers)
+    """
+    dic_model_kwargs = {'input_height': nd_patch_size[0], 'input_width': nd_patch_size[1],
+                        'output_height': nd_patch_size[0], 'output_width': nd_patch_size[1],
+                        'batch_size': n_batch_size, 'nd_patch_size': tuple(nd_patch_size), 'n_stride': 10}
+    dic_results = {}
+    f_base_per_worker = None
+    for n_workers in lst_n_workers:
+        trainer = DataParallelTrainer(dic_model_kwargs, [{'n_random': n_patches_per_worker, 'seed': i} for i in range(n_workers)],
+                                      n_threads_per_worker=n_threads_per_worker)
+        try:
+            for _ in range(n_warmup):
+                trainer.step()
+            f_start = time.time()
+            lst_steps = [trainer.step() for _ in range(n_steps)]
+            f_sec = time.time() - f_start
+        finally:
+            trainer.stop()
+
+        f_patches_per_sec = sum(dic_step['n_patches'] for dic_step in lst_steps) / f_sec
+        if f_base_per_worker is None:
+            f_base_per_worker = f_patches_per_sec / n_workers
+        dic_results[n_workers] = {'steps_per_sec': n_steps / f_sec, 'patches_per_sec': f_patches_per_sec,
+                                  'worker_compute_sec': float(np.mean([dic_step['worker_compute_sec'] for dic_step in lst_steps])),
+                                  'efficiency': f_patches_per_sec / (n_workers * f_base_per_worker)}
+        print('{:3d} workers: {:8.2f} steps/s, {:9.1f} patches/s, scaling efficiency {:.0%}'.format(
+            n_workers, dic_results[n_workers]['steps_per_sec'], f_patches_per_sec, dic_results[n_workers]['efficiency']))
+    return dic_results
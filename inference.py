@@ -0,0 +1,116 @@
+"""
+Inference-only export of a trained ALOCC model and a loader for the exported graph.
+
+# freeze the latest checkpoint of checkpoint/UCSD_128_45_45 into a pruned scoring graph
+python inference.py --checkpoint_dir ./checkpoint/UCSD_128_45_45 --export_path ./export/ALOCC_UCSD_45.pb
+
+The exported graph only holds the scoring outputs (inference/D, inference/D_, inference/G) with the
+variables frozen to constants. FrozenScorer opens it without building ALOCC_Model or touching a dataset.
+"""
+import json
+import os
+import time
+
+import numpy as np
+import tensorflow as tf
+
+from utils import score_in_batches
+
+flags = tf.app.flags
+flags.DEFINE_string("checkpoint_dir", "./checkpoint/UCSD_128_45_45", "Directory of the checkpoint to export")
+flags.DEFINE_string("checkpoint_path", None, "Checkpoint prefix (or weights-only .npz export) to export, None for the latest one in checkpoint_dir [None]")
+flags.DEFINE_string("export_path", "./export/ALOCC_UCSD_45.pb", "Path of the exported inference graph")
+flags.DEFINE_integer("input_height", 45, "The size of the patches. [45]")
+flags.DEFINE_integer("input_width", None, "The size of the patches. If None, same value as input_height [None]")
+flags.DEFINE_integer("c_dim", 1, "Channels of the patches [1]")
+flags.DEFINE_boolean("fold_batch_norm", False, "Fold batch-norm (moving averages) into the conv/deconv weights: no batch-norm op in the export [False]")
+
+# tensor names of the exported graph
+DIC_INPUT_NAMES = {'inputs': 'real_images:0', 'z': 'z:0'}
+DIC_OUTPUT_NAMES = {'D': 'inference/D:0', 'D_': 'inference/D_:0', 'G': 'inference/G:0'}
+# input each output is computed from
+DIC_OUTPUT_INPUTS = {'D': 'inputs', 'D_': 'z', 'G': 'z'}
+
+
+def export_inference_graph(s_checkpoint_path, s_export_path, nd_patch_size=(45, 45), c_dim=1, b_fold_batch_norm=False):
+    """
+    Restore s_checkpoint_path into an inference-only ALOCC_Model and write the frozen, pruned graph
+    to s_export_path (plus a small json description next to it)
+    :param b_fold_batch_norm: export batch-norm on the moving averages folded into the conv/deconv weights
+    """
+    # only the exporter needs the model definition, FrozenScorer does not
+    from models import ALOCC_Model
+
+    with tf.Graph().as_default(), tf.Session() as sess:
+        model = ALOCC_Model(sess, input_height=nd_patch_size[0], input_width=nd_patch_size[1],
+                            output_height=nd_patch_size[0], output_width=nd_patch_size[1],
+                            c_dim=c_dim, is_training=False, b_inference_only=True, b_fold_batch_norm=b_fold_batch_norm)
+        model.f_check_checkpoint(s_checkpoint_path)
+
+        lst_output_nodes = [s_name.split(':')[0] for s_name in DIC_OUTPUT_NAMES.values()]
+        graph_def = tf.graph_util.convert_variables_to_constants(sess, sess.graph.as_graph_def(), lst_output_nodes)
+
+    s_export_dir = os.path.dirname(s_export_path)
+    if s_export_dir and not os.path.exists(s_export_dir):
+        os.makedirs(s_export_dir)
+    with tf.gfile.GFile(s_export_path, 'wb') as f:
+        f.write(graph_def.SerializeToString())
+    with open(s_export_path + '.json', 'w') as f:
+        json.dump({'checkpoint': s_checkpoint_path, 'patch_size': list(nd_patch_size), 'c_dim': c_dim,
+                   'fold_batch_norm': b_fold_batch_norm,
+                   'inputs': DIC_INPUT_NAMES, 'outputs': DIC_OUTPUT_NAMES}, f, indent=2)
+
+    print(' [*] Exported {} ({} nodes) to {}'.format(s_checkpoint_path, len(graph_def.node), s_export_path))
+    return s_export_path
+
+
+class FrozenScorer(object):
+    """
+    Scores patches with a graph written by export_inference_graph
+    """
+    def __init__(self, s_graph_path, n_batch_size=512, config=None):
+        f_start = time.time()
+        graph_def = tf.GraphDef()
+        with tf.gfile.GFile(s_graph_path, 'rb') as f:
+            graph_def.ParseFromString(f.read())
+
+        self.graph = tf.Graph()
+        with self.graph.as_default():
+            tf.import_graph_def(graph_def, name='')
+        self.sess = tf.Session(graph=self.graph, config=config)
+        self.n_batch_size = n_batch_size
+
+        dic_inputs = {s_key: self.graph.get_tensor_by_name(s_name) for s_key, s_name in DIC_INPUT_NAMES.items()}
+        self.dic_output_tensors = {}
+        for s_output, s_name in DIC_OUTPUT_NAMES.items():
+            self.dic_output_tensors[s_output] = (self.graph.get_tensor_by_name(s_name), dic_inputs[DIC_OUTPUT_INPUTS[s_output]])
+        self.f_load_time = time.time() - f_start
+
+    def score(self, nd_patches, lst_outputs=('D',)):
+        """
+        :return: dict output name -> numpy array aligned with nd_patches (see ALOCC_Model.f_score_patches)
+        """
+        return score_in_batches(self.sess, self.dic_output_tensors, nd_patches, lst_outputs, self.n_batch_size)
+
+    def close(self):
+        self.sess.close()
+
+
+def main(_):
+    FLAGS = flags.FLAGS
+    if FLAGS.input_width is None:
+        FLAGS.input_width = FLAGS.input_height
+
+    s_checkpoint_path = FLAGS.checkpoint_path or tf.train.latest_checkpoint(FLAGS.checkpoint_dir)
+    if s_checkpoint_path is None:
+        raise Exception("[!] No checkpoint found in {}".format(FLAGS.checkpoint_dir))
+    export_inference_graph(s_checkpoint_path, FLAGS.export_path, (FLAGS.input_height, FLAGS.input_width), FLAGS.c_dim,
+                           FLAGS.fold_batch_norm)
+
+    scorer = FrozenScorer(FLAGS.export_path)
+    nd_patches = np.random.uniform(0, 1, [8, FLAGS.input_height, FLAGS.input_width, FLAGS.c_dim])
+    print(' [*] Loaded in {:.3f}s, D on random patches: {}'.format(
+        scorer.f_load_time, scorer.score(nd_patches)['D'].reshape(-1)))
+
+if __name__ == '__main__':
+    tf.app.run()
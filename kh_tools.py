@@ -1,16 +1,15 @@
 import os
 import datetime
 import json
-from PIL import Image
+import multiprocessing
+from contextlib import closing
+from functools import lru_cache
 import numpy as np
+from numpy.lib.stride_tricks import as_strided
 from glob import glob
-from PIL import Image, ImageDraw
-from scipy import ndimage, misc
-import scipy.misc
-import imageio
 
-# http://scikit-image.org/docs/dev/auto_examples/filters/plot_denoise.html
-from skimage.util import random_noise
+# PIL, scipy and scikit-image are imported by the functions that use them: importing them all takes longer
+# than a scoring run needs to start
 
 '''
 IMAGE PROCESSING
@@ -19,8 +18,11 @@ IMAGE PROCESSING
 - read_lst_images
 - read_image
 - get_noisy_data
+- get_image_patches
 '''
 def get_noisy_data(data):
+    # http://scikit-image.org/docs/dev/auto_examples/filters/plot_denoise.html
+    from skimage.util import random_noise
     lst_noisy = []
     sigma = 0.155
     for image in data:
@@ -42,6 +44,7 @@ def read_dataset_image_path(s_dataset_url, n_number_count=None):
 
 
 def read_image_w_noise(s_image_path):
+    from skimage.util import random_noise
     tmp_image = read_image(s_image_path)
     sigma = 0.155
     noisy = random_noise(tmp_image, var=sigma ** 2)
@@ -97,15 +100,259 @@ def read_dataset_images(s_dataset_url , nd_img_size ,n_number_count):
 
     return np.array(lst_images)
 
+'''
+PARALLEL READERS
+Same results as the readers above, with frames decoded, noised and patched in a pool of worker processes.
+Results come back in input order, n_chunksize frames per transfer. Noise is drawn per frame with seed
+n_seed + frame index, so it does not depend on the number of workers.
+Workers are spawned, not forked: the readers run in processes that already hold a TensorFlow session, and
+TensorFlow does not survive a fork. They serve frames from the frame store of the parent, if any.
+'''
+def _get_pool(n_workers):
+    return multiprocessing.get_context('spawn').Pool(n_workers, initializer=set_frame_store, initargs=(_frame_store,))
+
+def _read_frame_task(tpl_task):
+    s_image_path, n_noise_seed, nd_patch_size, n_patch_step = tpl_task
+    tmp_img = read_image(s_image_path)
+    if n_noise_seed is not None:
+        # skimage random_noise(var=0.155 ** 2) with its old seed= keyword (np.random.seed), which newer
+        # scikit-image versions removed: gaussian noise, clipped to [0, 1]
+        tmp_img = np.clip(tmp_img + np.random.RandomState(n_noise_seed).normal(0., 0.155, tmp_img.shape), 0., 1.)
+    if nd_patch_size is None:
+        return tmp_img, None
+    return get_image_patches([tmp_img], nd_patch_size, n_patch_step)
+
+def _map_frames(lst_images_path, b_noise, nd_patch_size, n_patch_step, n_workers, n_chunksize, n_seed):
+    if b_noise and n_seed is None:
+        # every frame gets its own seed, the workers do not share a random state
+        n_seed = np.random.randint(0, 2 ** 31 - len(lst_images_path))
+    lst_tasks = [(s_image_path, n_seed + i if b_noise else None, nd_patch_size, n_patch_step)
+                 for i, s_image_path in enumerate(lst_images_path)]
+
+    if n_workers is None:
+        n_workers = multiprocessing.cpu_count()
+    if n_workers <= 1:
+        return [_read_frame_task(tpl_task) for tpl_task in lst_tasks]
+    with closing(_get_pool(n_workers)) as pool:
+        return list(pool.imap(_read_frame_task, lst_tasks, chunksize=n_chunksize))
+
+def _concat_patches(lst_results):
+    nd_slices = np.concatenate([tmp_slices for tmp_slices, _ in lst_results])
+    lst_location = [location for _, tmp_locations in lst_results for location in tmp_locations]
+    return nd_slices, lst_location
+
+def read_lst_images_parallel(lst_images_path, nd_patch_size, n_patch_step, b_work_on_patch=True,
+                             n_workers=None, n_chunksize=8):
+    if b_work_on_patch:
+        return _concat_patches(_map_frames(lst_images_path, False, nd_patch_size, n_patch_step, n_workers, n_chunksize, None))
+    lst_results = _map_frames(lst_images_path, False, None, None, n_workers, n_chunksize, None)
+    return np.array([tmp_img for tmp_img, _ in lst_results])
+
+def read_lst_images_w_noise_parallel(lst_images_path, nd_patch_size, n_patch_step,
+                                     n_workers=None, n_chunksize=8, n_seed=None):
+    return _concat_patches(_map_frames(lst_images_path, True, nd_patch_size, n_patch_step, n_workers, n_chunksize, n_seed))
+
+def read_lst_images_w_noise2_parallel(lst_images_path, nd_patch_size, n_patch_step,
+                                      n_workers=None, n_chunksize=8, n_seed=None):
+    lst_results = _map_frames(lst_images_path, True, None, None, n_workers, n_chunksize, n_seed)
+    return np.array([tmp_img for tmp_img, _ in lst_results])
+
+def read_dataset_images_parallel(s_dataset_url, nd_img_size, n_number_count, n_workers=None, n_chunksize=8):
+    # nd_img_size is kept for the signature of read_dataset_images, frames keep the ND_FRAME_CROP size
+    lst_images_path = read_dataset_image_path(s_dataset_url, n_number_count)
+    lst_results = _map_frames(list(lst_images_path), False, None, None, n_workers, n_chunksize, None)
+    return np.array([tmp_img for tmp_img, _ in lst_results])
+
+'''
+UINT8 PATCHES
+Training patches kept as uint8 pixels (1 byte each instead of the 8 of the float64 patches of read_lst_images),
+scaled to float32 with to_float_images only when a batch is fed.
+'''
+def _read_patches_uint8_task(tpl_task):
+    s_image_path, nd_patch_size, n_patch_step = tpl_task
+    tmp_slices, _ = get_image_patches([read_image_uint8(s_image_path)], nd_patch_size, n_patch_step)
+    return tmp_slices[:, 0]
+
+def read_lst_patches_uint8(lst_images_path, nd_patch_size, n_patch_step, n_workers=1, n_chunksize=8):
+    """
+    Patches of every frame in one preallocated uint8 array, frames decoded in n_workers processes if n_workers > 1
+    :return: patches with shape (#frames * #locations, patch_h, patch_w) and the list of [start_h, start_w] of every patch
+    """
+    lst_images_path = list(lst_images_path)
+    if len(lst_images_path) == 0:
+        return np.zeros((0, nd_patch_size[0], nd_patch_size[1]), np.uint8), []
+
+    nd_locations = get_patch_locations(read_image_uint8(lst_images_path[0]).shape, nd_patch_size, n_patch_step)
+    n_patches_per_frame = len(nd_locations)
+    nd_patches = np.empty((len(lst_images_path) * n_patches_per_frame, nd_patch_size[0], nd_patch_size[1]), np.uint8)
+    lst_tasks = [(s_image_path, nd_patch_size, n_patch_step) for s_image_path in lst_images_path]
+
+    if n_workers is None:
+        n_workers = multiprocessing.cpu_count()
+    if n_workers <= 1:
+        for i, tpl_task in enumerate(lst_tasks):
+            nd_patches[i * n_patches_per_frame:(i + 1) * n_patches_per_frame] = _read_patches_uint8_task(tpl_task)
+    else:
+        with closing(_get_pool(n_workers)) as pool:
+            for i, tmp_slices in enumerate(pool.imap(_read_patches_uint8_task, lst_tasks, chunksize=n_chunksize)):
+                nd_patches[i * n_patches_per_frame:(i + 1) * n_patches_per_frame] = tmp_slices
+    return nd_patches, nd_locations.tolist() * len(lst_images_path)
+
 def read_image(s_image_path):
     # tmp_image = scipy.misc.imread(s_image_path)[100:240,0:360]/127.5 -1.
-    tmp_image = scipy.misc.imread(s_image_path)[100:240,0:360]/255.
+    tmp_image = read_image_uint8(s_image_path)/255.
 
     #sigma = 0.155
     #noisy = random_noise(tmp_image, var=sigma ** 2)
     # image = scipy.misc.imresize(tmp_image, nd_img_size)
     return np.array(tmp_image)
 
+def read_image_uint8(s_image_path):
+    """
+    Cropped frame as uint8 pixels, from the frame store when it holds the frame
+    """
+    if _frame_store is not None and s_image_path in _frame_store:
+        return np.array(_frame_store.read(s_image_path))
+    return read_image_crop(s_image_path)
+
+def to_float_images(nd_images):
+    """
+    float32 images in [0, 1] for the network, uint8 pixels are scaled by 1/255 as read_image does
+    """
+    nd_images = np.asarray(nd_images)
+    if nd_images.dtype == np.uint8:
+        return nd_images.astype(np.float32) / np.float32(255.)
+    return nd_images.astype(np.float32)
+
+def read_image_crop(s_image_path, nd_crop=None):
+    """
+    Decode one frame and return its uint8 crop ((start_h, end_h), (start_w, end_w)) as in ND_FRAME_CROP
+    """
+    if nd_crop is None:
+        nd_crop = ND_FRAME_CROP
+    import scipy.misc
+    tmp_image = scipy.misc.imread(s_image_path)
+    return tmp_image[nd_crop[0][0]:nd_crop[0][1], nd_crop[1][0]:nd_crop[1][1]]
+
+'''
+FRAME STORE
+- FrameStore
+- set_frame_store
+'''
+# Crop applied to every UCSD frame
+ND_FRAME_CROP = ((100, 240), (0, 360))
+
+_frame_store = None
+
+def set_frame_store(frame_store):
+    """
+    Make read_image (and so every read_lst_images* reader) serve frames from frame_store
+    instead of decoding them. Pass None to go back to decoding.
+    """
+    global _frame_store
+    _frame_store = frame_store
+
+class FrameStore(object):
+    """
+    Build-once on-disk store of cropped uint8 frames.
+    The frames live in one memory-mapped array (frames.npy) and index.json maps every frame
+    to its row, by path or by (video, frame) name, e.g. store.get('Train001', '001.tif').
+    The store is rebuilt when the crop or the list of frames changes or a frame file is modified.
+    """
+    s_frames_name = 'frames.npy'
+    s_index_name = 'index.json'
+
+    def __init__(self, s_store_dir, lst_images_path, nd_crop=None):
+        self.s_store_dir = s_store_dir
+        self.nd_crop = [list(x) for x in (nd_crop if nd_crop is not None else ND_FRAME_CROP)]
+        self.lst_images_path = [os.path.abspath(x) for x in lst_images_path]
+
+        kh_isDirExist(s_store_dir)
+        if not self.is_valid():
+            self.build()
+        self.open()
+
+    @property
+    def frames_path(self):
+        return os.path.join(self.s_store_dir, self.s_frames_name)
+
+    @property
+    def index_path(self):
+        return os.path.join(self.s_store_dir, self.s_index_name)
+
+    def _entries(self):
+        return [[s_path, os.stat(s_path).st_mtime_ns] for s_path in self.lst_images_path]
+
+    def is_valid(self):
+        if not (os.path.exists(self.frames_path) and os.path.exists(self.index_path)):
+            return False
+        with open(self.index_path) as f:
+            dic_index = json.load(f)
+        return dic_index['crop'] == self.nd_crop and dic_index['entries'] == self._entries()
+
+    def build(self):
+        print(' [*] Building frame store at {} ({} frames)'.format(self.s_store_dir, len(self.lst_images_path)))
+        lst_entries = self._entries()
+        nd_first = read_image_crop(self.lst_images_path[0], self.nd_crop)
+
+        s_frames_tmp = self.frames_path + '.tmp'
+        nd_frames = np.lib.format.open_memmap(s_frames_tmp, mode='w+', dtype=np.uint8,
+                                              shape=(len(self.lst_images_path),) + nd_first.shape)
+        for i, s_path in enumerate(self.lst_images_path):
+            tmp_image = nd_first if i == 0 else read_image_crop(s_path, self.nd_crop)
+            if tmp_image.dtype != np.uint8:
+                raise ValueError('FrameStore expects 8-bit frames, {} is {}'.format(s_path, tmp_image.dtype))
+            nd_frames[i] = tmp_image
+        nd_frames.flush()
+        del nd_frames
+
+        s_index_tmp = self.index_path + '.tmp'
+        with open(s_index_tmp, 'w') as f:
+            json.dump({'crop': self.nd_crop, 'entries': lst_entries}, f)
+        # the index goes in last, so an interrupted build never looks valid
+        if os.path.exists(self.index_path):
+            os.remove(self.index_path)
+        os.replace(s_frames_tmp, self.frames_path)
+        os.replace(s_index_tmp, self.index_path)
+
+    def open(self):
+        self.frames = np.load(self.frames_path, mmap_mode='r')
+        self.dic_path_row = {}
+        self.dic_video_frame_row = {}
+        for i, s_path in enumerate(self.lst_images_path):
+            self.dic_path_row[s_path] = i
+            self.dic_video_frame_row[(os.path.basename(os.path.dirname(s_path)), os.path.basename(s_path))] = i
+
+    def __getstate__(self):
+        # the memory map is reopened on unpickling (e.g. in reader workers) instead of being copied
+        return {'s_store_dir': self.s_store_dir, 'nd_crop': self.nd_crop, 'lst_images_path': self.lst_images_path}
+
+    def __setstate__(self, dic_state):
+        self.__dict__.update(dic_state)
+        self.open()
+
+    def __len__(self):
+        return len(self.lst_images_path)
+
+    def __contains__(self, s_image_path):
+        return os.path.abspath(s_image_path) in self.dic_path_row
+
+    def read(self, s_image_path):
+        """
+        uint8 crop of one frame (a read-only view into the memory map)
+        """
+        return self.frames[self.dic_path_row[os.path.abspath(s_image_path)]]
+
+    def get(self, s_video, s_frame):
+        return self.frames[self.dic_video_frame_row[(s_video, s_frame)]]
+
+    def get_video(self, s_video):
+        """
+        All frames of one video, in frame name order
+        """
+        lst_rows = [n_row for (s_v, s_f), n_row in sorted(self.dic_video_frame_row.items()) if s_v == s_video]
+        return self.frames[lst_rows]
+
 
 def get_patch_video(lst_images, nd_patch_size, nd_stride, n_depth):
     lst_video_slice = []
@@ -132,57 +379,156 @@ def get_patch_video(lst_images, nd_patch_size, nd_stride, n_depth):
 
 
 def get_image_patches(image_src, nd_patch_size, nd_stride):
-    image_src = np.array(image_src)
-
-    lst_patches = []
-    lst_locations = []
+    """
+    Cut every frame of image_src into patches of nd_patch_size every nd_stride pixels.
+    The last row/column of patches is clamped to the frame border, so border
+    locations may appear more than once (same order as the original while-loop version).
+    :return: patches with shape (#locations, #frames, patch_h, patch_w) and the list of [start_h, start_w]
+    """
+    nd_windows, nd_locations = get_image_patches_view(image_src, nd_patch_size, nd_stride)
+
+    # one gather over the strided view instead of a python copy per location
+    nd_patches = nd_windows[:, nd_locations[:, 0], nd_locations[:, 1]]
+    nd_patches = np.ascontiguousarray(nd_patches.transpose([1, 0] + list(range(2, nd_patches.ndim))))
+
+    return nd_patches, nd_locations.tolist()
+
+def get_image_patches_view(image_src, nd_patch_size, nd_stride):
+    """
+    Zero-copy version of get_image_patches.
+    :return: a read-only sliding window view with shape (#frames, frame_h-patch_h+1, frame_w-patch_w+1, patch_h, patch_w)
+             and the (#locations, 2) array of [start_h, start_w]; patch k of every frame is
+             nd_windows[:, nd_locations[k, 0], nd_locations[k, 1]]
+    """
+    image_src = np.asarray(image_src)
+    nd_windows = get_image_windows(image_src, nd_patch_size)
+    nd_locations = get_patch_locations(image_src.shape[1:3], nd_patch_size, nd_stride)
+    return nd_windows, nd_locations
+
+def get_image_windows(image_src, nd_patch_size):
+    """
+    Read-only sliding window view (stride 1) over a stack of frames, in the spirit of utils.kh_make_patches
+    """
+    n_patch_h, n_patch_w = nd_patch_size[0], nd_patch_size[1]
+    n_frames, n_frame_h, n_frame_w = image_src.shape[0:3]
+    n_stride_f, n_stride_h, n_stride_w = image_src.strides[0:3]
+
+    shape = (n_frames, n_frame_h - n_patch_h + 1, n_frame_w - n_patch_w + 1, n_patch_h, n_patch_w) + image_src.shape[3:]
+    strides = (n_stride_f, n_stride_h, n_stride_w, n_stride_h, n_stride_w) + image_src.strides[3:]
+    return as_strided(image_src, shape=shape, strides=strides, writeable=False)
+
+def get_patch_locations(nd_frame_size, nd_patch_size, nd_stride):
+    """
+    Patch locations ([start_h, start_w] rows) of a frame, cached per (frame size, patch size, stride).
+    The returned array is shared between callers and therefore read-only.
+    """
+    return _get_patch_locations((int(nd_frame_size[0]), int(nd_frame_size[1])),
+                                (int(nd_patch_size[0]), int(nd_patch_size[1])),
+                                (int(nd_stride[0]), int(nd_stride[1])))
+
+@lru_cache(maxsize=64)
+def _get_patch_locations(nd_frame_size, nd_patch_size, nd_stride):
+    # start positions run over range(0, frame, stride) and are clamped so that the patch stays inside the frame
+    nd_start_h = np.minimum(np.arange(0, nd_frame_size[0], nd_stride[0]), nd_frame_size[0] - nd_patch_size[0])
+    nd_start_w = np.minimum(np.arange(0, nd_frame_size[1], nd_stride[1]), nd_frame_size[1] - nd_patch_size[1])
+
+    nd_locations = np.stack(np.meshgrid(nd_start_h, nd_start_w, indexing='ij'), axis=-1).reshape(-1, 2)
+    nd_locations.setflags(write=False)
+    return nd_locations
 
-    n_stride_h = nd_stride[0]
-    n_stride_w = nd_stride[1]
-
-    tmp_frame = image_src[0].shape
-    n_frame_h = tmp_frame[0]
-    n_frame_w = tmp_frame[1]
-
-    # for i in range(0,n_frame_h,n_stride_h):
-    # np.array(lst_patches[10])[0,:,:]
-    flag_permission_h = flag_permission_w = True
-    i = 0
-    while i < n_frame_h and flag_permission_h:
-        flag_permission_w = True
-        start_h = i
-        end_h = i + nd_patch_size[0]
-        if end_h > n_frame_h:
-            end_h = n_frame_h
-            start_h = n_frame_h - nd_patch_size[0]
-            # break
-        # for j in range(0,n_frame_w,n_stride_w):
-        j = 0
-        while j < n_frame_w and flag_permission_w:
-            start_w = j
-            end_w = j + nd_patch_size[1]
-            if end_w > n_frame_w:
-                end_w = n_frame_w
-                start_w = n_frame_w - nd_patch_size[1]
-                # break
-
-            # print(start_w,end_w,'**',start_h,end_h)
-
-            tmp_slices = np.array(image_src[:, start_h:end_h, start_w:end_w])
-            lst_patches.append(tmp_slices)
-            lst_locations.append([start_h, start_w])
-
-            j += n_stride_w
-            if j > n_frame_w:
-                flag_permission_w = False
-                j = n_frame_w - nd_patch_size[1]
-
-        i += n_stride_h
-        if i > n_frame_h:
-            flag_permission_h = False
-            i = n_frame_h - nd_patch_size[0]
-
-    return np.array(lst_patches), lst_locations
+'''
+ANOMALY MAP
+- AnomalyMapper
+'''
+class AnomalyMapper(object):
+    """
+    Per-pixel map of the patch scores of one frame geometry, and the connected regions where it is anomalous.
+
+    The patch locations form a grid (start rows x start columns, see get_patch_locations), so the patches that
+    cover a pixel are the product of the rows covering its y and the columns covering its x. Both covers are
+    precomputed as 0/1 matrices: the mean map is cover_h . scores . cover_w^T divided by the number of covering
+    patches, the max/min maps reduce over the two covers one after the other. The cost per frame only depends
+    on the geometry.
+    """
+    def __init__(self, nd_frame_size, nd_patch_size, nd_stride):
+        self.nd_frame_size = (int(nd_frame_size[0]), int(nd_frame_size[1]))
+        nd_locations = get_patch_locations(nd_frame_size, nd_patch_size, nd_stride)
+        nd_start_h = np.unique(nd_locations[:, 0], return_index=True)
+        nd_start_w = np.unique(nd_locations[:, 1], return_index=True)
+        self.n_grid_h = len(np.arange(0, self.nd_frame_size[0], nd_stride[0]))
+        self.n_grid_w = len(np.arange(0, self.nd_frame_size[1], nd_stride[1]))
+
+        # border starts are clamped and repeat the same patch, only the first of each is used
+        self.nd_rows = nd_start_h[1] // self.n_grid_w
+        self.nd_cols = nd_start_w[1] % self.n_grid_w
+
+        # cover[y, i] is 1 when the patch row i covers pixel row y (same for the columns)
+        self.nd_cover_h = ((np.arange(self.nd_frame_size[0])[:, np.newaxis] >= nd_start_h[0]) &
+                           (np.arange(self.nd_frame_size[0])[:, np.newaxis] < nd_start_h[0] + nd_patch_size[0]))
+        self.nd_cover_w = ((np.arange(self.nd_frame_size[1])[:, np.newaxis] >= nd_start_w[0]) &
+                           (np.arange(self.nd_frame_size[1])[:, np.newaxis] < nd_start_w[0] + nd_patch_size[1]))
+        self.nd_cover_h_f = self.nd_cover_h.astype(np.float32)
+        self.nd_cover_w_f = self.nd_cover_w.astype(np.float32)
+        nd_count = np.outer(self.nd_cover_h.sum(axis=1), self.nd_cover_w.sum(axis=1)).astype(np.float32)
+        self.nd_inv_count = np.where(nd_count > 0, 1. / np.maximum(nd_count, 1), np.nan).astype(np.float32)
+
+    def score_grid(self, nd_scores):
+        """
+        :param nd_scores: one score per location of get_patch_locations (in that order)
+        :return: (#distinct start rows, #distinct start columns) grid of the scores
+        """
+        nd_grid = np.asarray(nd_scores, dtype=np.float32).reshape(self.n_grid_h, self.n_grid_w)
+        return nd_grid[np.ix_(self.nd_rows, self.nd_cols)]
+
+    def map(self, nd_scores, s_mode='mean'):
+        """
+        :param s_mode: 'mean', 'max' or 'min' of the scores of the patches covering each pixel
+        :return: (frame_h, frame_w) float32 map, NaN where no patch covers the pixel
+        """
+        nd_grid = self.score_grid(nd_scores)
+        if s_mode == 'mean':
+            return self.nd_cover_h_f.dot(nd_grid).dot(self.nd_cover_w_f.T) * self.nd_inv_count
+
+        if s_mode == 'max':
+            fn_reduce, f_empty = np.max, -np.inf
+        elif s_mode == 'min':
+            fn_reduce, f_empty = np.min, np.inf
+        else:
+            raise ValueError("s_mode must be 'mean', 'max' or 'min', not {}".format(s_mode))
+        # reduce over the covering columns, then over the covering rows
+        nd_cols = fn_reduce(np.where(self.nd_cover_w[np.newaxis], nd_grid[:, np.newaxis, :], f_empty), axis=2)
+        nd_map = fn_reduce(np.where(self.nd_cover_h[:, :, np.newaxis], nd_cols[np.newaxis], f_empty), axis=1)
+        nd_map[np.isinf(nd_map)] = np.nan
+        return nd_map.astype(np.float32)
+
+    def regions(self, nd_map, f_threshold=1e-30, b_below=True):
+        """
+        Connected regions of anomalous pixels (map below f_threshold, or above it when b_below is False)
+        :return: list of dicts with the bounding box (start_h, start_w, end_h, end_w), the area in pixels and
+                 the most anomalous map value of the region
+        """
+        from scipy import ndimage
+        nd_mask = nd_map < f_threshold if b_below else nd_map > f_threshold
+        nd_labels, n_regions = ndimage.label(nd_mask)
+        if n_regions == 0:
+            return []
+        nd_index = np.arange(1, n_regions + 1)
+        nd_area = np.bincount(nd_labels.ravel(), minlength=n_regions + 1)[1:]
+        fn_extreme = ndimage.minimum if b_below else ndimage.maximum
+        nd_extreme = fn_extreme(nd_map, nd_labels, nd_index)
+
+        lst_regions = []
+        for slc, n_area, f_extreme in zip(ndimage.find_objects(nd_labels), nd_area, nd_extreme):
+            lst_regions.append({'bbox': (slc[0].start, slc[1].start, slc[0].stop, slc[1].stop),
+                                'area': int(n_area), 'score': float(f_extreme)})
+        return lst_regions
+
+    def __call__(self, nd_scores, s_mode='min', f_threshold=1e-30):
+        """
+        :return: the per-pixel map and its anomalous regions
+        """
+        nd_map = self.map(nd_scores, s_mode)
+        return nd_map, self.regions(nd_map, f_threshold)
 
 def kh_isDirExist(path):
     if not os.path.exists(path):
@@ -194,6 +540,8 @@ def kh_crop(img,nStartX,nEndX,nStartY,nEndY):
     return img[nStartY:nEndY,nStartX:nEndX]
 
 def kh_extractPatches(sImg,nStride=1,ndSliceSize=(10,10),bSaveImages=False):
+    from PIL import Image
+    import scipy.misc
     i = 0
     j = 0
     imgArray = np.zeros([Image.open(sImg[0]).size[1],Image.open(sImg[0]).size[0], 3])
@@ -321,6 +669,8 @@ def kh_extractPatches(sImg,nStride=1,ndSliceSize=(10,10),bSaveImages=False):
 
 
 def kh_extractPatchesOne(sImg,nStride=1,ndSliceSize=(10,10),bSaveImages=False):
+    from PIL import Image
+    import scipy.misc
 
     # read Images
     imgTmp = Image.open(sImg)
@@ -0,0 +1,229 @@
+"""
+In-memory metrics with periodic export, in place of a print and a logging.info per step.
+
+A MetricsRegistry holds counters, gauges and histograms. Updating one is a few python operations under the
+lock of that metric, so an export from another thread never reads half an update; nothing is formatted or
+written until maybe_export() finds that f_export_secs have passed, and then one JSON line is appended to the
+jsonl file and the Prometheus text file is rewritten (node_exporter's textfile collector can scrape it).
+should_print() rate-limits console output the same way.
+
+    registry = MetricsRegistry('log/metrics.jsonl', 'log/metrics.prom')
+    registry.histogram('step_seconds').observe(f_step_time)
+    registry.gauge('g_loss').set(errG)
+    if registry.should_print():
+        print(registry.format_line(['g_loss', 'step_seconds']))
+    registry.maybe_export(step)
+"""
+import json
+import os
+import threading
+import time
+
+import numpy as np
+
+# seconds, for step / wait / latency histograms
+LST_TIME_BUCKETS = [0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1., 2.5, 5., 10.]
+
+
+class Counter(object):
+    """
+    Monotonic total (steps, patches, frames)
+    """
+    s_type = 'counter'
+
+    def __init__(self, s_name, s_help=''):
+        self.s_name = s_name
+        self.s_help = s_help
+        self.value = 0
+        self.lock = threading.Lock()
+
+    def inc(self, value=1):
+        with self.lock:
+            self.value += value
+
+    def snapshot(self):
+        with self.lock:
+            return self.value
+
+
+class Gauge(object):
+    """
+    Last value of a quantity (a loss, a rate)
+    """
+    s_type = 'gauge'
+
+    def __init__(self, s_name, s_help=''):
+        self.s_name = s_name
+        self.s_help = s_help
+        self.value = float('nan')
+        self.lock = threading.Lock()
+
+    def set(self, value):
+        with self.lock:
+            self.value = float(value)
+
+    def snapshot(self):
+        with self.lock:
+            return self.value
+
+
+class Histogram(object):
+    """
+    Distribution over fixed bucket upper bounds, with count, sum, min and max
+    """
+    s_type = 'histogram'
+
+    def __init__(self, s_name, s_help='', lst_buckets=None):
+        self.s_name = s_name
+        self.s_help = s_help
+        self.nd_bounds = np.array(sorted(lst_buckets or LST_TIME_BUCKETS), dtype=np.float64)
+        self.nd_counts = np.zeros(len(self.nd_bounds) + 1, dtype=np.int64)
+        self.n_count = 0
+        self.f_sum = 0.
+        self.f_min = float('inf')
+        self.f_max = float('-inf')
+        self.lock = threading.Lock()
+
+    def observe(self, value):
+        value = float(value)
+        n_bucket = np.searchsorted(self.nd_bounds, value)
+        with self.lock:
+            self.nd_counts[n_bucket] += 1
+            self.n_count += 1
+            self.f_sum += value
+            self.f_min = min(self.f_min, value)
+            self.f_max = max(self.f_max, value)
+
+    def quantile(self, f_q):
+        """
+        Upper bound of the bucket holding the f_q quantile (the max for the overflow bucket)
+        """
+        with self.lock:
+            return self._quantile(f_q)
+
+    def _quantile(self, f_q):
+        if self.n_count == 0:
+            return float('nan')
+        n_bucket = int(np.searchsorted(np.cumsum(self.nd_counts), f_q * self.n_count))
+        return float(self.nd_bounds[n_bucket]) if n_bucket < len(self.nd_bounds) else self.f_max
+
+    def snapshot(self):
+        with self.lock:
+            return {'count': self.n_count, 'sum': self.f_sum,
+                    'mean': self.f_sum / self.n_count if self.n_count else float('nan'),
+                    'min': self.f_min if self.n_count else float('nan'), 'max': self.f_max if self.n_count else float('nan'),
+                    'p50': self._quantile(0.5), 'p90': self._quantile(0.9), 'p99': self._quantile(0.99),
+                    'buckets': dict(zip([str(f) for f in self.nd_bounds] + ['+Inf'], np.cumsum(self.nd_counts).tolist()))}
+
+
+class MetricsRegistry(object):
+    """
+    Named metrics, created on first use, exported every f_export_secs to s_jsonl_path and s_prometheus_path
+    (either may be None) and printable at most every f_print_secs (0 prints every time)
+    """
+    def __init__(self, s_jsonl_path=None, s_prometheus_path=None, f_export_secs=30., f_print_secs=10., s_prefix='alocc_'):
+        self.s_jsonl_path = s_jsonl_path
+        self.s_prometheus_path = s_prometheus_path
+        self.f_export_secs = f_export_secs
+        self.f_print_secs = f_print_secs
+        self.s_prefix = s_prefix
+        self.dic_metrics = {}
+        self.lock = threading.Lock()
+        self.f_last_export = time.time()
+        self.f_last_print = None
+        for s_path in [s_jsonl_path, s_prometheus_path]:
+            if s_path is not None and os.path.dirname(s_path) and not os.path.exists(os.path.dirname(s_path)):
+                os.makedirs(os.path.dirname(s_path))
+
+    def _get(self, cls, s_name, *args):
+        metric = self.dic_metrics.get(s_name)
+        if metric is None:
+            with self.lock:
+                metric = self.dic_metrics.setdefault(s_name, cls(s_name, *args))
+        if not isinstance(metric, cls):
+            raise ValueError('metric {} is a {}, not a {}'.format(s_name, metric.s_type, cls.s_type))
+        return metric
+
+    def counter(self, s_name, s_help=''):
+        return self._get(Counter, s_name, s_help)
+
+    def gauge(self, s_name, s_help=''):
+        return self._get(Gauge, s_name, s_help)
+
+    def histogram(self, s_name, s_help='', lst_buckets=None):
+        return self._get(Histogram, s_name, s_help, lst_buckets)
+
+    def should_print(self):
+        """
+        True at most once every f_print_secs
+        """
+        f_now = time.time()
+        if self.f_last_print is not None and f_now - self.f_last_print < self.f_print_secs:
+            return False
+        self.f_last_print = f_now
+        return True
+
+    def format_line(self, lst_names):
+        """
+        'name: value' of gauges and counters, 'name: mean (p90)' of histograms
+        """
+        lst_parts = []
+        for s_name in lst_names:
+            metric = self.dic_metrics.get(s_name)
+            if metric is None:
+                continue
+            if isinstance(metric, Histogram):
+                dic_snapshot = metric.snapshot()
+                lst_parts.append('{}: {:.4g} (p90 {:.4g})'.format(s_name, dic_snapshot['mean'], dic_snapshot['p90']))
+            else:
+                lst_parts.append('{}: {:.6g}'.format(s_name, metric.snapshot()))
+        return ', '.join(lst_parts)
+
+    def snapshot(self):
+        with self.lock:
+            return {s_name: metric.snapshot() for s_name, metric in self.dic_metrics.items()}
+
+    def maybe_export(self, n_step=None):
+        """
+        Export if f_export_secs passed since the last export
+        :return: True when exported
+        """
+        if time.time() - self.f_last_export < self.f_export_secs:
+            return False
+        self.export(n_step)
+        return True
+
+    def export(self, n_step=None):
+        self.f_last_export = time.time()
+        dic_snapshot = self.snapshot()
+        if self.s_jsonl_path is not None:
+            with open(self.s_jsonl_path, 'a') as f:
+                f.write(json.dumps({'time': self.f_last_export, 'step': n_step, 'metrics': dic_snapshot}) + '\n')
+        if self.s_prometheus_path is not None:
+            # written next to the target and renamed, so a scraper never reads half a file
+            s_tmp_path = self.s_prometheus_path + '.tmp'
+            with open(s_tmp_path, 'w') as f:
+                f.write(self.format_prometheus(dic_snapshot))
+            os.replace(s_tmp_path, self.s_prometheus_path)
+
+    def format_prometheus(self, dic_snapshot=None):
+        if dic_snapshot is None:
+            dic_snapshot = self.snapshot()
+        lst_lines = []
+        for s_name in sorted(dic_snapshot):
+            metric = self.dic_metrics[s_name]
+            s_metric = self.s_prefix + s_name
+            if metric.s_help:
+                lst_lines.append('# HELP {} {}'.format(s_metric, metric.s_help))
+            lst_lines.append('# TYPE {} {}'.format(s_metric, metric.s_type))
+            if isinstance(metric, Histogram):
+                for s_bound, n_count in dic_snapshot[s_name]['buckets'].items():
+                    lst_lines.append('{}_bucket{{le="{}"}} {}'.format(s_metric, s_bound, n_count))
+                lst_lines.append('{}_sum {}'.format(s_metric, repr(dic_snapshot[s_name]['sum'])))
+                lst_lines.append('{}_count {}'.format(s_metric, dic_snapshot[s_name]['count']))
+            else:
+                lst_lines.append('{} {}'.format(s_metric, repr(float(dic_snapshot[s_name]))))
+        return '\n'.join(lst_lines) + '\n'
+
+    def close(self, n_step=None):
+        self.export(n_step)
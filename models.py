@@ -1,11 +1,15 @@
 from __future__ import division
-from tensorflow.examples.tutorials.mnist import input_data
 import re
+import time
 from ops import *
 from utils import *
 from kh_tools import *
+from validation import ValidationSet, Validator
+from profiling import StepProfiler
+from metrics import MetricsRegistry
+from checkpointing import CheckpointManager, read_resume_state, get_random_states, set_random_states, restore_weights, \
+  read_checkpoint_values, load_values
 import logging
-import matplotlib.pyplot as plt
 
 class ALOCC_Model(object):
   def __init__(self, sess,
@@ -15,7 +19,8 @@ class ALOCC_Model(object):
                dataset_name=None, dataset_address=None, input_fname_pattern=None,
                checkpoint_dir=None, log_dir=None, sample_dir=None, r_alpha = 0.2,
                kb_work_on_patch=True, nd_input_frame_size=(240, 360), nd_patch_size=(10, 10), n_stride=1,
-               n_fetch_data=10, n_per_itr_print_results=500):
+               n_fetch_data=10, n_per_itr_print_results=500, s_frame_store_dir=None, b_inference_only=False,
+               f_noise_sigma=0.155, n_noise_seed=None, b_fold_batch_norm=False):
     """
     This is the main class of our Adversarially Learned One-Class Classifier for Novelty Detection
     :param sess: TensorFlow session
@@ -35,6 +40,13 @@ class ALOCC_Model(object):
     :param n_stride: PatchBased data preprocessing stride
     :param n_fetch_data: Fetch size of Data
     :param n_per_itr_print_results: # of printed iteration
+    :param s_frame_store_dir: Directory of the memory-mapped decoded-frame store (see kh_tools.FrameStore), None to decode every frame [None]
+    :param b_inference_only: Only build the scoring outputs (see build_inference_model), without dataset or losses [False]
+    :param f_noise_sigma: Std of the Gaussian noise the graph adds to the inputs to make z [0.155]
+    :param n_noise_seed: Op seed of that noise, None for a random seed [None]
+    :param b_fold_batch_norm: Scoring only: batch-norm uses the moving averages and is folded into the conv/deconv
+                              weights when a checkpoint is restored (see f_check_checkpoint), so the graph has no
+                              batch-norm op and a patch gets the same score in any batch [False]
     """
 
     self.n_per_itr_print_results=n_per_itr_print_results
@@ -46,6 +58,8 @@ class ALOCC_Model(object):
     self.is_training = is_training
 
     self.r_alpha = r_alpha
+    self.noise_sigma = f_noise_sigma
+    self.noise_seed = n_noise_seed
 
     self.batch_size = batch_size
     self.sample_num = sample_num
@@ -78,6 +92,24 @@ class ALOCC_Model(object):
     self.g_bn6 = batch_norm(name='g_bn6')
     self.g_bn7 = batch_norm(name='g_bn7')
 
+    # batch-norm -> the conv/deconv whose output it normalizes, and the output-channel axis of that filter
+    self.lst_batch_norm_folds = [
+      (self.d_bn0, 'discriminator/d_bn0', 'discriminator/d_h0_conv', 3),
+      (self.d_bn1, 'discriminator/d_bn1', 'discriminator/d_h1_conv', 3),
+      (self.d_bn2, 'discriminator/d_bn2', 'discriminator/d_h2_conv', 3),
+      (self.d_bn3, 'discriminator/d_bn3', 'discriminator/d_h3_conv', 3),
+      (self.g_bn0, 'generator/g_bn0', 'generator/g_encoder_h0_conv', 3),
+      (self.g_bn1, 'generator/g_bn1', 'generator/g_encoder_h1_conv', 3),
+      (self.g_bn2, 'generator/g_bn2', 'generator/g_encoder_h2_conv', 3),
+      (self.g_bn3, 'generator/g_bn3', 'generator/g_encoder_h3_conv', 3),
+      (self.g_bn4, 'generator/g_bn4', 'generator/g_decoder_h3_deconv', 2),
+      (self.g_bn5, 'generator/g_bn5', 'generator/g_decoder_h2_deconv', 2),
+      (self.g_bn6, 'generator/g_bn6', 'generator/g_decoder_h1_deconv', 2),
+      (self.g_bn7, 'generator/g_bn7', 'generator/g_decoder_h0_deconv', 2)]
+    self.b_fold_batch_norm = b_fold_batch_norm
+    for bn, _, _, _ in self.lst_batch_norm_folds:
+      bn.folded = b_fold_batch_norm
+
     self.dataset_name = dataset_name
     self.dataset_address= dataset_address
     self.input_fname_pattern = input_fname_pattern
@@ -86,10 +118,17 @@ class ALOCC_Model(object):
 
     self.attention_label = attention_label
 
+    if b_inference_only:
+      self.c_dim = c_dim
+      self.grayscale = (self.c_dim == 1)
+      self.build_inference_model()
+      return
+
     if self.is_training:
       logging.basicConfig(filename='ALOCC_loss.log', level=logging.INFO)
 
     if self.dataset_name == 'mnist':
+      from tensorflow.examples.tutorials.mnist import input_data
       mnist = input_data.read_data_sets(self.dataset_address)
       specific_idx = np.where(mnist.train.labels == self.attention_label)[0]
       self.data = mnist.train.images[specific_idx].reshape(-1, 28, 28, 1)
@@ -103,6 +142,8 @@ class ALOCC_Model(object):
         for sImageDirFiles in glob(os.path.join(s_image_dir_path+'/*')):
           lst_image_paths.append(sImageDirFiles)
       self.dataAddress = lst_image_paths
+      if s_frame_store_dir is not None:
+        set_frame_store(FrameStore(s_frame_store_dir, self.dataAddress))
       lst_forced_fetch_data = [self.dataAddress[x] for x in random.sample(range(0, len(lst_image_paths)), n_fetch_data)]
 
       self.data = lst_forced_fetch_data
@@ -113,13 +154,42 @@ class ALOCC_Model(object):
     self.grayscale = (self.c_dim == 1)
     self.build_model()
 
+  # =========================================================================================================
+  def build_inference_model(self):
+    """
+    Scoring outputs only: D (discriminator on the input patch), G (reconstruction) and D_ (discriminator on G),
+    exposed as inference/D, inference/G and inference/D_. Batch-norm still normalizes with the batch statistics
+    as in training mode, but without the moving-average updates, so the graph can be frozen to constants.
+    With b_fold_batch_norm there is no batch-norm op at all (see f_fold_batch_norm_values).
+    """
+    for bn in [self.d_bn0, self.d_bn1, self.d_bn2, self.d_bn3, self.g_bn0, self.g_bn1, self.g_bn2, self.g_bn3,
+               self.g_bn4, self.g_bn5, self.g_bn6, self.g_bn7]:
+      bn.update_moving_averages = False
+
+    image_dims = [self.input_height, self.input_width, self.c_dim]
+    self.inputs = tf.placeholder(tf.float32, [None] + image_dims, name='real_images')
+    self.z = tf.placeholder(tf.float32, [None] + image_dims, name='z')
+
+    self.G, self.G_ = self.generator(self.z)
+    self.D, self.D_logits = self.discriminator(self.inputs)
+    self.D_, self.D_logits_ = self.discriminator(self.G, reuse=True)
+
+    with tf.name_scope('inference'):
+      self.dic_inference_outputs = {'D': tf.identity(self.D, name='D'),
+                                    'D_': tf.identity(self.D_, name='D_'),
+                                    'G': tf.identity(self.G, name='G')}
+
   # =========================================================================================================
   def build_model(self):
 
     image_dims = [self.input_height, self.input_width, self.c_dim]
 
-    self.inputs = tf.placeholder(tf.float32, [self.batch_size] + image_dims, name='real_images')
-    self.sample_inputs = tf.placeholder(tf.float32, [self.sample_num] + image_dims, name='sample_inputs')
+    # the batch dimension is left open, so the same graph trains at batch_size and scores at any batch size.
+    # Unless a batch is fed, inputs are the next batch of the tf.data pipeline of train (see build_input_pipeline),
+    # so a training step consumes the prefetched batch in its own run
+    self.input_iterator = tf.data.Iterator.from_structure(tf.float32, tf.TensorShape([None] + image_dims))
+    self.inputs = tf.placeholder_with_default(self.input_iterator.get_next(), [None] + image_dims, name='real_images')
+    self.sample_inputs = tf.placeholder(tf.float32, [None] + image_dims, name='sample_inputs')
 
     inputs = self.inputs
     sample_inputs = self.sample_inputs
@@ -130,8 +200,9 @@ class ALOCC_Model(object):
     # self.d__sum = histogram_summary("d_", self.D_)
     # self.G_sum = image_summary("G", self.G)
 
-    # The error function added to the image
-    self.z = tf.placeholder(tf.float32,[self.batch_size] + image_dims, name='z')
+    # The error function added to the image: fresh noise on every run unless a z is fed explicitly
+    self.noisy_inputs = gaussian_noise(inputs, self.noise_sigma, self.noise_seed)
+    self.z = tf.placeholder_with_default(self.noisy_inputs, [None] + image_dims, name='z')
 
     # Generate the Images
     self.G, self.G_ = self.generator(self.z)
@@ -170,13 +241,24 @@ class ALOCC_Model(object):
 
 
 # =========================================================================================================
-  def train(self, config):
+  def build_train_ops(self, learning_rate, b_fused_step=False):
+    """
+    Build the optimizers and gradient summaries used by train
+    :param b_fused_step: make both updates wait for the losses, D outputs and all gradients,
+                         so one sess.run can update D and G and return the metrics of the same forward pass
+    """
+    d_grads = tf.train.AdamOptimizer(learning_rate).compute_gradients(self.d_loss, var_list=self.d_vars)
+    g_grads = tf.train.AdamOptimizer(learning_rate).compute_gradients(self.g_loss, var_list=self.g_vars)
 
-    d_grads = tf.train.AdamOptimizer(config.learning_rate).compute_gradients(self.d_loss, var_list=self.d_vars)
-    g_grads = tf.train.AdamOptimizer(config.learning_rate).compute_gradients(self.g_loss, var_list=self.g_vars)
+    lst_step_dependencies = []
+    if b_fused_step:
+      lst_step_dependencies = [self.d_loss_fake, self.d_loss_real, self.g_loss, self.D, self.D_]
+      lst_step_dependencies += [grad for grad, var in d_grads + g_grads if grad is not None]
 
-    d_optim = tf.train.AdamOptimizer(config.learning_rate).apply_gradients(d_grads)
-    g_optim = tf.train.AdamOptimizer(config.learning_rate).apply_gradients(g_grads)
+    with tf.control_dependencies(lst_step_dependencies):
+      self.d_optim = tf.train.AdamOptimizer(learning_rate).apply_gradients(d_grads)
+      self.g_optim = tf.train.AdamOptimizer(learning_rate).apply_gradients(g_grads)
+    self.fused_optim = tf.group(self.d_optim, self.g_optim) if b_fused_step else None
 
     d_grads_scalar = []
     g_grads_scalar = []
@@ -191,18 +273,125 @@ class ALOCC_Model(object):
     self.d_grads = merge_summary(d_grads_scalar)
     self.g_grads = merge_summary(g_grads_scalar)
 
+    self.g_sum = merge_summary([self.d_loss_fake_sum, self.g_loss_sum])
+    self.d_sum = merge_summary([self.d_loss_real_sum, self.d_loss_sum])
+    self.image_sum = merge_summary([image_summary("inputs", self.inputs, max_outputs=4),
+                                    image_summary("G", self.G, max_outputs=4)])
+
+    # summary ops by kind, see utils.SummaryPolicy
+    self.dic_summaries = {'scalar': [self.d_sum, self.g_sum],
+                          'histogram': [self.d_grads, self.g_grads],
+                          'image': [self.image_sum]}
+
+  # =========================================================================================================
+  def f_train_step_ucsd(self, batch_images, batch_noise_images=None, lst_summary_ops=(), dic_run_kwargs=None):
+    """
+    UCSD training step: G update plus separate runs for the summaries, the D outputs and every loss
+    :param batch_noise_images: z to feed, None to let the graph noise batch_images (one draw for the whole step)
+    :param lst_summary_ops: summary ops to evaluate in this step
+    :param dic_run_kwargs: extra sess.run arguments of the G update (see profiling.StepProfiler.run_kwargs)
+    :return: list of summaries, errD_fake, errD_real, errG, D, D_
+    """
+    feed_dict = {self.inputs: batch_images}
+    if batch_noise_images is None:
+      # the noise is drawn in the first run and fed back, so the update and the logged losses see the same z
+      lst_results = self.sess.run([self.noisy_inputs] + list(lst_summary_ops), feed_dict=feed_dict)
+      feed_dict[self.z], lst_summaries = lst_results[0], lst_results[1:]
+    else:
+      feed_dict[self.z] = batch_noise_images
+      lst_summaries = []
+      if lst_summary_ops:
+        lst_summaries = self.sess.run(list(lst_summary_ops), feed_dict=feed_dict)
+
+    # Update G network
+    _, c, d = self.sess.run([self.g_optim, self.D, self.D_], feed_dict=feed_dict, **(dic_run_kwargs or {}))
+
+    c, d = self.sess.run([self.D, self.D_], feed_dict=feed_dict)
+    errD_fake = self.d_loss_fake.eval(feed_dict)
+    errD_real = self.d_loss_real.eval(feed_dict)
+    errG = self.g_loss.eval(feed_dict)
+    return lst_summaries, errD_fake, errD_real, errG, c, d
+
+  # =========================================================================================================
+  def f_train_step_fused(self, batch_images, batch_noise_images=None, lst_summary_ops=(), dic_run_kwargs=None):
+    """
+    D and G updates, summaries, losses and D outputs from a single sess.run (needs build_train_ops(b_fused_step=True))
+    :param batch_images: batch to feed, None to take the next batch of the input pipeline (see build_input_pipeline)
+    :param batch_noise_images: z to feed, None to let the graph noise batch_images (one draw shared by both updates)
+    :param lst_summary_ops: summary ops to evaluate in this step
+    :param dic_run_kwargs: extra sess.run arguments (see profiling.StepProfiler.run_kwargs)
+    :return: list of summaries, errD_fake, errD_real, errG, D, D_
+    """
+    feed_dict = {}
+    if batch_images is not None:
+      feed_dict[self.inputs] = batch_images
+    if batch_noise_images is not None:
+      feed_dict[self.z] = batch_noise_images
+    lst_results = self.sess.run(
+      [self.fused_optim, self.d_loss_fake, self.d_loss_real, self.g_loss, self.D, self.D_] + list(lst_summary_ops),
+      feed_dict=feed_dict, **(dic_run_kwargs or {}))
+    _, errD_fake, errD_real, errG, c, d = lst_results[:6]
+    return lst_results[6:], errD_fake, errD_real, errG, c, d
+
+# =========================================================================================================
+  def train(self, config):
+    import scipy.misc
+
+    if self.b_fold_batch_norm:
+      raise Exception("[!] A model with folded batch-norm can only score, build it with b_fold_batch_norm=False to train")
+
+    b_fused_step = getattr(config, 'fused_step', False) and config.dataset == 'UCSD'
+    self.build_train_ops(config.learning_rate, b_fused_step)
+    d_optim, g_optim = self.d_optim, self.g_optim
+
     tf.global_variables_initializer().run()
 
     self.saver = tf.train.Saver(max_to_keep=40)
 
-    self.g_sum = merge_summary([self.d_loss_fake_sum, self.g_loss_sum])
-    self.d_sum = merge_summary([self.d_loss_real_sum, self.d_loss_sum])
+    # # load previous checkpoint, and the state saved with it to continue where that run stopped
+    counter = 1
+    dic_resume_state = None
+    could_load, checkpoint_counter = self.load(self.checkpoint_dir)
+    if could_load:
+      counter = checkpoint_counter
+      print(" [*] Load SUCCESS")
+      if getattr(config, 'resume', True):
+        dic_resume_state = read_resume_state(tf.train.latest_checkpoint(os.path.join(self.checkpoint_dir, self.model_dir)))
+    else:
+      print(" [!] Load failed...")
+
+    n_start_epoch, n_start_idx, n_pipeline_batches = 0, 0, 0
+    n_pipeline_seed = np.random.randint(2 ** 31 - 1)
+    if dic_resume_state is not None:
+      n_start_epoch, n_start_idx = dic_resume_state['epoch'], dic_resume_state['batch_index']
+      n_pipeline_batches, n_pipeline_seed = dic_resume_state['pipeline_batches'], dic_resume_state['pipeline_seed']
+      if dic_resume_state.get('n_train_workers', 1) != 1:
+        # written by distributed.train_data_parallel, whose batch index counts steps over worker shards
+        n_start_idx = 0
+      if dic_resume_state['data'] is not None:
+        # the frames sampled by the interrupted run, not a new random sample
+        self.data = dic_resume_state['data']
+      print(" [*] Resuming at epoch %d, batch %d (step %d)" % (n_start_epoch, n_start_idx, counter))
+
+    checkpoints = CheckpointManager(self.sess, os.path.join(config.checkpoint_dir, self.model_dir), n_max_to_keep=40,
+                                    b_background=getattr(config, 'async_checkpoint', True),
+                                    b_weights_only_export=getattr(config, 'export_weights', False))
+
+    def f_resume_state(n_epoch, n_batch_index):
+      # the in-graph noise op restarts its sequence from noise_seed in a new process, numpy and python RNGs continue
+      return {'epoch': n_epoch, 'batch_index': n_batch_index, 'pipeline_batches': n_pipeline_batches,
+              'pipeline_seed': n_pipeline_seed, 'noise_seed': self.noise_seed,
+              'data': self.data if config.dataset == 'UCSD' else None, 'random_states': get_random_states()}
 
     log_dir = os.path.join(self.log_dir, self.model_dir)
     if not os.path.exists(log_dir):
       os.makedirs(log_dir)
 
-    self.writer = SummaryWriter(log_dir, self.sess.graph)
+    self.writer = AsyncSummaryWriter(SummaryWriter(log_dir, self.sess.graph),
+                                     n_max_queue=getattr(config, 'summary_queue_size', 100))
+    summary_policy = SummaryPolicy(n_scalar_every=getattr(config, 'scalar_summary_every', 1),
+                                   n_histogram_every=getattr(config, 'histogram_summary_every', 100),
+                                   n_image_every=getattr(config, 'image_summary_every', 500))
 
     if config.dataset == 'mnist':
       sample = self.data[0:self.sample_num]
@@ -219,112 +408,158 @@ class ALOCC_Model(object):
     sample_inputs = np.array(sample).astype(np.float32)
     scipy.misc.imsave('./{}/train_input_samples.jpg'.format(config.sample_dir), montage(sample_inputs[:,:,:,0]))
 
-    # # load previous checkpoint
-    counter = 1
-    could_load, checkpoint_counter = self.load(self.checkpoint_dir)
-    if could_load:
-      counter = checkpoint_counter
-      print(" [*] Load SUCCESS")
-    else:
-      print(" [!] Load failed...")
-
 
-    # load traning data
-    if config.dataset == 'mnist':
-      sample_w_noise = get_noisy_data(self.data)
-    if config.dataset == 'UCSD':
+    # load traning data, z is noised in the graph (see build_model) so only the clean samples are kept
+    b_input_pipeline = getattr(config, 'input_pipeline', False)
+    if b_input_pipeline:
+      pipeline_init_op, n_pipeline_samples = self.build_input_pipeline(
+        n_parallel_calls=config.n_input_threads, n_shuffle_buffer=config.n_shuffle_buffer,
+        n_seed=n_pipeline_seed, n_skip_batches=n_pipeline_batches)
+      self.sess.run(pipeline_init_op)
+    elif config.dataset == 'UCSD':
       sample_files = self.data
-      sample, _ = read_lst_images(sample_files, self.patch_size, self.patch_step, self.b_work_on_patch)
-      sample = np.array(sample).reshape(-1, self.patch_size[0], self.patch_size[1], 1)
-      sample_w_noise,_ = read_lst_images_w_noise(sample_files, self.patch_size, self.patch_step)
-      sample_w_noise = np.array(sample_w_noise).reshape(-1, self.patch_size[0], self.patch_size[1], 1)
+      n_reader_workers = getattr(config, 'n_reader_workers', 1)
+      # uint8 patches, scaled to float32 per batch by to_float_images
+      sample, _ = read_lst_patches_uint8(sample_files, self.patch_size, self.patch_step, n_workers=n_reader_workers)
+      sample = sample[..., np.newaxis]
 
       print(sample.shape)
-      print(sample_w_noise.shape)
-
-    for epoch in xrange(config.epoch):
+      msg = "Training patches: %.1f MB as uint8 (%.1f MB as float64)" % (sample.nbytes / 2. ** 20, sample.size * 8. / 2. ** 20)
+      print(msg)
+      logging.info(msg)
+    if not b_input_pipeline:
+      nd_train_data = self.data if config.dataset == 'mnist' else sample
+      msg = "In-graph noise (sigma %.3f): no precomputed noisy copy, %.1f MB of float64 not allocated" % (
+        self.noise_sigma, nd_train_data.size * 8. / 2. ** 20)
+      print(msg)
+      logging.info(msg)
+
+    # op-level traces of a window of steps (see profiling.StepProfiler)
+    profiler = None
+    if getattr(config, 'profile_dir', None):
+      profiler = StepProfiler(config.profile_dir, self.sess.graph, config.profile_start_step, config.profile_steps)
+
+    # step metrics are aggregated in memory, exported every metrics_export_secs and printed every print_every_secs
+    s_metrics_dir = getattr(config, 'metrics_dir', None) or log_dir
+    registry = MetricsRegistry(os.path.join(s_metrics_dir, 'metrics.jsonl'), os.path.join(s_metrics_dir, 'metrics.prom'),
+                               getattr(config, 'metrics_export_secs', 30.), getattr(config, 'print_every_secs', 10.))
+    hist_step_time = registry.histogram('step_seconds', 'Wall time of a training step, input included')
+    hist_input_wait = registry.histogram('input_wait_seconds', 'Time a training step waited for its batch')
+    counter_steps = registry.counter('steps_total', 'Training steps')
+    counter_patches = registry.counter('patches_total', 'Training samples consumed')
+    gauge_patches_per_sec = registry.gauge('patches_per_second', 'Training samples per second over the current epoch')
+    lst_printed_metrics = ['d_loss_fake', 'd_loss_real', 'g_loss', 'D_real_prob', 'D_fake_prob',
+                           'step_seconds', 'input_wait_seconds', 'patches_per_second']
+
+    # validation frames are decoded and patched once, then scored after every epoch
+    validator = None
+    s_validation_frames = getattr(config, 'validation_frames', '')
+    if config.dataset == 'UCSD' and s_validation_frames:
+      n_validation_stride = getattr(config, 'validation_stride', 10)
+      self.validation_set = ValidationSet(s_validation_frames.split(','), self.patch_size,
+                                          (n_validation_stride, n_validation_stride), self.noise_sigma)
+      validator = Validator(self, self.validation_set, self.batch_size,
+                            b_background=getattr(config, 'async_validation', False),
+                            fn_callback=self.f_report_validation)
+      print(' [*] Validation set: {} patches of {} frames'.format(len(self.validation_set), len(self.validation_set.lst_frame_paths)))
+
+    if dic_resume_state is not None:
+      set_random_states(dic_resume_state['random_states'])
+    n_checkpoint_every = getattr(config, 'checkpoint_every_steps', 0)
+
+    for epoch in xrange(n_start_epoch, config.epoch):
       print('Epoch ({}/{})-------------------------------------------------'.format(epoch,config.epoch))
-      if config.dataset == 'mnist':
+      if b_input_pipeline:
+        batch_idxs = min(n_pipeline_samples, config.train_size) // config.batch_size
+      elif config.dataset == 'mnist':
         batch_idxs = min(len(self.data), config.train_size) // config.batch_size
       elif config.dataset == 'UCSD':
         batch_idxs = min(len(sample), config.train_size) // config.batch_size
-
-      # for detecting valuable epoch that we must stop training step
-      # sample_input_for_test_each_train_step.npy
-      sample_test = np.load('SIFTETS.npy').reshape([504,45,45,1])[0:64]
-
-      for idx in xrange(0, batch_idxs):
-        if config.dataset == 'mnist':
-          batch = self.data[idx * config.batch_size:(idx + 1) * config.batch_size]
-          batch_noise = sample_w_noise[idx * config.batch_size:(idx + 1) * config.batch_size]
+      f_input_wait_time = 0.
+      f_epoch_start_time = time.time()
+      n_epoch_patches = 0
+
+      for idx in xrange(n_start_idx if epoch == n_start_epoch else 0, batch_idxs):
+        f_input_start_time = time.time()
+        batch_images = None
+        if b_input_pipeline:
+          n_pipeline_batches += 1
+          # the fused step takes the prefetched batch in its own run (a wait for it counts in step_seconds only),
+          # the other steps run the graph several times on the same batch, so it is fetched once and fed back
+          if not b_fused_step:
+            batch_images = self.sess.run(self.inputs)
+        elif config.dataset == 'mnist':
+          batch_images = to_float_images(self.data[idx * config.batch_size:(idx + 1) * config.batch_size])
         elif config.dataset == 'UCSD':
-          batch = sample[idx * config.batch_size:(idx + 1) * config.batch_size]
-          batch_noise = sample_w_noise[idx * config.batch_size:(idx + 1) * config.batch_size]
-
-        batch_images = np.array(batch).astype(np.float32)
-        batch_noise_images = np.array(batch_noise).astype(np.float32)
+          batch_images = to_float_images(sample[idx * config.batch_size:(idx + 1) * config.batch_size])
+        n_batch_samples = self.batch_size if batch_images is None else len(batch_images)
+        f_batch_wait_time = time.time() - f_input_start_time
+        f_input_wait_time += f_batch_wait_time
 
         batch_z = np.random.uniform(0, 1, [config.batch_size, self.z_dim]).astype(np.float32)
 
+        lst_summary_ops = summary_policy.due_summaries(counter, self.dic_summaries)
         if config.dataset == 'mnist':
+          lst_d_summary_ops = [op for op in lst_summary_ops if op not in (self.g_sum, self.g_grads)]
+          lst_g_summary_ops = [op for op in lst_summary_ops if op in (self.g_sum, self.g_grads)]
+
           # Update D network
-          _, summary_str,grads = self.sess.run([d_optim, self.d_sum,self.d_grads],
-                                         feed_dict={self.inputs: batch_images, self.z: batch_noise_images})
-          self.writer.add_summary(summary_str, counter)
-          self.writer.add_summary(grads, counter)
+          dic_run_kwargs = profiler.run_kwargs(counter) if profiler is not None else {}
+          lst_summaries = self.sess.run([d_optim] + lst_d_summary_ops,
+                                         feed_dict={self.inputs: batch_images}, **dic_run_kwargs)[1:]
+          if profiler is not None:
+            profiler.record(counter, dic_run_kwargs, 'train_d')
 
           # Update G network
-          _, summary_str,grads = self.sess.run([g_optim, self.g_sum,self.g_grads],
-                                         feed_dict={self.z: batch_noise_images})
-          self.writer.add_summary(summary_str, counter)
-          self.writer.add_summary(grads, counter)
+          dic_run_kwargs = profiler.run_kwargs(counter) if profiler is not None else {}
+          lst_summaries += self.sess.run([g_optim] + lst_g_summary_ops,
+                                         feed_dict={self.inputs: batch_images}, **dic_run_kwargs)[1:]
+          if profiler is not None:
+            profiler.record(counter, dic_run_kwargs, 'train_g')
 
           # Run g_optim twice to make sure that d_loss does not go to zero (different from paper)
-          _, summary_str,grads = self.sess.run([g_optim, self.g_sum, self.g_grads],
-                                         feed_dict={self.z: batch_noise_images})
-          self.writer.add_summary(summary_str, counter)
-          self.writer.add_summary(grads, counter)
+          _ = self.sess.run(g_optim, feed_dict={self.inputs: batch_images})
+          for summary_str in lst_summaries:
+            self.writer.add_summary(summary_str, counter)
 
 
-          errD_fake = self.d_loss_fake.eval({self.z: batch_noise_images})
+          errD_fake = self.d_loss_fake.eval({self.inputs: batch_images})
           errD_real = self.d_loss_real.eval({self.inputs: batch_images})
-          errG = self.g_loss.eval({self.z: batch_noise_images})
+          errG = self.g_loss.eval({self.inputs: batch_images})
         else:
-          # update discriminator
-          # if idx%2==0:
-          #     _ = self.sess.run([d_optim],
-          #                                  feed_dict={self.inputs: batch_images, self.z: batch_noise_images})
-          summary_str,grads = self.sess.run([self.d_sum,self.d_grads],
-                                         feed_dict={self.inputs: batch_images, self.z: batch_noise_images})
-          self.writer.add_summary(summary_str, counter)
-          self.writer.add_summary(grads, counter)
-          self.writer.flush()
-          # a,b = self.sess.run([self.D,self.D_],
-          #                                feed_dict={self.inputs: batch_images, self.z: batch_noise_images})
-          # Update G network
-          # _, summary_str,grads,c,d = self.sess.run([g_optim, self.g_sum,self.g_grads,self.D,self.D_],
-          #                                feed_dict={self.inputs: batch_images, self.z: batch_noise_images})
-          _, summary_str,grads,c,d = self.sess.run([g_optim, self.g_sum,self.g_grads,self.D,self.D_],
-                                         feed_dict={self.inputs: batch_images, self.z: batch_noise_images})
-          # _, summary_str,grads,c,d = self.sess.run([g_optim, self.g_sum,self.g_grads,self.D,self.D_],
-          #                                feed_dict={self.inputs: batch_images, self.z: batch_noise_images})
-          self.writer.add_summary(summary_str, counter)
-          self.writer.add_summary(grads, counter)
-          self.writer.flush()
-          c,d = self.sess.run([self.D,self.D_],
-                                         feed_dict={self.inputs: batch_images, self.z: batch_noise_images})
-          errD_fake = self.d_loss_fake.eval({ self.inputs: batch_images, self.z: batch_noise_images })
-          errD_real = self.d_loss_real.eval({ self.inputs: batch_images, self.z: batch_noise_images })
-          errG = self.g_loss.eval({self.inputs: batch_images, self.z: batch_noise_images})
+          dic_run_kwargs = profiler.run_kwargs(counter) if profiler is not None else {}
+          if b_fused_step:
+            lst_summaries, errD_fake, errD_real, errG, c, d = self.f_train_step_fused(batch_images, None, lst_summary_ops,
+                                                                                      dic_run_kwargs)
+          else:
+            lst_summaries, errD_fake, errD_real, errG, c, d = self.f_train_step_ucsd(batch_images, None, lst_summary_ops,
+                                                                                     dic_run_kwargs)
+          if profiler is not None:
+            profiler.record(counter, dic_run_kwargs, 'train')
+          for summary_str in lst_summaries:
+            self.writer.add_summary(summary_str, counter)
+
+        hist_step_time.observe(time.time() - f_input_start_time)
+        hist_input_wait.observe(f_batch_wait_time)
+        counter_steps.inc()
+        counter_patches.inc(n_batch_samples)
+        n_epoch_patches += n_batch_samples
+        gauge_patches_per_sec.set(n_epoch_patches / max(time.time() - f_epoch_start_time, 1e-12))
+        registry.gauge('d_loss_fake').set(errD_fake)
+        registry.gauge('d_loss_real').set(errD_real)
+        registry.gauge('g_loss').set(errG)
+        if config.dataset == 'UCSD':
+          registry.gauge('D_real_prob').set(np.mean(c))
+          registry.gauge('D_fake_prob').set(np.mean(d))
 
         counter += 1
-        # print(self.sess.run([self.D,self.D_],feed_dict={self.inputs: batch_images, self.z: batch_noise_images}))
-        msg = "Epoch:[%2d][%4d/%4d]--> Fake_d_loss: %.8f, Real_d_loss: %.8f, g_loss: %.8f" % (epoch, idx, batch_idxs, errD_fake, errD_real, errG)
-        print(msg)
-        logging.info(msg)
-        msg = "D_real_prob: %.8f, D_fake_loss: %.8f, G_real_prob: %.8f, G_fake_loss: %.8f" % (np.mean(a),np.mean(b),np.mean(c),np.mean(d))
-        print(msg)
-        logging.info(msg)
+        if registry.should_print():
+          msg = "Epoch:[%2d][%4d/%4d]--> %s" % (epoch, idx, batch_idxs, registry.format_line(lst_printed_metrics))
+          print(msg)
+          logging.info(msg)
+        registry.maybe_export(counter)
+        if n_checkpoint_every and np.mod(counter, n_checkpoint_every) == 0 and idx + 1 < batch_idxs:
+          checkpoints.save(counter, f_resume_state(epoch, idx + 1))
 
         if np.mod(counter, self.n_per_itr_print_results) == 0:
           if config.dataset == 'mnist':
@@ -345,8 +580,8 @@ class ALOCC_Model(object):
           # ====================================================================================================
           else:
             #try:
-              samples, d_loss, g_loss = self.sess.run(
-                [self.sampler, self.d_loss, self.g_loss],
+              samples, d_loss, g_loss, a = self.sess.run(
+                [self.sampler, self.d_loss, self.g_loss, self.D],
                 feed_dict={
                     self.z: sample_inputs,
                     self.inputs: sample_inputs,
@@ -374,78 +609,152 @@ class ALOCC_Model(object):
               print(msg)
               logging.info(msg)
 
-      test_img = read_lst_images_w_noise2(["./dataset/UCSD_Anomaly_Dataset.v1p2/UCSDped2/Test/Test004/068.tif"], (45,45), (10,10))
-      test_img_orig = read_lst_images_without_noise2(["./dataset/UCSD_Anomaly_Dataset.v1p2/UCSDped2/Test/Test004/068.tif"], (45,45), (10,10))
-
-      test_patch,test_location = get_image_patches(test_img,(45,45), (10,10))
-      test_patch_orig,test_location_orig = get_image_patches(test_img_orig,(45,45), (10,10))
-
-      frame_test_patches = np.expand_dims(np.squeeze(test_patch),axis=-1)
-      frame_test_patches_orig = np.expand_dims(np.squeeze(test_patch_orig),axis=-1)
-
-      test_batch_idxs = len(frame_test_patches) // self.batch_size
-      print(len(frame_test_patches))
-      print('start new process ...')
-      lst_generated_img=[]
-      lst_discriminator_v=[]
-      for i in xrange(0, test_batch_idxs):
-          batch_data = frame_test_patches[i * self.batch_size:(i + 1) * self.batch_size]
-
-          results_g = self.sess.run(self.G, feed_dict={self.z: batch_data})
-          results_d = self.sess.run(self.D_, feed_dict={self.z: batch_data})
-        #results = self.sess.run(self.sampler, feed_dict={self.z: batch_data})
-        # to log some images with d values
-        #for idx,image in enumerate(results_g):
-        #  scipy.misc.imsave('samples/{}_{}.jpg'.format(idx,results_d[idx][0]),batch_data[idx,:,:,0])
-
-          lst_discriminator_v.extend(results_d)
-          lst_generated_img.extend(results_g)
-          print('finish pp ... {}/{}'.format(i,test_batch_idxs))
-    #f = plt.figure()
-    #plt.plot(np.array(lst_discriminator_v))
-    #f.savefig('samples/d_values.jpg')
-      print(np.squeeze(np.array(lst_discriminator_v)))
-      start = (test_batch_idxs-1)*self.batch_size
-      end = (test_batch_idxs)*self.batch_size
-      errD_fake = self.d_loss_fake.eval({ self.inputs: frame_test_patches_orig[start:end], self.z: frame_test_patches[start:end] })
-      errD_real = self.d_loss_real.eval({ self.inputs: frame_test_patches_orig[start:end], self.z: frame_test_patches[start:end] })
-      errG = self.g_loss.eval({self.inputs: frame_test_patches_orig[start:end], self.z: frame_test_patches[start:end]})
-      msg = "Fake_d_loss: %.8f, Real_d_loss: %.8f, g_loss: %.8f" % (errD_fake, errD_real, errG)
+      f_epoch_time = time.time() - f_epoch_start_time
+      msg = "Epoch:[%2d] input stall: %.2fs of %.2fs (%.1f%%)" % (
+        epoch, f_input_wait_time, f_epoch_time, 100. * f_input_wait_time / max(f_epoch_time, 1e-12))
       print(msg)
+      logging.info(msg)
+      registry.gauge('input_stall_percent', 'Share of the last epoch spent waiting for input').set(
+        100. * f_input_wait_time / max(f_epoch_time, 1e-12))
+
+      checkpoints.save(counter, f_resume_state(epoch + 1, 0))
+      if validator is not None:
+        validator.submit(epoch, counter)
+      self.writer.flush()
+
+    if validator is not None:
+      validator.close()
+    if profiler is not None:
+      profiler.write_summary()
+    registry.close(counter)
+    checkpoints.close()
+    self.writer.close()
+
+  # =========================================================================================================
+  def f_report_validation(self, dic_result):
+    '''
+    Log a validation pass of validation.Validator and export its generated and input patches
+    (called from the validation thread in the background mode)
+    '''
+    import scipy.misc
+    n_epoch = dic_result['epoch']
+    msg = "Validation epoch:[%2d]--> Fake_d_loss: %.8f, Real_d_loss: %.8f, g_loss: %.8f, D_fake_prob: %.8f (%.2fs)" % (
+      n_epoch, dic_result['d_loss_fake'], dic_result['d_loss_real'], dic_result['g_loss'],
+      np.mean(dic_result['D_']), dic_result['sec'])
+    print(msg)
+    logging.info(msg)
+    self.writer.add_summary(tf.Summary(value=[tf.Summary.Value(tag='validation/' + s_key, simple_value=float(dic_result[s_key]))
+                                              for s_key in ['d_loss_fake', 'd_loss_real', 'g_loss']]), dic_result['step'])
+
+    scipy.misc.imsave(os.path.join(self.sample_dir, 'ALOCC_generated'+str(n_epoch)+'.jpg'), montage(dic_result['G'][:,:,:,0]))
+    scipy.misc.imsave(os.path.join(self.sample_dir, 'ALOCC_input'+str(n_epoch)+'.jpg'), montage(self.validation_set.noisy_patches[:,:,:,0]))
+
+  # =========================================================================================================
+  def build_input_pipeline(self, n_parallel_calls=4, n_shuffle_buffer=10000, n_prefetch=4, n_seed=None, n_skip_batches=0):
+    """
+    tf.data pipeline that yields clean training batches, the noisy z is drawn in the graph (see build_model).
+    For UCSD every frame of self.data is decoded and patched in parallel py_func calls, the patches are
+    shuffled as uint8 and scaled to float32 per batch.
+    With n_seed the batch sequence is the same on every run, and n_skip_batches drops its first batches
+    (decoding them again) so that a resumed run continues that sequence.
+    :return: the op that points self.inputs at the pipeline (run it before training) and the number of samples
+             in one epoch
+    """
+    image_dims = [self.input_height, self.input_width, self.c_dim]
+
+    if self.dataset_name == 'UCSD':
+      nd_patch_size = self.patch_size
+      nd_patch_step = self.patch_step
+
+      # uint8 patches keep the shuffle buffer small, batches are scaled as to_float_images does
+      def load_patches(s_image_path):
+        tmp_img = read_image_uint8(s_image_path.decode())
+        tmp_slices, _ = get_image_patches([tmp_img], nd_patch_size, nd_patch_step)
+        return tmp_slices[:, 0][..., np.newaxis]
+
+      def load_patches_op(s_image_path):
+        clean = tf.py_func(load_patches, [s_image_path], tf.uint8, stateful=True)
+        clean.set_shape([None] + image_dims)
+        return clean
 
-      scipy.misc.imsave('./'+self.sample_dir+'/ALOCC_generated'+str(epoch)+'.jpg', montage(np.array(lst_generated_img)[:,:,:,0]))
-      scipy.misc.imsave('./'+self.sample_dir+'/ALOCC_input'+str(epoch)+'.jpg', montage(np.array(frame_test_patches)[:,:,:,0]))
-      self.save(config.checkpoint_dir, epoch)
+      n_patches_per_frame = len(get_patch_locations(read_image(self.data[0]).shape, nd_patch_size, nd_patch_step))
+      n_samples = len(self.data) * n_patches_per_frame
+
+      dataset = tf.data.Dataset.from_tensor_slices(np.array(self.data))
+      dataset = dataset.shuffle(len(self.data), seed=n_seed).repeat()
+      dataset = dataset.map(load_patches_op, num_parallel_calls=n_parallel_calls)
+      dataset = dataset.flat_map(tf.data.Dataset.from_tensor_slices)
+    else:
+      n_samples = len(self.data)
+
+      dataset = tf.data.Dataset.from_tensor_slices(self.data.astype(np.float32))
+      dataset = dataset.repeat()
+
+    dataset = dataset.shuffle(n_shuffle_buffer, seed=n_seed)
+    dataset = dataset.batch(self.batch_size, drop_remainder=True)
+    if self.dataset_name == 'UCSD':
+      dataset = dataset.map(lambda batch: tf.cast(batch, tf.float32) / 255.)
+    if n_skip_batches:
+      dataset = dataset.skip(n_skip_batches)
+    dataset = dataset.prefetch(n_prefetch)
+
+    return self.input_iterator.make_initializer(dataset), n_samples
 
   # =========================================================================================================
-  def discriminator(self, image, reuse=False):
+  def discriminator(self, image, reuse=False, train=True):
 
     with tf.variable_scope("discriminator") as scope:
 
       if reuse:
         scope.reuse_variables()
 
-      # df_dim = 16 (data frame dimension)
-      h0 = lrelu( self.d_bn0(conv2d(image, self.df_dim*4, name='d_h0_conv')) )
-      assert( h0.get_shape()[-1] == 64 )
+      h3 = self.discriminator_features(image, train)
 
-      h1 = lrelu( self.d_bn1(conv2d(h0, self.df_dim*8, name='d_h1_conv')) )
-      assert( h1.get_shape()[-1] == 128 )
+      h4 = linear(tf.reshape(h3, [-1, int(np.prod(h3.get_shape().as_list()[1:]))]), 1, 'd_h3_lin')
 
-      h2 = lrelu( self.d_bn2(conv2d(h1, self.df_dim*16, name='d_h2_conv')) )
-      assert( h2.get_shape()[-1] == 256 )
+      h5 = tf.nn.sigmoid(h4,name='d_output')
 
-      h3 = lrelu( self.d_bn3(conv2d(h2, self.df_dim*32, name='d_h3_conv')) )
-      assert( h3.get_shape()[-1] == 512 )
+      return h5, h4
 
-      h4 = linear(tf.reshape(h3, [self.batch_size, -1]), 1, 'd_h3_lin')
+  # =========================================================================================================
+  def discriminator_features(self, image, train=True):
+    ''' Convolutional part of the discriminator, to be called inside the "discriminator" variable scope '''
 
-      h5 = tf.nn.sigmoid(h4,name='d_output')
+    # df_dim = 16 (data frame dimension)
+    h0 = lrelu( self.d_bn0(conv2d(image, self.df_dim*4, name='d_h0_conv'), train=train) )
+    assert( h0.get_shape()[-1] == 64 )
 
-      return h5, h4
+    h1 = lrelu( self.d_bn1(conv2d(h0, self.df_dim*8, name='d_h1_conv'), train=train) )
+    assert( h1.get_shape()[-1] == 128 )
+
+    h2 = lrelu( self.d_bn2(conv2d(h1, self.df_dim*16, name='d_h2_conv'), train=train) )
+    assert( h2.get_shape()[-1] == 256 )
+
+    h3 = lrelu( self.d_bn3(conv2d(h2, self.df_dim*32, name='d_h3_conv'), train=train) )
+    assert( h3.get_shape()[-1] == 512 )
+
+    return h3
+
+  # =========================================================================================================
+  def discriminator_map(self, image, train=False):
+    '''
+    Fully-convolutional discriminator: the d_h3_lin layer applied as a convolution over the feature map of a
+    whole frame, so that logits[:, i, j] is the logit of the patch whose top-left corner is (i, j)
+    '''
+    with tf.variable_scope("discriminator", reuse=True):
+      h3 = self.discriminator_features(image, train)
+
+      # four VALID 5x5 convolutions: a patch gives a (patch_h - 16) x (patch_w - 16) feature map
+      k_h, k_w = self.input_height - 16, self.input_width - 16
+      with tf.variable_scope('d_h3_lin'):
+        matrix = tf.get_variable('Matrix')
+        bias = tf.get_variable('bias')
+      kernel = tf.reshape(matrix, [k_h, k_w, h3.get_shape().as_list()[-1], 1])
+
+      return tf.nn.bias_add(tf.nn.conv2d(h3, kernel, strides=[1, 1, 1, 1], padding='VALID'), bias)
 
   # =========================================================================================================
-  def generator(self, z,reuse=None):
+  def generator(self, z,reuse=None, train=True):
 
     ''' Convolution Auto-Encoder Decoder '''
 
@@ -453,34 +762,34 @@ class ALOCC_Model(object):
 
       # Encoder-Architecture
       # df_dim = 16 (data frame dimension)
-      encoder_0 = lrelu(self.g_bn0(conv2d(z, self.gf_dim * 4, name='g_encoder_h0_conv')))
+      encoder_0 = lrelu(self.g_bn0(conv2d(z, self.gf_dim * 4, name='g_encoder_h0_conv'), train=train))
       assert(encoder_0.get_shape()[-1] == 64)
 
-      encoder_1 = lrelu(self.g_bn1(conv2d(encoder_0, self.gf_dim * 8, name='g_encoder_h1_conv')))
+      encoder_1 = lrelu(self.g_bn1(conv2d(encoder_0, self.gf_dim * 8, name='g_encoder_h1_conv'), train=train))
       assert(encoder_1.get_shape()[-1] == 128)
 
-      encoder_2 = lrelu(self.g_bn2(conv2d(encoder_1, self.gf_dim * 16, name='g_encoder_h2_conv')))
+      encoder_2 = lrelu(self.g_bn2(conv2d(encoder_1, self.gf_dim * 16, name='g_encoder_h2_conv'), train=train))
       assert(encoder_2.get_shape()[-1] == 256)
 
       # Middle Portion
-      encoder_3 = lrelu(self.g_bn3(conv2d(encoder_2, self.gf_dim * 32, name='g_encoder_h3_conv',padding = 'SAME')))
+      encoder_3 = lrelu(self.g_bn3(conv2d(encoder_2, self.gf_dim * 32, name='g_encoder_h3_conv',padding = 'SAME'), train=train))
       assert(encoder_3.get_shape()[-1] == 512)
 
       print(encoder_3)
       # Decoder-Architecture
-      decoder_3 = lrelu(self.g_bn4(deconv2d( encoder_3, output_shape = encoder_2.get_shape(), name = 'g_decoder_h3_deconv',padding='SAME')))
+      decoder_3 = lrelu(self.g_bn4(deconv2d( encoder_3, output_shape = encoder_2.get_shape(), name = 'g_decoder_h3_deconv',padding='SAME'), train=train))
       assert(decoder_3.get_shape()[-1] == 256)
       print(decoder_3)
 
-      decoder_2 = lrelu(self.g_bn5(deconv2d( decoder_3, output_shape = encoder_1.get_shape(), name = 'g_decoder_h2_deconv')))
+      decoder_2 = lrelu(self.g_bn5(deconv2d( decoder_3, output_shape = encoder_1.get_shape(), name = 'g_decoder_h2_deconv'), train=train))
       assert(decoder_2.get_shape()[-1] == 128)
       print(decoder_2)
 
-      decoder_1 = lrelu(self.g_bn6(deconv2d( decoder_2, output_shape = encoder_0.get_shape(), name = 'g_decoder_h1_deconv')))
+      decoder_1 = lrelu(self.g_bn6(deconv2d( decoder_2, output_shape = encoder_0.get_shape(), name = 'g_decoder_h1_deconv'), train=train))
       assert(decoder_1.get_shape()[-1] == 64)
       print(decoder_1)
 
-      decoder_0 = self.g_bn7(deconv2d( decoder_1, output_shape = z.get_shape(), name = 'g_decoder_h0_deconv'))
+      decoder_0 = self.g_bn7(deconv2d( decoder_1, output_shape = z.get_shape(), name = 'g_decoder_h0_deconv'), train=train)
       assert(decoder_0.get_shape()[-1] == 1)
       print(decoder_0)
 
@@ -524,18 +833,6 @@ class ALOCC_Model(object):
         self.dataset_name, self.batch_size,
         self.output_height, self.output_width)
 
-  # =========================================================================================================
-  def save(self, checkpoint_dir, step):
-    model_name = "ALOCC_Model.model"
-    checkpoint_dir = os.path.join(checkpoint_dir, self.model_dir)
-
-    if not os.path.exists(checkpoint_dir):
-      os.makedirs(checkpoint_dir)
-
-    self.saver.save(self.sess,
-            os.path.join(checkpoint_dir, model_name),
-            global_step=step)
-
   # =========================================================================================================
   def load(self, checkpoint_dir):
     import re
@@ -555,9 +852,30 @@ class ALOCC_Model(object):
 
   # =========================================================================================================
 
-  def f_check_checkpoint(self):
+  def f_check_checkpoint(self, s_checkpoint_path=None):
+      """
+      Restore the model from s_checkpoint_path, by default the latest checkpoint in checkpoint_dir
+      (or in checkpoint_dir/model_dir). A path ending with .npz is a weights-only export.
+      With b_fold_batch_norm, the batch-norm parameters of the checkpoint are folded into the conv/deconv weights.
+      """
+      if s_checkpoint_path is None:
+        s_checkpoint_path = tf.train.latest_checkpoint(self.checkpoint_dir) or \
+                            tf.train.latest_checkpoint(os.path.join(self.checkpoint_dir, self.model_dir))
+        if s_checkpoint_path is None:
+          raise Exception("[!] No checkpoint found in {}".format(self.checkpoint_dir))
       self.saver = tf.train.Saver()
-      self.saver.restore(self.sess, "./checkpoint_3/UCSD_128_45_45/ALOCC_Model.model-34")
+      if self.b_fold_batch_norm:
+        lst_missing = load_values(self.sess, self.f_fold_batch_norm_values(read_checkpoint_values(s_checkpoint_path)))
+        if lst_missing:
+          raise Exception("[!] {} has no value for {}".format(s_checkpoint_path, lst_missing))
+      elif s_checkpoint_path.endswith('.npz'):
+        # weights-only export of checkpointing.CheckpointManager
+        lst_missing = restore_weights(self.sess, s_checkpoint_path)
+        if lst_missing:
+          raise Exception("[!] {} has no value for {}".format(s_checkpoint_path, lst_missing))
+      else:
+        self.saver.restore(self.sess, s_checkpoint_path)
+      print(' [*] Restored {}'.format(s_checkpoint_path))
 
     # try:
     #   tf.global_variables_initializer().run()
@@ -588,33 +906,104 @@ class ALOCC_Model(object):
     #   return -1
 
   # =========================================================================================================
-  def f_test_frozen_model(self,lst_image_slices=[]):
-    lst_generated_img= []
-    lst_discriminator_v = []
+  def f_fold_batch_norm_values(self, dic_values):
+    '''
+    :param dic_values: variable name -> value of a model with batch-norm (see checkpointing.read_checkpoint_values)
+    :return: the same values with every batch-norm folded into its conv/deconv weights and biases (see numpy_engine.fold_batch_norm)
+    '''
+    dic_folded = dict(dic_values)
+    for bn, s_bn_scope, s_layer_scope, n_output_axis in self.lst_batch_norm_folds:
+      lst_bn_values = [dic_folded.pop('{}/{}'.format(s_bn_scope, s_name))
+                       for s_name in ['gamma', 'beta', 'moving_mean', 'moving_variance']]
+      dic_folded[s_layer_scope + '/w'], dic_folded[s_layer_scope + '/biases'] = fold_batch_norm(
+        dic_values[s_layer_scope + '/w'], dic_values[s_layer_scope + '/biases'], *lst_bn_values,
+        epsilon=bn.epsilon, n_output_axis=n_output_axis)
+    return dic_folded
+
+  # =========================================================================================================
+  def f_score_patches(self, nd_patches, lst_outputs=('D',), profiler=None):
+    """
+    Scoring engine: run any number of patches through the model in batches of batch_size,
+    one sess.run per batch for all requested outputs (see utils.score_in_batches).
+    :param nd_patches: (N, h, w) or (N, h, w, c) patches
+    :param lst_outputs: any of 'D' (discriminator on the patch), 'D_' (discriminator on the reconstruction)
+                        and 'G' (reconstruction of the patch)
+    :param profiler: profiling.StepProfiler that traces the batches of its window
+    :return: dict output name -> numpy array with N rows, aligned with nd_patches
+    """
+    dic_output_tensors = {'D': (self.D, self.inputs), 'D_': (self.D_, self.z), 'G': (self.G, self.z)}
+    return score_in_batches(self.sess, dic_output_tensors, nd_patches, lst_outputs, self.batch_size, profiler)
+
+  # =========================================================================================================
+  def build_frame_model(self, nd_frame_size):
+    """
+    Whole-frame scoring: the convolutional parts of generator and discriminator run once over a full frame and
+    the per-patch scores are gathered at the patch locations, instead of cutting hundreds of overlapping patches.
+    Batch statistics would normalize a frame and its patches differently, so the model must be built with
+    b_fold_batch_norm: the frame graph and the patch path (f_score_patches) then both use the moving averages.
+    D only sees VALID convolutions, so the frame scores equal the patch scores up to float error; G pads at
+    the patch border in the patch path, so G and D_ only approximately match.
+    :param nd_frame_size: (height, width) of the frames, e.g. the (140, 360) UCSD crop
+    """
+    if not self.b_fold_batch_norm:
+      raise Exception("[!] Whole-frame scoring needs batch-norm with the moving averages, build the model with "
+                      "b_fold_batch_norm=True (--fold_batch_norm) so that the patch path uses them too")
+    self.nd_frame_size = tuple(nd_frame_size)
+    frame_dims = [nd_frame_size[0], nd_frame_size[1], self.c_dim]
+    self.frame_inputs = tf.placeholder(tf.float32, [1] + frame_dims, name='frame_inputs')
+    self.frame_locations = tf.placeholder(tf.int32, [None, 2], name='frame_locations')
+
+    self.frame_G, _ = self.generator(self.frame_inputs, reuse=True, train=False)
+    frame_logits = self.discriminator_map(self.frame_inputs)
+    frame_logits_ = self.discriminator_map(self.frame_G)
+
+    self.frame_D = tf.nn.sigmoid(tf.gather_nd(frame_logits[0], self.frame_locations))
+    self.frame_D_ = tf.nn.sigmoid(tf.gather_nd(frame_logits_[0], self.frame_locations))
+
+  # =========================================================================================================
+  def f_score_frame(self, nd_frame, lst_outputs=('D',)):
+    """
+    Score every patch location of one frame with a single run of the whole-frame graph (see build_frame_model)
+    :param nd_frame: (h, w) or (h, w, c) frame
+    :param lst_outputs: any of 'D', 'D_' (one row per location) and 'G' (the reconstructed frame)
+    :return: dict output name -> numpy array, and the (#locations, 2) patch locations the rows are aligned with
+    """
+    nd_frame = np.asarray(nd_frame, dtype=np.float32)
+    if nd_frame.ndim == 2:
+      nd_frame = nd_frame[..., np.newaxis]
+    nd_locations = get_patch_locations(nd_frame.shape, self.patch_size, self.patch_step)
+
+    dic_output_tensors = {'D': self.frame_D, 'D_': self.frame_D_, 'G': self.frame_G}
+    lst_results = self.sess.run([dic_output_tensors[s_output] for s_output in lst_outputs],
+                                feed_dict={self.frame_inputs: nd_frame[np.newaxis], self.frame_locations: nd_locations})
+    return dict(zip(lst_outputs, lst_results)), nd_locations
+
+  # =========================================================================================================
+  def f_check_frame_equivalence(self, nd_frame, f_tolerance=1e-4):
+    """
+    Compare f_score_frame with the patch path that scores without --whole_frame (f_score_patches) on one frame
+    :return: True when the D scores agree within f_tolerance, and the max absolute difference of D and D_
+    """
+    dic_frame, nd_locations = self.f_score_frame(nd_frame, ['D', 'D_'])
+    nd_patches, _ = get_image_patches([np.asarray(nd_frame).reshape(self.nd_frame_size)], self.patch_size, self.patch_step)
+    dic_patch = self.f_score_patches(nd_patches[:, 0], ['D', 'D_'])
+
+    dic_diff = {s_output: float(np.max(np.abs(dic_frame[s_output] - dic_patch[s_output]))) for s_output in ['D', 'D_']}
+    print('whole frame vs patches, max |diff|: D {:.3g}, D_ {:.3g}'.format(dic_diff['D'], dic_diff['D_']))
+    return dic_diff['D'] <= f_tolerance, dic_diff
+
+  # =========================================================================================================
+  def f_test_frozen_model(self,lst_image_slices=[], profiler=None):
+    import scipy.misc
     tmp_shape = lst_image_slices.shape
 
     if self.dataset_name=='UCSD':
       tmp_lst_slices = lst_image_slices.reshape(-1, tmp_shape[2], tmp_shape[3], 1)
     else:
       tmp_lst_slices = lst_image_slices
-    batch_idxs = len(tmp_lst_slices) // self.batch_size
-    print('start new process ...')
-    for i in xrange(0, batch_idxs):
-        batch_data = tmp_lst_slices[i * self.batch_size:(i + 1) * self.batch_size]
-
-        results_g = self.sess.run(self.G, feed_dict={self.z: batch_data})
-        results_d = self.sess.run(self.D, feed_dict={self.inputs: batch_data})
-        #results = self.sess.run(self.sampler, feed_dict={self.z: batch_data})
-        # to log some images with d values
-        #for idx,image in enumerate(results_g):
-        #  scipy.misc.imsave('samples/{}_{}.jpg'.format(idx,results_d[idx][0]),batch_data[idx,:,:,0])
-
-        lst_discriminator_v.extend(results_d)
-        lst_generated_img.extend(results_g)
-        print('finish pp ... {}/{}'.format(i,batch_idxs))
-    #f = plt.figure()
-    #plt.plot(np.array(lst_discriminator_v))
-    #f.savefig('samples/d_values.jpg')
-    scipy.misc.imsave('./'+self.sample_dir+'/ALOCC_generated.jpg', montage(np.array(lst_generated_img)[:,:,:,0]))
-    scipy.misc.imsave('./'+self.sample_dir+'/ALOCC_input.jpg', montage(np.array(tmp_lst_slices)[:,:,:,0]))
-    return lst_discriminator_v
+    print('start new process ... ({} patches)'.format(len(tmp_lst_slices)))
+    dic_results = self.f_score_patches(tmp_lst_slices, ['D', 'G'], profiler)
+
+    scipy.misc.imsave(os.path.join(self.sample_dir, 'ALOCC_generated.jpg'), montage(dic_results['G'][:,:,:,0]))
+    scipy.misc.imsave(os.path.join(self.sample_dir, 'ALOCC_input.jpg'), montage(np.array(tmp_lst_slices)[:,:,:,0]))
+    return dic_results['D']
@@ -0,0 +1,454 @@
+"""
+TensorFlow-free scoring of ALOCC checkpoints with NumPy.
+
+BundleReader reads the variables of an ALOCC_Model.model-* checkpoint straight from its files: the .index
+file is a table of name -> BundleEntryProto (dtype, shape, data shard, offset, size) and the values are
+raw little-endian bytes in the .data-*-of-* shards. NumpyALOCC runs the generator and discriminator
+forward pass on those weights, with im2col + GEMM convolutions, and scores patches like
+ALOCC_Model.f_score_patches. Only numpy is imported, so a process starts scoring in a fraction of a second.
+
+# D of the patches of one frame, and a comparison with the TensorFlow model when it is installed
+python numpy_engine.py --checkpoint_dir ./checkpoint/UCSD_128_45_45 --frame ./dataset/.../Test004/068.tif --compare
+"""
+import argparse
+import os
+import re
+import struct
+import sys
+import time
+
+import numpy as np
+
+# tensorflow DataType enum -> numpy dtype
+DIC_DTYPES = {1: np.float32, 2: np.float64, 3: np.int32, 4: np.uint8, 5: np.int16, 6: np.int8, 9: np.int64,
+              10: np.bool_, 14: np.uint16, 17: np.uint16, 19: np.float16, 22: np.uint32, 23: np.uint64}
+
+N_TABLE_MAGIC = 0xdb4775248b80fb57
+N_FOOTER_SIZE = 48
+N_BLOCK_TRAILER_SIZE = 5
+
+
+# =========================================================================================================
+# CHECKPOINT FILES
+# =========================================================================================================
+def _read_varint(buffer, n_pos):
+    """
+    :return: the varint at n_pos and the position after it
+    """
+    n_result = 0
+    n_shift = 0
+    while True:
+        n_byte = buffer[n_pos]
+        n_pos += 1
+        n_result |= (n_byte & 0x7f) << n_shift
+        if not n_byte & 0x80:
+            return n_result, n_pos
+        n_shift += 7
+
+
+def _snappy_decompress(buffer):
+    """
+    Raw snappy format, in which table blocks may be stored
+    """
+    n_length, n_pos = _read_varint(buffer, 0)
+    output = bytearray()
+    while n_pos < len(buffer):
+        n_tag = buffer[n_pos]
+        n_pos += 1
+        n_type = n_tag & 3
+        if n_type == 0:
+            n_literal = n_tag >> 2
+            if n_literal >= 60:
+                n_bytes = n_literal - 59
+                n_literal = int.from_bytes(bytes(buffer[n_pos:n_pos + n_bytes]), 'little')
+                n_pos += n_bytes
+            n_literal += 1
+            output += buffer[n_pos:n_pos + n_literal]
+            n_pos += n_literal
+            continue
+        if n_type == 1:
+            n_copy = ((n_tag >> 2) & 7) + 4
+            n_offset = ((n_tag >> 5) << 8) | buffer[n_pos]
+            n_pos += 1
+        else:
+            n_bytes = 2 if n_type == 2 else 4
+            n_copy = (n_tag >> 2) + 1
+            n_offset = int.from_bytes(bytes(buffer[n_pos:n_pos + n_bytes]), 'little')
+            n_pos += n_bytes
+        # copies may overlap their own output
+        for _ in range(n_copy):
+            output.append(output[-n_offset])
+    if len(output) != n_length:
+        raise ValueError('snappy block decompressed to {} bytes instead of {}'.format(len(output), n_length))
+    return bytes(output)
+
+
+def _read_block(buffer, n_offset, n_size):
+    """
+    Entries (key, value) of the table block at n_offset
+    """
+    n_compression = buffer[n_offset + n_size]
+    block = buffer[n_offset:n_offset + n_size]
+    if n_compression == 1:
+        block = _snappy_decompress(block)
+    elif n_compression != 0:
+        raise ValueError('unsupported table block compression {}'.format(n_compression))
+
+    n_restarts = struct.unpack('<I', block[-4:])[0]
+    n_end = len(block) - 4 * (n_restarts + 1)
+    lst_entries = []
+    s_key = b''
+    n_pos = 0
+    while n_pos < n_end:
+        n_shared, n_pos = _read_varint(block, n_pos)
+        n_non_shared, n_pos = _read_varint(block, n_pos)
+        n_value_size, n_pos = _read_varint(block, n_pos)
+        s_key = s_key[:n_shared] + bytes(block[n_pos:n_pos + n_non_shared])
+        n_pos += n_non_shared
+        lst_entries.append((s_key, bytes(block[n_pos:n_pos + n_value_size])))
+        n_pos += n_value_size
+    return lst_entries
+
+
+def _parse_proto(buffer):
+    """
+    Fields of a protobuf message: field number -> list of values (ints, or bytes for length-delimited fields)
+    """
+    dic_fields = {}
+    n_pos = 0
+    while n_pos < len(buffer):
+        n_key, n_pos = _read_varint(buffer, n_pos)
+        n_wire_type = n_key & 7
+        if n_wire_type == 0:
+            value, n_pos = _read_varint(buffer, n_pos)
+        elif n_wire_type == 1:
+            value = struct.unpack('<Q', buffer[n_pos:n_pos + 8])[0]
+            n_pos += 8
+        elif n_wire_type == 2:
+            n_size, n_pos = _read_varint(buffer, n_pos)
+            value = buffer[n_pos:n_pos + n_size]
+            n_pos += n_size
+        elif n_wire_type == 5:
+            value = struct.unpack('<I', buffer[n_pos:n_pos + 4])[0]
+            n_pos += 4
+        else:
+            raise ValueError('unsupported protobuf wire type {}'.format(n_wire_type))
+        dic_fields.setdefault(n_key >> 3, []).append(value)
+    return dic_fields
+
+
+class BundleReader(object):
+    """
+    Variables of a TensorFlow checkpoint (tensor bundle) given its prefix, e.g. checkpoint/UCSD_128_45_45/ALOCC_Model.model-5
+    """
+    def __init__(self, s_prefix):
+        self.s_prefix = s_prefix
+        with open(s_prefix + '.index', 'rb') as f:
+            buffer = f.read()
+        if struct.unpack('<Q', buffer[-8:])[0] != N_TABLE_MAGIC:
+            raise ValueError('{}.index is not a checkpoint index'.format(s_prefix))
+
+        # footer: metaindex handle, index handle, padding, magic
+        _, n_pos = _read_varint(buffer, len(buffer) - N_FOOTER_SIZE)
+        _, n_pos = _read_varint(buffer, n_pos)
+        n_index_offset, n_pos = _read_varint(buffer, n_pos)
+        n_index_size, n_pos = _read_varint(buffer, n_pos)
+
+        self.n_shards = 1
+        self.dic_entries = {}
+        for _, s_handle in _read_block(buffer, n_index_offset, n_index_size):
+            n_block_offset, n_handle_pos = _read_varint(s_handle, 0)
+            n_block_size, _ = _read_varint(s_handle, n_handle_pos)
+            for s_key, s_value in _read_block(buffer, n_block_offset, n_block_size):
+                dic_proto = _parse_proto(s_value)
+                if not s_key:
+                    # BundleHeaderProto
+                    self.n_shards = dic_proto.get(1, [1])[0]
+                    continue
+                lst_dims = [_parse_proto(s_dim).get(1, [0])[0] for s_dim in _parse_proto(dic_proto.get(2, [b''])[0]).get(2, [])]
+                if 7 in dic_proto:
+                    raise ValueError('{}: partitioned variables are not supported'.format(s_key.decode()))
+                self.dic_entries[s_key.decode()] = {'dtype': DIC_DTYPES[dic_proto.get(1, [1])[0]], 'shape': tuple(lst_dims),
+                                                    'shard': dic_proto.get(3, [0])[0], 'offset': dic_proto.get(4, [0])[0],
+                                                    'size': dic_proto.get(5, [0])[0]}
+
+    def names(self):
+        return sorted(self.dic_entries)
+
+    def get_tensor(self, s_name):
+        dic_entry = self.dic_entries[s_name]
+        s_data_path = '{}.data-{:05d}-of-{:05d}'.format(self.s_prefix, dic_entry['shard'], self.n_shards)
+        with open(s_data_path, 'rb') as f:
+            f.seek(dic_entry['offset'])
+            buffer = f.read(dic_entry['size'])
+        return np.frombuffer(buffer, dtype=np.dtype(dic_entry['dtype']).newbyteorder('<')).reshape(dic_entry['shape'])
+
+
+def latest_checkpoint(s_checkpoint_dir):
+    """
+    Prefix named by model_checkpoint_path in the 'checkpoint' file of s_checkpoint_dir, None if there is none
+    """
+    s_state_path = os.path.join(s_checkpoint_dir, 'checkpoint')
+    if not os.path.exists(s_state_path):
+        return None
+    with open(s_state_path) as f:
+        match = re.search(r'^model_checkpoint_path:\s*"(.*)"', f.read(), re.MULTILINE)
+    if match is None:
+        return None
+    s_prefix = match.group(1)
+    return s_prefix if os.path.isabs(s_prefix) else os.path.join(s_checkpoint_dir, s_prefix)
+
+
+def read_values(s_checkpoint_path, fn_keep=None):
+    """
+    :param s_checkpoint_path: checkpoint prefix or weights-only .npz export (see checkpointing.CheckpointManager)
+    :param fn_keep: name -> bool, the variables to read (all by default)
+    :return: dict variable name -> numpy array
+    """
+    if s_checkpoint_path.endswith('.npz'):
+        with np.load(s_checkpoint_path) as npz:
+            return {s_name: npz[s_name] for s_name in npz.files if fn_keep is None or fn_keep(s_name)}
+    reader = BundleReader(s_checkpoint_path)
+    return {s_name: reader.get_tensor(s_name) for s_name in reader.names() if fn_keep is None or fn_keep(s_name)}
+
+
+# =========================================================================================================
+# FORWARD PASS
+# =========================================================================================================
+def conv2d(x, w, biases, s_padding='VALID', n_max_chunk_bytes=64 * 2 ** 20):
+    """
+    Stride-1 convolution as in ops.conv2d: x (N, H, W, C), w (kh, kw, C, out). The im2col matrix of a chunk of
+    patches is copied out of a strided view of x and multiplied with the filter matrix in one GEMM.
+    """
+    n_kh, n_kw, n_in, n_out = w.shape
+    if s_padding == 'SAME':
+        x = np.pad(x, [(0, 0), ((n_kh - 1) // 2, n_kh // 2), ((n_kw - 1) // 2, n_kw // 2), (0, 0)], 'constant')
+    n_batch, n_h, n_w, _ = x.shape
+    n_oh, n_ow = n_h - n_kh + 1, n_w - n_kw + 1
+    nd_w = w.reshape(n_kh * n_kw * n_in, n_out)
+
+    x = np.ascontiguousarray(x)
+    n_sn, n_sh, n_sw, n_sc = x.strides
+    windows = np.lib.stride_tricks.as_strided(x, (n_batch, n_oh, n_ow, n_kh, n_kw, n_in),
+                                              (n_sn, n_sh, n_sw, n_sh, n_sw, n_sc), writeable=False)
+    n_chunk = max(1, n_max_chunk_bytes // (n_oh * n_ow * nd_w.shape[0] * x.itemsize))
+    output = np.empty((n_batch, n_oh, n_ow, n_out), dtype=np.result_type(x, w))
+    for n_start in range(0, n_batch, n_chunk):
+        cols = windows[n_start:n_start + n_chunk].reshape(-1, nd_w.shape[0])
+        output[n_start:n_start + n_chunk] = np.dot(cols, nd_w).reshape(-1, n_oh, n_ow, n_out)
+    return output + biases
+
+
+def deconv2d(x, w, biases, s_padding='VALID', n_max_chunk_bytes=64 * 2 ** 20):
+    """
+    Stride-1 transposed convolution as in ops.deconv2d: x (N, H, W, in), w (kh, kw, out, in). It is the
+    convolution of x, padded by kernel - 1 - (forward SAME padding) on each side, with the flipped filter.
+    """
+    n_kh, n_kw = w.shape[:2]
+    if s_padding == 'SAME':
+        tpl_pad_h = (n_kh - 1 - (n_kh - 1) // 2, n_kh - 1 - n_kh // 2)
+        tpl_pad_w = (n_kw - 1 - (n_kw - 1) // 2, n_kw - 1 - n_kw // 2)
+    else:
+        tpl_pad_h, tpl_pad_w = (n_kh - 1, n_kh - 1), (n_kw - 1, n_kw - 1)
+    x = np.pad(x, [(0, 0), tpl_pad_h, tpl_pad_w, (0, 0)], 'constant')
+    return conv2d(x, w[::-1, ::-1].transpose(0, 1, 3, 2), biases, 'VALID', n_max_chunk_bytes)
+
+
+def batch_norm(x, dic_bn, s_mode='batch', f_epsilon=1e-5):
+    """
+    ops.batch_norm: s_mode 'batch' normalizes with the statistics of x (the training-mode graph the scores come
+    from), 'moving' with the moving averages; dic_bn None when the layer was folded into the previous one
+    """
+    if dic_bn is None:
+        return x
+    if s_mode == 'batch':
+        nd_mean = x.mean(axis=(0, 1, 2))
+        nd_variance = x.var(axis=(0, 1, 2))
+    else:
+        nd_mean, nd_variance = dic_bn['moving_mean'], dic_bn['moving_variance']
+    nd_scale = dic_bn['gamma'] / np.sqrt(nd_variance + f_epsilon)
+    return x * nd_scale + (dic_bn['beta'] - nd_mean * nd_scale)
+
+
+def fold_batch_norm(w, biases, gamma, beta, moving_mean, moving_variance, epsilon=1e-5, n_output_axis=3):
+    """
+    Weights and biases of a conv/deconv followed by an inference-mode batch_norm, as one conv/deconv:
+    gamma * (conv(x, w) + biases - mean) / sqrt(variance + epsilon) + beta
+    :param n_output_axis: output-channel axis of w, 3 for conv2d filters, 2 for deconv2d filters
+    """
+    scale = gamma / np.sqrt(moving_variance + epsilon)
+    shape = [1] * w.ndim
+    shape[n_output_axis] = -1
+    return (w * scale.reshape(shape)).astype(w.dtype), ((biases - moving_mean) * scale + beta).astype(biases.dtype)
+
+
+def lrelu(x, f_leak=0.2):
+    return np.maximum(x, f_leak * x)
+
+
+def sigmoid(x):
+    return 1. / (1. + np.exp(-x))
+
+
+class NumpyALOCC(object):
+    """
+    Forward pass of ALOCC_Model.generator and discriminator on the values of a checkpoint
+    """
+    # (conv / deconv scope, padding, batch-norm scope) in the order of models.ALOCC_Model.discriminator_features
+    LST_DISCRIMINATOR = [('d_h0_conv', 'VALID', 'd_bn0'), ('d_h1_conv', 'VALID', 'd_bn1'),
+                         ('d_h2_conv', 'VALID', 'd_bn2'), ('d_h3_conv', 'VALID', 'd_bn3')]
+    # (conv / deconv scope, padding, batch-norm scope, transposed) in the order of models.ALOCC_Model.generator
+    LST_GENERATOR = [('g_encoder_h0_conv', 'VALID', 'g_bn0', False), ('g_encoder_h1_conv', 'VALID', 'g_bn1', False),
+                     ('g_encoder_h2_conv', 'VALID', 'g_bn2', False), ('g_encoder_h3_conv', 'SAME', 'g_bn3', False),
+                     ('g_decoder_h3_deconv', 'SAME', 'g_bn4', True), ('g_decoder_h2_deconv', 'VALID', 'g_bn5', True),
+                     ('g_decoder_h1_deconv', 'VALID', 'g_bn6', True), ('g_decoder_h0_deconv', 'VALID', 'g_bn7', True)]
+
+    def __init__(self, dic_values, s_batch_norm='batch', n_batch_size=64, n_max_chunk_bytes=64 * 2 ** 20):
+        """
+        :param dic_values: variable name -> value (see read_values), optimizer slots are ignored
+        :param s_batch_norm: 'batch' for the batch statistics of the TensorFlow scoring graph, 'moving' for the
+                             moving averages (ALOCC_Model(b_fold_batch_norm=True))
+        """
+        self.s_batch_norm = s_batch_norm
+        self.n_batch_size = n_batch_size
+        self.n_max_chunk_bytes = n_max_chunk_bytes
+        self.dic_values = {s_name: np.asarray(value, dtype=np.float32) for s_name, value in dic_values.items()}
+
+    @classmethod
+    def from_checkpoint(cls, s_checkpoint_path, **kwargs):
+        """
+        :param s_checkpoint_path: checkpoint prefix, weights-only .npz, or a directory holding a 'checkpoint' file
+        """
+        if os.path.isdir(s_checkpoint_path):
+            s_checkpoint_path = latest_checkpoint(s_checkpoint_path)
+        return cls(read_values(s_checkpoint_path, lambda s_name: re.search(r'Adam|RMSProp|power', s_name) is None), **kwargs)
+
+    def _bn(self, s_scope):
+        s_prefix = s_scope + '/'
+        if s_prefix + 'gamma' not in self.dic_values:
+            return None
+        return {s_name: self.dic_values[s_prefix + s_name] for s_name in ['gamma', 'beta', 'moving_mean', 'moving_variance']}
+
+    def discriminator(self, x):
+        """
+        :return: D and its logits, (N, 1)
+        """
+        for s_layer, s_padding, s_bn in self.LST_DISCRIMINATOR:
+            s_layer = 'discriminator/' + s_layer
+            x = conv2d(x, self.dic_values[s_layer + '/w'], self.dic_values[s_layer + '/biases'], s_padding, self.n_max_chunk_bytes)
+            x = lrelu(batch_norm(x, self._bn('discriminator/' + s_bn), self.s_batch_norm))
+        logits = np.dot(x.reshape(len(x), -1), self.dic_values['discriminator/d_h3_lin/Matrix']) + \
+                 self.dic_values['discriminator/d_h3_lin/bias']
+        return sigmoid(logits), logits
+
+    def generator(self, z):
+        """
+        :return: G, the reconstruction of z
+        """
+        x = z
+        for i, (s_layer, s_padding, s_bn, b_transposed) in enumerate(self.LST_GENERATOR):
+            s_layer = 'generator/' + s_layer
+            fn_conv = deconv2d if b_transposed else conv2d
+            x = fn_conv(x, self.dic_values[s_layer + '/w'], self.dic_values[s_layer + '/biases'], s_padding, self.n_max_chunk_bytes)
+            x = batch_norm(x, self._bn('generator/' + s_bn), self.s_batch_norm)
+            # no leaky relu after the last batch-norm, the sigmoid follows
+            if i < len(self.LST_GENERATOR) - 1:
+                x = lrelu(x)
+        return sigmoid(x)
+
+    def score_batch(self, nd_batch, lst_outputs=('D',)):
+        dic_results = {}
+        if 'D' in lst_outputs:
+            dic_results['D'] = self.discriminator(nd_batch)[0]
+        if 'G' in lst_outputs or 'D_' in lst_outputs:
+            g = self.generator(nd_batch)
+            if 'G' in lst_outputs:
+                dic_results['G'] = g
+            if 'D_' in lst_outputs:
+                dic_results['D_'] = self.discriminator(g)[0]
+        return dic_results
+
+    def score(self, nd_patches, lst_outputs=('D',)):
+        """
+        Same batching as utils.score_in_batches: the last batch is shifted back to stay full, so that with
+        'batch' batch-norm every patch is normalized with n_batch_size patches as in the TensorFlow graph
+        :return: dict output name -> numpy array aligned with nd_patches
+        """
+        nd_patches = np.asarray(nd_patches, dtype=np.float32)
+        if nd_patches.ndim == 3:
+            nd_patches = nd_patches[..., np.newaxis]
+        n_patches = len(nd_patches)
+        dic_results = {}
+        for n_start in range(0, n_patches, self.n_batch_size):
+            n_batch_start = max(0, min(n_start, n_patches - self.n_batch_size))
+            n_offset = n_start - n_batch_start
+            n_keep = min(n_start + self.n_batch_size, n_patches) - n_start
+            dic_batch = self.score_batch(nd_patches[n_batch_start:n_batch_start + self.n_batch_size], lst_outputs)
+            for s_output, value in dic_batch.items():
+                if s_output not in dic_results:
+                    dic_results[s_output] = np.empty((n_patches,) + value.shape[1:], dtype=np.float32)
+                dic_results[s_output][n_start:n_start + n_keep] = value[n_offset:n_offset + n_keep]
+        return dic_results
+
+
+def compare_with_tensorflow(s_checkpoint_path, nd_patches, n_batch_size=64):
+    """
+    Max absolute difference of D, D_ and G between NumpyALOCC and ALOCC_Model.f_score_patches on nd_patches
+    """
+    import tensorflow as tf
+    from models import ALOCC_Model
+
+    engine = NumpyALOCC.from_checkpoint(s_checkpoint_path, n_batch_size=n_batch_size)
+    dic_numpy = engine.score(nd_patches, ['D', 'D_', 'G'])
+    nd_patch_size = nd_patches.shape[1:3]
+    with tf.Graph().as_default(), tf.Session() as sess:
+        model = ALOCC_Model(sess, input_height=nd_patch_size[0], input_width=nd_patch_size[1],
+                            output_height=nd_patch_size[0], output_width=nd_patch_size[1], batch_size=n_batch_size,
+                            c_dim=1, is_training=False, b_inference_only=True)
+        model.f_check_checkpoint(s_checkpoint_path)
+        dic_tf = model.f_score_patches(nd_patches, ['D', 'D_', 'G'])
+    return {s_output: float(np.abs(dic_numpy[s_output] - dic_tf[s_output]).max()) for s_output in dic_numpy}
+
+
+def main(lst_args=None):
+    f_start = time.time()
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--checkpoint_dir', default='./checkpoint/UCSD_128_45_45')
+    parser.add_argument('--checkpoint_path', default=None, help='checkpoint prefix or .npz export, the latest one of checkpoint_dir by default')
+    parser.add_argument('--frame', default=None, help='frame to score, random patches when not given')
+    parser.add_argument('--patch_size', type=int, default=45)
+    parser.add_argument('--stride', type=int, default=10)
+    parser.add_argument('--batch_size', type=int, default=64)
+    parser.add_argument('--batch_norm', default='batch', choices=['batch', 'moving'])
+    parser.add_argument('--compare', action='store_true', help='also score with TensorFlow and report the differences')
+    args = parser.parse_args(lst_args)
+
+    s_checkpoint_path = args.checkpoint_path or latest_checkpoint(args.checkpoint_dir)
+    if s_checkpoint_path is None:
+        raise Exception("[!] No checkpoint found in {}".format(args.checkpoint_dir))
+    engine = NumpyALOCC.from_checkpoint(s_checkpoint_path, s_batch_norm=args.batch_norm, n_batch_size=args.batch_size)
+    f_load_time = time.time() - f_start
+
+    if args.frame is not None:
+        # same crop and patch grid as test.py, the border patches are clamped to the frame
+        import imageio
+        from kh_tools import ND_FRAME_CROP, get_image_patches
+        nd_frame = np.asarray(imageio.imread(args.frame))[ND_FRAME_CROP[0][0]:ND_FRAME_CROP[0][1],
+                                                          ND_FRAME_CROP[1][0]:ND_FRAME_CROP[1][1]] / 255.
+        nd_patches, _ = get_image_patches(nd_frame[np.newaxis], (args.patch_size, args.patch_size), (args.stride, args.stride))
+        nd_patches = nd_patches[:, 0].astype(np.float32)
+    else:
+        nd_patches = np.random.RandomState(0).uniform(0, 1, (args.batch_size, args.patch_size, args.patch_size)).astype(np.float32)
+
+    f_score_start = time.time()
+    dic_results = engine.score(nd_patches, ['D'])
+    f_score_time = time.time() - f_score_start
+    print(' [*] {}: loaded in {:.3f}s since start ({} modules), {} patches scored in {:.3f}s ({:.1f} patches/s), min D {:.6g}'.format(
+        s_checkpoint_path, f_load_time, len(sys.modules), len(nd_patches), f_score_time, len(nd_patches) / max(f_score_time, 1e-12),
+        dic_results['D'].min()))
+    if args.compare:
+        print(' [*] max |numpy - tensorflow|: {}'.format(compare_with_tensorflow(s_checkpoint_path, nd_patches, args.batch_size)))
+
+
+if __name__ == '__main__':
+    main()
@@ -9,6 +9,8 @@ import tensorflow as tf
 from tensorflow.python.framework import ops
 
 from utils import *
+# numpy only, so the folding can be done and tested without TensorFlow
+from numpy_engine import fold_batch_norm
 
 try:
   image_summary = tf.image_summary
@@ -31,16 +33,26 @@ else:
     return tf.concat(tensors, axis, *args, **kwargs)
 
 class batch_norm(object):
-  def __init__(self, epsilon=1e-5, momentum = 0.9, name="batch_norm"):
+  def __init__(self, epsilon=1e-5, momentum = 0.9, name="batch_norm", update_moving_averages=True, folded=False):
+    '''
+    : params update_moving_averages : update the moving mean/variance in place on every training-mode call.
+                                      Inference-only graphs turn this off so that they hold no assign ops.
+    : params folded : the moving-average normalization, scale and shift are folded into the weights of the
+                      preceding conv/deconv (see fold_batch_norm), so calling the layer adds no op and no variable.
+    '''
     with tf.variable_scope(name):
       self.epsilon  = epsilon
       self.momentum = momentum
       self.name = name
+      self.update_moving_averages = update_moving_averages
+      self.folded = folded
 
   def __call__(self, x, train=True):
+    if self.folded:
+      return x
     return tf.contrib.layers.batch_norm(x,
                       decay=self.momentum,
-                      updates_collections=None,
+                      updates_collections=None if self.update_moving_averages else 'unused_batch_norm_updates',
                       epsilon=self.epsilon,
                       scale=True,
                       is_training=train,
@@ -51,7 +63,7 @@ def conv_cond_concat(x, y):
   x_shapes = x.get_shape()
   y_shapes = y.get_shape()
   return concat([
-    x, y*tf.ones([x_shapes[0], x_shapes[1], x_shapes[2], y_shapes[3]])], 3)
+    x, y*tf.ones(tf.stack([tf.shape(x)[0], x_shapes[1], x_shapes[2], y_shapes[3]]))], 3)
 
 def conv2d(input_, output_dim, k_h=5, k_w=5, d_h=1, d_w=1, stddev=0.02, name="conv2d", padding = "VALID"):
 
@@ -69,7 +81,7 @@ def conv2d(input_, output_dim, k_h=5, k_w=5, d_h=1, d_w=1, stddev=0.02, name="co
 
     biases = tf.get_variable('biases', [output_dim], initializer=tf.constant_initializer(0.0))
 
-    conv = tf.reshape(tf.nn.bias_add(conv, biases), conv.get_shape())
+    conv = tf.nn.bias_add(conv, biases)
 
     return conv
 
@@ -77,23 +89,38 @@ def conv2d(input_, output_dim, k_h=5, k_w=5, d_h=1, d_w=1, stddev=0.02, name="co
 
 def deconv2d(input_, output_shape, k_h=5, k_w=5, d_h=1, d_w=1, stddev=0.02, name="deconv2d", with_w=False,padding='VALID'):
 
+  # an unknown (None) batch dimension in output_shape is taken from input_ at run time
+  output_shape = tf.TensorShape(output_shape).as_list()
+  if output_shape[0] is None:
+    run_output_shape = tf.stack([tf.shape(input_)[0]] + output_shape[1:])
+  else:
+    run_output_shape = output_shape
+
   with tf.variable_scope(name):
 
     # filter : [height, width, output_channels, in_channels]
     w = tf.get_variable('w', [k_h, k_w, output_shape[-1], input_.get_shape()[-1]],initializer=tf.contrib.layers.xavier_initializer())
     if padding=='VALID':
         # input_ = tf.pad(input_,paddings = [[0,0], [4,4], [4,4], [0,0]], mode='SYMMETRIC', name = "pad")
-        deconv = tf.nn.conv2d_transpose(input_, w, output_shape = output_shape, strides=[1, d_h, d_w, 1], padding = 'VALID')
+        deconv = tf.nn.conv2d_transpose(input_, w, output_shape = run_output_shape, strides=[1, d_h, d_w, 1], padding = 'VALID')
     else:
-        deconv = tf.nn.conv2d_transpose(input_, w, output_shape = output_shape, strides=[1, d_h, d_w, 1], padding = 'SAME')
+        deconv = tf.nn.conv2d_transpose(input_, w, output_shape = run_output_shape, strides=[1, d_h, d_w, 1], padding = 'SAME')
     biases = tf.get_variable('biases', [output_shape[-1]], initializer=tf.constant_initializer(0.0))
-    deconv = tf.reshape(tf.nn.bias_add(deconv, biases), deconv.get_shape())
+    deconv = tf.nn.bias_add(deconv, biases)
+    deconv.set_shape(output_shape)
 
     return deconv
 
 def lrelu(x, leak=0.2, name="lrelu"):
   return tf.maximum(x, leak*x)
 
+def gaussian_noise(x, sigma=0.155, seed=None, name="gaussian_noise"):
+  """Add N(0, sigma^2) noise to images in [0, 1] and clip back to [0, 1], like skimage's random_noise(x, var=sigma**2).
+  A new draw is made on every run of the graph."""
+  with tf.name_scope(name):
+    noise = tf.random_normal(tf.shape(x), stddev=sigma, dtype=x.dtype, seed=seed)
+    return tf.clip_by_value(x + noise, 0., 1.)
+
 def linear(input_, output_size, scope=None, stddev=0.02, bias_start=0.0, with_w=False):
 
   shape = input_.get_shape().as_list()
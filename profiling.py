@@ -0,0 +1,151 @@
+"""
+Opt-in op-level profiling of training and scoring steps.
+
+StepProfiler traces the sess.run calls of a window of steps with full RunMetadata, writes one Chrome trace
+per traced run (open chrome://tracing and load the json) and aggregates the op times and memory into tables
+by op type and by layer. Layers are the variable scopes of ops.conv2d / ops.deconv2d / linear / batch_norm
+(g_encoder_h0_conv, d_bn0, ...), split into the forward pass, the gradients and the optimizer updates.
+
+    profiler = StepProfiler('./profile', sess.graph, n_start_step=10, n_steps=5)
+    dic_run_kwargs = profiler.run_kwargs(step)
+    sess.run(fetches, feed_dict, **dic_run_kwargs)
+    profiler.record(step, dic_run_kwargs, 'train')
+    ...
+    profiler.write_summary()
+"""
+import json
+import os
+import re
+from collections import defaultdict
+
+import tensorflow as tf
+from tensorflow.python.client import timeline
+
+SUMMARY_OP_TYPES = {'ScalarSummary', 'HistogramSummary', 'ImageSummary', 'MergeSummary'}
+
+
+class StepProfiler(object):
+    """
+    Traces the runs of steps n_start_step .. n_start_step + n_steps - 1 and keeps per-node time and memory
+    """
+    def __init__(self, s_output_dir, graph, n_start_step=10, n_steps=5):
+        self.s_output_dir = s_output_dir
+        self.graph = graph
+        self.n_start_step = n_start_step
+        self.n_steps = n_steps
+        if not os.path.exists(s_output_dir):
+            os.makedirs(s_output_dir)
+
+        # layer names are the scopes holding the trainable variables (generator/g_bn0/beta -> g_bn0)
+        self.set_layers = set(var.op.name.split('/')[-2] for var in graph.get_collection(tf.GraphKeys.TRAINABLE_VARIABLES)
+                              if '/' in var.op.name)
+        self.set_traced_steps = set()
+        self.n_traced_runs = 0
+        self.dic_node_micros = defaultdict(int)
+        self.dic_node_bytes = defaultdict(int)
+        self.dic_node_calls = defaultdict(int)
+
+    def is_active(self, n_step):
+        return self.n_start_step <= n_step < self.n_start_step + self.n_steps
+
+    def run_kwargs(self, n_step):
+        """
+        :return: options/run_metadata keyword arguments of sess.run for n_step, empty outside of the window
+        """
+        if not self.is_active(n_step):
+            return {}
+        return {'options': tf.RunOptions(trace_level=tf.RunOptions.FULL_TRACE), 'run_metadata': tf.RunMetadata()}
+
+    def record(self, n_step, dic_run_kwargs, s_tag='step'):
+        """
+        Write the Chrome trace of a run made with dic_run_kwargs and add its node stats to the tables
+        """
+        if not dic_run_kwargs:
+            return
+        step_stats = dic_run_kwargs['run_metadata'].step_stats
+        s_trace_path = os.path.join(self.s_output_dir, 'timeline_{}_{:06d}_{}.json'.format(s_tag, n_step, self.n_traced_runs))
+        with open(s_trace_path, 'w') as f:
+            f.write(timeline.Timeline(step_stats, graph=self.graph).generate_chrome_trace_format(show_memory=True))
+
+        for dev_stats in step_stats.dev_stats:
+            if dev_stats.device.endswith('/stream:all'):
+                # GPU kernels show up on their own stream and again in this aggregate
+                continue
+            for node_stats in dev_stats.node_stats:
+                s_node = node_stats.node_name.split(':')[0]
+                self.dic_node_micros[s_node] += node_stats.all_end_rel_micros
+                self.dic_node_bytes[s_node] += sum(memory.total_bytes for memory in node_stats.memory)
+                self.dic_node_calls[s_node] += 1
+        self.set_traced_steps.add(n_step)
+        self.n_traced_runs += 1
+
+    def _op_type(self, s_node):
+        try:
+            return self.graph.get_operation_by_name(s_node).type
+        except KeyError:
+            # _SOURCE and other runtime-only nodes
+            return s_node
+
+    def _layer(self, s_node, s_op_type):
+        if s_op_type in SUMMARY_OP_TYPES:
+            return 'summaries'
+        lst_parts = s_node.split('/')
+        if lst_parts[0] == 'gradients':
+            s_phase = 'backward'
+        elif any(s_part.startswith('Adam') or s_part.startswith('update_') for s_part in lst_parts):
+            s_phase = 'optimizer'
+        else:
+            s_phase = 'forward'
+        for s_part in lst_parts:
+            # a scope opened again gets a numeric suffix in op names (d_h0_conv_1/...)
+            s_layer = s_part if s_part in self.set_layers else re.sub(r'_\d+$', '', s_part)
+            if s_layer in self.set_layers:
+                return '{}/{}'.format(s_layer, s_phase)
+        return 'other/{}'.format(s_phase)
+
+    def summary_table(self, s_group='layer'):
+        """
+        :param s_group: 'layer' (variable scope and phase) or 'op' (op type)
+        :return: rows (name, #calls, total ms, ms per traced step, % of total time, total MB) by decreasing time
+        """
+        dic_micros = defaultdict(int)
+        dic_bytes = defaultdict(int)
+        dic_calls = defaultdict(int)
+        for s_node, n_micros in self.dic_node_micros.items():
+            s_op_type = self._op_type(s_node)
+            s_key = self._layer(s_node, s_op_type) if s_group == 'layer' else s_op_type
+            dic_micros[s_key] += n_micros
+            dic_bytes[s_key] += self.dic_node_bytes[s_node]
+            dic_calls[s_key] += self.dic_node_calls[s_node]
+
+        n_total = max(sum(dic_micros.values()), 1)
+        n_steps = max(len(self.set_traced_steps), 1)
+        return [(s_key, dic_calls[s_key], dic_micros[s_key] / 1e3, dic_micros[s_key] / 1e3 / n_steps,
+                 100. * dic_micros[s_key] / n_total, dic_bytes[s_key] / 2. ** 20)
+                for s_key in sorted(dic_micros, key=dic_micros.get, reverse=True)]
+
+    def format_table(self, s_group='layer', n_rows=30):
+        lst_lines = ['{:45s} {:>7s} {:>11s} {:>11s} {:>6s} {:>10s}'.format(
+            s_group, 'calls', 'total ms', 'ms/step', '%', 'MB')]
+        for s_key, n_calls, f_total, f_per_step, f_percent, f_mb in self.summary_table(s_group)[:n_rows]:
+            lst_lines.append('{:45s} {:7d} {:11.2f} {:11.2f} {:6.1f} {:10.2f}'.format(
+                s_key, n_calls, f_total, f_per_step, f_percent, f_mb))
+        return '\n'.join(lst_lines)
+
+    def write_summary(self):
+        """
+        Print the layer and op tables and write them to summary.txt / summary.json in s_output_dir
+        """
+        if not self.n_traced_runs:
+            print(' [!] Profiler: no run was traced (window starts at step {})'.format(self.n_start_step))
+            return
+        s_text = 'traced steps: {}, runs: {}\n\n{}\n\n{}\n'.format(
+            sorted(self.set_traced_steps), self.n_traced_runs, self.format_table('layer'), self.format_table('op'))
+        print(s_text)
+        with open(os.path.join(self.s_output_dir, 'summary.txt'), 'w') as f:
+            f.write(s_text)
+        lst_columns = ['name', 'calls', 'total_ms', 'ms_per_step', 'percent', 'mb']
+        with open(os.path.join(self.s_output_dir, 'summary.json'), 'w') as f:
+            json.dump({'traced_steps': sorted(self.set_traced_steps), 'runs': self.n_traced_runs,
+                       'layer': [dict(zip(lst_columns, row)) for row in self.summary_table('layer')],
+                       'op': [dict(zip(lst_columns, row)) for row in self.summary_table('op')]}, f, indent=2)
@@ -0,0 +1,256 @@
+"""
+Post-training int8 quantization of the ALOCC scoring model (generator + discriminator) for CPU inference.
+
+# calibrate on training frames, export, then compare with the float model on test frames
+python quantization.py --checkpoint_dir ./checkpoint/UCSD_128_45_45 \
+    --calibration_dir ./dataset/UCSD_Anomaly_Dataset.v1p2/UCSDped2/Train \
+    --evaluation_dir ./dataset/UCSD_Anomaly_Dataset.v1p2/UCSDped2/Test --export_path ./export/ALOCC_UCSD_45_int8.tflite
+
+The quantized model is a TensorFlow Lite flatbuffer with int8 weights and activations (float32 input and
+outputs, quantized inside). It maps one batch of patches to D_logits (discriminator on the patch) and G (its
+reconstruction). Batch-norm uses the moving averages, as int8 kernels need fixed scales and shifts; the
+report compares it with the float model in the same mode ('float_moving_stats', the quantization error
+alone) and with the float scoring graph of ALOCC_Model, which normalizes with the batch statistics
+('float_batch_stats', what test.py scores with today).
+"""
+import json
+import os
+import time
+from glob import glob
+
+import numpy as np
+import tensorflow as tf
+
+from kh_tools import read_lst_patches_uint8, to_float_images
+from streaming import F_ANOMALY_THRESHOLD
+from utils import score_in_batches
+
+flags = tf.app.flags
+flags.DEFINE_string("checkpoint_dir", "./checkpoint/UCSD_128_45_45", "Directory of the checkpoint to quantize")
+flags.DEFINE_string("checkpoint_path", None, "Checkpoint prefix (or weights-only .npz export), None for the latest one in checkpoint_dir [None]")
+flags.DEFINE_string("export_path", "./export/ALOCC_UCSD_45_int8.tflite", "Path of the int8 model")
+flags.DEFINE_string("calibration_dir", "./dataset/UCSD_Anomaly_Dataset.v1p2/UCSDped2/Train", "Videos of normal frames to calibrate on")
+flags.DEFINE_string("evaluation_dir", "./dataset/UCSD_Anomaly_Dataset.v1p2/UCSDped2/Test", "Videos of the frames of the accuracy report")
+flags.DEFINE_integer("n_calibration_frames", 20, "Frames sampled from calibration_dir [20]")
+flags.DEFINE_integer("n_calibration_patches", 512, "Patches of those frames fed to the calibration [512]")
+flags.DEFINE_integer("n_evaluation_frames", 10, "Frames sampled from evaluation_dir [10]")
+flags.DEFINE_integer("stride", 10, "Patch stride in the calibration and evaluation frames [10]")
+flags.DEFINE_integer("input_height", 45, "The size of the patches. [45]")
+flags.DEFINE_integer("input_width", None, "The size of the patches. If None, same value as input_height [None]")
+flags.DEFINE_integer("c_dim", 1, "Channels of the patches [1]")
+flags.DEFINE_integer("batch_size", 64, "Patches per run of either model [64]")
+flags.DEFINE_integer("n_repeats", 3, "Timed passes over the evaluation patches [3]")
+flags.DEFINE_string("report_path", None, "Write the accuracy / throughput report as json here, None to only print it [None]")
+
+
+def build_scoring_model(sess, s_checkpoint_path, nd_patch_size=(45, 45), c_dim=1, n_batch_size=64):
+    """
+    Inference-only ALOCC_Model restored from s_checkpoint_path, plus D_logits and G on a fixed-size batch with
+    batch-norm on the moving averages
+    :return: the model, the batch placeholder and dict output name -> tensor
+    """
+    from models import ALOCC_Model
+    from checkpointing import restore_weights
+
+    model = ALOCC_Model(sess, input_height=nd_patch_size[0], input_width=nd_patch_size[1],
+                        output_height=nd_patch_size[0], output_width=nd_patch_size[1],
+                        c_dim=c_dim, is_training=False, b_inference_only=True)
+    patches = tf.placeholder(tf.float32, [n_batch_size, nd_patch_size[0], nd_patch_size[1], c_dim], name='quant_patches')
+    _, d_logits = model.discriminator(patches, reuse=True, train=False)
+    g, _ = model.generator(patches, reuse=True, train=False)
+    with tf.name_scope('quantizable'):
+        dic_outputs = {'D_logits': tf.identity(d_logits, name='D_logits'), 'G': tf.identity(g, name='G')}
+
+    if s_checkpoint_path.endswith('.npz'):
+        restore_weights(sess, s_checkpoint_path)
+    else:
+        tf.train.Saver().restore(sess, s_checkpoint_path)
+    return model, patches, dic_outputs
+
+
+def export_int8_model(sess, patches, dic_outputs, nd_calibration_patches, s_export_path):
+    """
+    Convert the subgraph patches -> dic_outputs of sess to an int8 TensorFlow Lite model, with the activation
+    ranges calibrated on nd_calibration_patches (normal patches, float in [0, 1])
+    """
+    n_batch_size = patches.get_shape()[0].value
+    lst_output_names = sorted(dic_outputs)
+
+    def representative_dataset():
+        for n_start in range(0, len(nd_calibration_patches) - n_batch_size + 1, n_batch_size):
+            yield [nd_calibration_patches[n_start:n_start + n_batch_size]]
+
+    converter = tf.lite.TFLiteConverter.from_session(sess, [patches], [dic_outputs[s_name] for s_name in lst_output_names])
+    converter.optimizations = [tf.lite.Optimize.DEFAULT]
+    converter.representative_dataset = representative_dataset
+    converter.target_spec.supported_ops = [tf.lite.OpsSet.TFLITE_BUILTINS_INT8]
+    tflite_model = converter.convert()
+
+    s_export_dir = os.path.dirname(s_export_path)
+    if s_export_dir and not os.path.exists(s_export_dir):
+        os.makedirs(s_export_dir)
+    with open(s_export_path, 'wb') as f:
+        f.write(tflite_model)
+    with open(s_export_path + '.json', 'w') as f:
+        json.dump({'batch_size': n_batch_size, 'input_shape': patches.get_shape().as_list(), 'outputs': lst_output_names,
+                   'n_calibration_patches': len(nd_calibration_patches)}, f, indent=2)
+    print(' [*] Exported int8 model ({:.2f} MB) to {}'.format(len(tflite_model) / 2. ** 20, s_export_path))
+    return s_export_path
+
+
+class QuantizedScorer(object):
+    """
+    Scores patches with a model written by export_int8_model, on the CPU
+    """
+    def __init__(self, s_model_path, n_threads=None):
+        f_start = time.time()
+        with open(s_model_path + '.json') as f:
+            dic_description = json.load(f)
+        self.interpreter = tf.lite.Interpreter(model_path=s_model_path, num_threads=n_threads) \
+            if n_threads else tf.lite.Interpreter(model_path=s_model_path)
+        self.interpreter.allocate_tensors()
+        self.n_input = self.interpreter.get_input_details()[0]['index']
+        self.n_batch_size = dic_description['batch_size']
+        # output tensors come in the order given to the converter
+        self.dic_output_indices = {s_name: dic_output['index'] for s_name, dic_output
+                                   in zip(dic_description['outputs'], self.interpreter.get_output_details())}
+        self.f_load_time = time.time() - f_start
+
+    def score_batch(self, nd_batch):
+        self.interpreter.set_tensor(self.n_input, nd_batch)
+        self.interpreter.invoke()
+        return {s_name: self.interpreter.get_tensor(n_index) for s_name, n_index in self.dic_output_indices.items()}
+
+    def score(self, nd_patches):
+        """
+        :return: dict D_logits, D, G -> numpy array aligned with nd_patches (a short tail is padded and cut again)
+        """
+        nd_patches = np.asarray(nd_patches, dtype=np.float32)
+        if nd_patches.ndim == 3:
+            nd_patches = nd_patches[..., np.newaxis]
+        n_patches = len(nd_patches)
+        lst_batches = []
+        for n_start in range(0, n_patches, self.n_batch_size):
+            nd_batch = nd_patches[n_start:n_start + self.n_batch_size]
+            n_keep = len(nd_batch)
+            if n_keep < self.n_batch_size:
+                nd_batch = np.resize(nd_batch, (self.n_batch_size,) + nd_batch.shape[1:])
+            lst_batches.append({s_name: value[:n_keep] for s_name, value in self.score_batch(nd_batch).items()})
+        dic_results = {s_name: np.concatenate([dic_batch[s_name] for dic_batch in lst_batches]) for s_name in self.dic_output_indices}
+        dic_results['D'] = 1. / (1. + np.exp(-dic_results['D_logits']))
+        return dic_results
+
+
+def compare_scores(dic_reference, dic_quantized, f_threshold=F_ANOMALY_THRESHOLD):
+    """
+    Agreement of the quantized anomaly scores with a reference model on the same patches
+    """
+    nd_ref_logits = dic_reference['D_logits'].reshape(-1)
+    nd_quant_logits = dic_quantized['D_logits'].reshape(-1)
+    nd_ref_ranks = np.argsort(np.argsort(nd_ref_logits))
+    nd_quant_ranks = np.argsort(np.argsort(nd_quant_logits))
+    b_ref_anomaly = dic_reference['D'].reshape(-1) < f_threshold
+    b_quant_anomaly = dic_quantized['D'].reshape(-1) < f_threshold
+    n_lowest = max(1, len(nd_ref_logits) // 100)
+    return {
+        'D_mean_abs_diff': float(np.mean(np.abs(dic_reference['D'] - dic_quantized['D']))),
+        'D_max_abs_diff': float(np.max(np.abs(dic_reference['D'] - dic_quantized['D']))),
+        'D_logits_mean_abs_diff': float(np.mean(np.abs(nd_ref_logits - nd_quant_logits))),
+        'D_logits_pearson': float(np.corrcoef(nd_ref_logits, nd_quant_logits)[0, 1]),
+        'D_spearman': float(np.corrcoef(nd_ref_ranks, nd_quant_ranks)[0, 1]),
+        # the most anomalous 1% of the patches by either model
+        'lowest_1pct_overlap': len(set(np.argsort(nd_ref_logits)[:n_lowest]) &
+                                   set(np.argsort(nd_quant_logits)[:n_lowest])) / float(n_lowest),
+        'anomaly_decision_agreement': float(np.mean(b_ref_anomaly == b_quant_anomaly)),
+        'n_anomalies_reference': int(b_ref_anomaly.sum()),
+        'n_anomalies_quantized': int(b_quant_anomaly.sum()),
+        'G_mean_abs_diff': float(np.mean(np.abs(dic_reference['G'] - dic_quantized['G']))),
+    }
+
+
+def time_scoring(fn_score_batch, nd_patches, n_batch_size, n_repeats=3):
+    """
+    :return: patches/sec and per-batch latency percentiles (ms) of fn_score_batch over full batches of nd_patches
+    """
+    lst_batches = [nd_patches[n_start:n_start + n_batch_size]
+                   for n_start in range(0, len(nd_patches) - n_batch_size + 1, n_batch_size)]
+    fn_score_batch(lst_batches[0])
+    lst_latencies = []
+    for _ in range(n_repeats):
+        for nd_batch in lst_batches:
+            f_start = time.time()
+            fn_score_batch(nd_batch)
+            lst_latencies.append(time.time() - f_start)
+    nd_latencies = 1e3 * np.array(lst_latencies)
+    return {'patches_per_sec': n_batch_size * len(lst_latencies) / max(nd_latencies.sum() / 1e3, 1e-12),
+            'latency_ms_p50': float(np.percentile(nd_latencies, 50)), 'latency_ms_p90': float(np.percentile(nd_latencies, 90)),
+            'latency_ms_p99': float(np.percentile(nd_latencies, 99)), 'batch_size': n_batch_size}
+
+
+def sample_patches(s_dataset_dir, n_frames, nd_patch_size, n_stride, n_patches=None, n_seed=0):
+    """
+    Float patches of n_frames frames picked at random in the video directories of s_dataset_dir
+    """
+    rng = np.random.RandomState(n_seed)
+    lst_frame_paths = sorted(glob(os.path.join(s_dataset_dir, '*', '*.tif')))
+    if not lst_frame_paths:
+        raise Exception("[!] No frame found in {}".format(s_dataset_dir))
+    lst_frame_paths = [lst_frame_paths[i] for i in sorted(rng.choice(len(lst_frame_paths), min(n_frames, len(lst_frame_paths)), replace=False))]
+    nd_patches, _ = read_lst_patches_uint8(lst_frame_paths, nd_patch_size, (n_stride, n_stride))
+    if n_patches is not None and n_patches < len(nd_patches):
+        nd_patches = nd_patches[rng.choice(len(nd_patches), n_patches, replace=False)]
+    return to_float_images(nd_patches[..., np.newaxis])
+
+
+def main(_):
+    FLAGS = flags.FLAGS
+    if FLAGS.input_width is None:
+        FLAGS.input_width = FLAGS.input_height
+    nd_patch_size = (FLAGS.input_height, FLAGS.input_width)
+
+    s_checkpoint_path = FLAGS.checkpoint_path or tf.train.latest_checkpoint(FLAGS.checkpoint_dir)
+    if s_checkpoint_path is None:
+        raise Exception("[!] No checkpoint found in {}".format(FLAGS.checkpoint_dir))
+    nd_calibration_patches = sample_patches(FLAGS.calibration_dir, FLAGS.n_calibration_frames, nd_patch_size, FLAGS.stride,
+                                            FLAGS.n_calibration_patches)
+    nd_evaluation_patches = sample_patches(FLAGS.evaluation_dir, FLAGS.n_evaluation_frames, nd_patch_size, FLAGS.stride)
+    print(' [*] {} calibration patches, {} evaluation patches'.format(len(nd_calibration_patches), len(nd_evaluation_patches)))
+
+    dic_report = {'checkpoint': s_checkpoint_path, 'n_evaluation_patches': len(nd_evaluation_patches)}
+    with tf.Graph().as_default(), tf.Session() as sess:
+        model, patches, dic_outputs = build_scoring_model(sess, s_checkpoint_path, nd_patch_size, FLAGS.c_dim, FLAGS.batch_size)
+        export_int8_model(sess, patches, dic_outputs, nd_calibration_patches, FLAGS.export_path)
+
+        dic_float_outputs = {s_name: (tensor, patches) for s_name, tensor in dic_outputs.items()}
+        dic_float = score_in_batches(sess, dic_float_outputs, nd_evaluation_patches, ['D_logits', 'G'], FLAGS.batch_size)
+        dic_float['D'] = 1. / (1. + np.exp(-dic_float['D_logits']))
+        dic_batch_stats_outputs = {'D_logits': (model.D_logits, model.inputs), 'G': (model.G, model.z)}
+        dic_batch_stats = score_in_batches(sess, dic_batch_stats_outputs, nd_evaluation_patches, ['D_logits', 'G'], FLAGS.batch_size)
+        dic_batch_stats['D'] = 1. / (1. + np.exp(-dic_batch_stats['D_logits']))
+
+        lst_fetches = [dic_outputs['D_logits'], dic_outputs['G']]
+        dic_report['float_timing'] = time_scoring(lambda nd_batch: sess.run(lst_fetches, {patches: nd_batch}),
+                                                  nd_evaluation_patches, FLAGS.batch_size, FLAGS.n_repeats)
+
+    scorer = QuantizedScorer(FLAGS.export_path)
+    dic_quantized = scorer.score(nd_evaluation_patches)
+    dic_report['int8_timing'] = time_scoring(scorer.score_batch, nd_evaluation_patches, FLAGS.batch_size, FLAGS.n_repeats)
+    dic_report['speedup'] = dic_report['int8_timing']['patches_per_sec'] / dic_report['float_timing']['patches_per_sec']
+    dic_report['int8_vs_float_moving_stats'] = compare_scores(dic_float, dic_quantized)
+    dic_report['int8_vs_float_batch_stats'] = compare_scores(dic_batch_stats, dic_quantized)
+
+    for s_key in ['int8_vs_float_moving_stats', 'int8_vs_float_batch_stats']:
+        print('{}: {}'.format(s_key, ', '.join('{} {:.4g}'.format(s_name, value)
+                                                for s_name, value in sorted(dic_report[s_key].items()))))
+    for s_key in ['float_timing', 'int8_timing']:
+        dic_timing = dic_report[s_key]
+        print('{}: {:.1f} patches/s, batch latency p50 {:.1f} ms, p90 {:.1f} ms, p99 {:.1f} ms'.format(
+            s_key, dic_timing['patches_per_sec'], dic_timing['latency_ms_p50'], dic_timing['latency_ms_p90'],
+            dic_timing['latency_ms_p99']))
+    print('int8 speedup: x{:.2f}'.format(dic_report['speedup']))
+    if FLAGS.report_path:
+        with open(FLAGS.report_path, 'w') as f:
+            json.dump(dic_report, f, indent=2)
+
+if __name__ == '__main__':
+    tf.app.run()
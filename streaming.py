@@ -0,0 +1,317 @@
+"""
+Streaming anomaly detection over a tree of test videos.
+
+Frames are listed lazily and pass through a chain of stages (decode -> patch -> score -> write), each stage
+in its own thread and connected to the next one by a bounded queue, so decoding of frame i+2 and patching of
+frame i+1 overlap with scoring of frame i while memory stays bounded by the queue sizes.
+StreamingPipeline.run returns the per-frame latency percentiles and the sustained frames/sec.
+"""
+import os
+import threading
+import time
+from glob import glob
+
+import numpy as np
+from six.moves import queue
+
+from kh_tools import read_image, get_image_patches, AnomalyMapper
+
+# patches whose D output is below this are reported as anomalies (same threshold as test.process_frame)
+F_ANOMALY_THRESHOLD = 1e-30
+
+_END = object()
+
+
+def iter_frame_paths(s_dataset_dir, lst_video_dirs=None, s_video_pattern='Test[0-9][0-9][0-9]'):
+    """
+    Lazily yield (video name, frame path) for every frame of every video directory of s_dataset_dir, in order
+    :param lst_video_dirs: names of the video directories to keep, None for all of them
+    """
+    for s_video_dir in sorted(glob(os.path.join(s_dataset_dir, s_video_pattern))):
+        s_video = os.path.basename(s_video_dir)
+        if lst_video_dirs and s_video not in lst_video_dirs:
+            continue
+        for s_frame_path in sorted(glob(os.path.join(s_video_dir, '*'))):
+            yield s_video, s_frame_path
+
+
+class StreamingPipeline(object):
+    """
+    Runs items through lst_stages [(name, fn), ...] with one thread per stage and bounded queues in between.
+    The order of the items is kept. fn_sink, if given, gets the output of the last stage in the calling thread.
+    An exception in any stage stops the pipeline and is raised again by run.
+    With a metrics.MetricsRegistry, every frame also updates its frame counter, latency histogram and frames/sec.
+    """
+    def __init__(self, lst_stages, n_queue_size=8, registry=None):
+        self.lst_stages = list(lst_stages)
+        self.n_queue_size = n_queue_size
+        self.registry = registry
+        self.lst_latencies = []
+        self.dic_stage_times = {}
+
+    def _run_stage(self, s_name, fn, queue_in, queue_out, lst_errors):
+        f_busy = 0.
+        while True:
+            item = queue_in.get()
+            if item is _END:
+                break
+            if lst_errors:
+                # drain so that the upstream stages do not block on a full queue
+                continue
+            f_enter, payload = item
+            f_start = time.time()
+            try:
+                payload = fn(payload)
+            except Exception as e:
+                lst_errors.append(e)
+                continue
+            f_busy += time.time() - f_start
+            queue_out.put((f_enter, payload))
+        self.dic_stage_times[s_name] = f_busy
+        queue_out.put(_END)
+
+    def _feed(self, iter_inputs, queue_out, lst_errors):
+        try:
+            for payload in iter_inputs:
+                if lst_errors:
+                    break
+                queue_out.put((time.time(), payload))
+        except Exception as e:
+            lst_errors.append(e)
+        queue_out.put(_END)
+
+    def run(self, iter_inputs, fn_sink=None):
+        """
+        :return: dict with n_frames, frames_per_sec, the latency percentiles (sec, from the moment a frame is
+                 pulled from iter_inputs to the end of fn_sink) and the busy seconds of every stage
+        """
+        self.lst_latencies = []
+        self.dic_stage_times = {}
+        lst_errors = []
+        lst_queues = [queue.Queue(maxsize=self.n_queue_size) for _ in range(len(self.lst_stages) + 1)]
+
+        lst_threads = [threading.Thread(target=self._feed, args=(iter_inputs, lst_queues[0], lst_errors), name='stream-feed')]
+        for i, (s_name, fn) in enumerate(self.lst_stages):
+            lst_threads.append(threading.Thread(target=self._run_stage, name='stream-' + s_name,
+                                                args=(s_name, fn, lst_queues[i], lst_queues[i + 1], lst_errors)))
+        for thread in lst_threads:
+            thread.daemon = True
+            thread.start()
+
+        f_start = time.time()
+        f_sink_busy = 0.
+        if self.registry is not None:
+            counter_frames = self.registry.counter('stream_frames_total', 'Frames through the streaming pipeline')
+            hist_latency = self.registry.histogram('stream_latency_seconds', 'Per-frame latency of the streaming pipeline')
+            gauge_frames_per_sec = self.registry.gauge('stream_frames_per_second', 'Frames per second since the run started')
+        while True:
+            item = lst_queues[-1].get()
+            if item is _END:
+                break
+            if lst_errors:
+                continue
+            f_enter, payload = item
+            f_sink_start = time.time()
+            if fn_sink is not None:
+                try:
+                    fn_sink(payload)
+                except Exception as e:
+                    lst_errors.append(e)
+                    continue
+            f_sink_busy += time.time() - f_sink_start
+            self.lst_latencies.append(time.time() - f_enter)
+            if self.registry is not None:
+                counter_frames.inc()
+                hist_latency.observe(self.lst_latencies[-1])
+                gauge_frames_per_sec.set(len(self.lst_latencies) / max(time.time() - f_start, 1e-12))
+                self.registry.maybe_export(len(self.lst_latencies))
+        f_elapsed = time.time() - f_start
+
+        for thread in lst_threads:
+            thread.join()
+        if lst_errors:
+            raise lst_errors[0]
+
+        self.dic_stage_times['sink'] = f_sink_busy
+        return self.stats(f_elapsed)
+
+    def stats(self, f_elapsed):
+        nd_latencies = np.array(self.lst_latencies)
+        dic_stats = {'n_frames': len(nd_latencies), 'sec': f_elapsed,
+                     'frames_per_sec': len(nd_latencies) / max(f_elapsed, 1e-12),
+                     'stage_busy_sec': dict(self.dic_stage_times)}
+        for n_percentile in [50, 90, 99]:
+            dic_stats['latency_p%d' % n_percentile] = np.percentile(nd_latencies, n_percentile) if len(nd_latencies) else 0.
+        dic_stats['latency_max'] = nd_latencies.max() if len(nd_latencies) else 0.
+        return dic_stats
+
+
+class IncrementalScorer(object):
+    """
+    Keeps the last D of every patch location of a video and only rescores the locations whose pixels changed
+    by more than f_change_threshold (mean absolute difference, pixels in [0, 1]) since they were last scored.
+    Every n_refresh_every frames all locations are rescored. With b_measure_drift every frame is also fully
+    rescored to measure how far the kept scores are from full rescoring.
+
+    Batch-norm normalizes with the statistics of the scored batch, so a location rescored together with a few
+    others does not get exactly the score it would get in a full frame; the drift includes that effect.
+    """
+    def __init__(self, model, f_change_threshold=0.01, n_refresh_every=10, b_measure_drift=False):
+        self.model = model
+        self.f_change_threshold = f_change_threshold
+        self.n_refresh_every = n_refresh_every
+        self.b_measure_drift = b_measure_drift
+
+        self.n_patches = 0
+        self.n_scored = 0
+        self.n_frames = 0
+        self.n_refreshes = 0
+        self.f_drift_sum = 0.
+        self.f_drift_max = 0.
+        self.n_decision_flips = 0
+        self.reset()
+
+    def reset(self):
+        """
+        Forget the kept scores, the next frame is scored in full (call it when a new video starts)
+        """
+        self.s_key = None
+        self.nd_ref_patches = None
+        self.nd_scores = None
+        self.n_since_refresh = 0
+
+    def score(self, nd_patches, s_key=None):
+        """
+        :param nd_patches: (#locations, patch_h, patch_w) patches of one frame, same locations on every frame
+        :param s_key: video of the frame, the kept scores are dropped when it changes
+        :return: D of every location
+        """
+        if s_key != self.s_key or self.nd_scores is None or len(self.nd_scores) != len(nd_patches):
+            self.reset()
+            self.s_key = s_key
+
+        if self.nd_scores is None or self.n_since_refresh >= self.n_refresh_every:
+            nd_rescore = np.arange(len(nd_patches))
+            self.n_since_refresh = 0
+            self.n_refreshes += 1
+        else:
+            nd_change = np.abs(nd_patches - self.nd_ref_patches).mean(axis=(1, 2))
+            nd_rescore = np.nonzero(nd_change > self.f_change_threshold)[0]
+
+        if self.nd_scores is None:
+            self.nd_ref_patches = np.array(nd_patches, dtype=np.float32)
+            self.nd_scores = np.empty(len(nd_patches), dtype=np.float32)
+        if len(nd_rescore):
+            self.nd_scores[nd_rescore] = np.array(self.model.f_score_patches(nd_patches[nd_rescore])['D']).reshape(-1)
+            self.nd_ref_patches[nd_rescore] = nd_patches[nd_rescore]
+        self.n_since_refresh += 1
+
+        self.n_frames += 1
+        self.n_patches += len(nd_patches)
+        self.n_scored += len(nd_rescore)
+        if self.b_measure_drift:
+            nd_full = np.array(self.model.f_score_patches(nd_patches)['D']).reshape(-1)
+            nd_drift = np.abs(self.nd_scores - nd_full)
+            self.f_drift_sum += nd_drift.sum()
+            self.f_drift_max = max(self.f_drift_max, nd_drift.max())
+            self.n_decision_flips += np.count_nonzero((self.nd_scores < F_ANOMALY_THRESHOLD) != (nd_full < F_ANOMALY_THRESHOLD))
+        return self.nd_scores.copy()
+
+    def stats(self):
+        """
+        :return: dict with the skip rate (share of patch scorings saved) and, with b_measure_drift, the mean and max
+                 absolute D difference to full rescoring and the number of anomaly decisions that differ
+        """
+        dic_stats = {'n_frames': self.n_frames, 'n_refreshes': self.n_refreshes,
+                     'skip_rate': 1. - self.n_scored / max(self.n_patches, 1)}
+        if self.b_measure_drift:
+            dic_stats.update({'drift_mean': float(self.f_drift_sum) / max(self.n_patches, 1),
+                              'drift_max': float(self.f_drift_max), 'decision_flips': int(self.n_decision_flips)})
+        return dic_stats
+
+
+def build_detection_stages(model, b_whole_frame=False, f_threshold=F_ANOMALY_THRESHOLD, incremental_scorer=None,
+                           s_map_mode=None):
+    """
+    decode / patch / score (/ aggregate) stages for an ALOCC_Model (with build_frame_model called first if b_whole_frame).
+    Items start as (video, frame path) and end as a dict with the video, the path, the locations and D of every patch
+    and the locations of the anomalous ones.
+    :param incremental_scorer: IncrementalScorer that scores the patches instead of rescoring every location (patch mode only)
+    :param s_map_mode: add an aggregate stage that puts the anomalous regions of the s_map_mode per-pixel map
+                       (see kh_tools.AnomalyMapper) under 'regions', None for no aggregation
+    """
+    if b_whole_frame and incremental_scorer is not None:
+        raise ValueError('incremental scoring works on patches, not with the whole-frame model')
+
+    def decode(tpl_item):
+        s_video, s_frame_path = tpl_item
+        return {'video': s_video, 'path': s_frame_path, 'frame': read_image(s_frame_path)}
+
+    def patch(dic_item):
+        if not b_whole_frame:
+            nd_patches, lst_locations = get_image_patches([dic_item['frame']], model.patch_size, model.patch_step)
+            dic_item['patches'] = nd_patches[:, 0]
+            dic_item['locations'] = np.array(lst_locations)
+        return dic_item
+
+    def score(dic_item):
+        if b_whole_frame:
+            dic_results, dic_item['locations'] = model.f_score_frame(dic_item['frame'])
+            dic_item['D'] = np.array(dic_results['D']).reshape(-1)
+        elif incremental_scorer is not None:
+            dic_item['D'] = incremental_scorer.score(dic_item.pop('patches'), dic_item['video'])
+        else:
+            dic_item['D'] = np.array(model.f_score_patches(dic_item.pop('patches'))['D']).reshape(-1)
+        dic_item['frame_size'] = dic_item.pop('frame').shape[0:2]
+        dic_item['anomalies'] = dic_item['locations'][dic_item['D'] < f_threshold]
+        return dic_item
+
+    dic_mappers = {}
+
+    def aggregate(dic_item):
+        tpl_frame_size = dic_item['frame_size']
+        if tpl_frame_size not in dic_mappers:
+            dic_mappers[tpl_frame_size] = AnomalyMapper(tpl_frame_size, model.patch_size, model.patch_step)
+        _, dic_item['regions'] = dic_mappers[tpl_frame_size](dic_item['D'], s_map_mode, f_threshold)
+        return dic_item
+
+    lst_stages = [('decode', decode), ('patch', patch), ('score', score)]
+    if s_map_mode is not None:
+        lst_stages.append(('aggregate', aggregate))
+    return lst_stages
+
+
+class DetectionWriter(object):
+    """
+    Sink of the detection pipeline: one csv line per frame (video, frame, #patches, #anomalies, min D, #regions,
+    bounding boxes of the regions as start_h:start_w:end_h:end_w separated by spaces)
+    """
+    def __init__(self, s_output_path=None):
+        self.f = None
+        if s_output_path is not None:
+            s_output_dir = os.path.dirname(s_output_path)
+            if s_output_dir and not os.path.exists(s_output_dir):
+                os.makedirs(s_output_dir)
+            self.f = open(s_output_path, 'w')
+            self.f.write('video,frame,n_patches,n_anomalies,min_D,n_regions,regions\n')
+
+    def __call__(self, dic_item):
+        lst_regions = dic_item.get('regions', [])
+        s_line = '{},{},{},{},{:.6g},{},{}'.format(
+            dic_item['video'], os.path.basename(dic_item['path']), len(dic_item['D']), len(dic_item['anomalies']),
+            dic_item['D'].min(), len(lst_regions), ' '.join(':'.join(str(n) for n in dic_region['bbox'])
+                                                            for dic_region in lst_regions))
+        if self.f is not None:
+            self.f.write(s_line + '\n')
+        else:
+            print(s_line)
+
+    def close(self):
+        if self.f is not None:
+            self.f.close()
+
+
+def format_stats(dic_stats):
+    return '{} frames in {:.2f}s: {:.2f} frames/s, latency p50 {:.1f} ms, p90 {:.1f} ms, p99 {:.1f} ms'.format(
+        dic_stats['n_frames'], dic_stats['sec'], dic_stats['frames_per_sec'], 1e3 * dic_stats['latency_p50'],
+        1e3 * dic_stats['latency_p90'], 1e3 * dic_stats['latency_p99'])
@@ -1,12 +1,13 @@
 import tensorflow as tf
-from tensorflow.examples.tutorials.mnist import input_data
 from utils import pp, visualize, to_json, show_all_variables
 from models import ALOCC_Model
-import matplotlib.pyplot as plt
 from kh_tools import *
 import numpy as np
-import scipy.misc
 from utils import *
+from streaming import StreamingPipeline, DetectionWriter, IncrementalScorer, build_detection_stages, iter_frame_paths, \
+    format_stats, F_ANOMALY_THRESHOLD
+from metrics import MetricsRegistry
+from profiling import StepProfiler
 import time
 import os
 
@@ -26,9 +27,28 @@ flags.DEFINE_string("dataset", "UCSD", "The name of dataset [UCSD, mnist]")
 flags.DEFINE_string("dataset_address", "./dataset/UCSD_Anomaly_Dataset.v1p2/UCSDped2/Test", "The path of dataset")
 flags.DEFINE_string("input_fname_pattern", "*", "Glob pattern of filename of input images [*]")
 flags.DEFINE_string("checkpoint_dir", "./checkpoint_3/UCSD_128_45_45/", "Directory name to save the checkpoints [checkpoint]")
+flags.DEFINE_string("checkpoint_path", None, "Checkpoint prefix or weights-only .npz export to load, None for the latest checkpoint [None]")
 flags.DEFINE_string("log_dir", "log", "Directory name to save the log [log]")
 flags.DEFINE_string("sample_dir", "samples", "Directory name to save the image samples [samples]")
+flags.DEFINE_string("frame_store_dir", None, "Directory of the decoded-frame store, None to decode frames on every read [None]")
 flags.DEFINE_boolean("train", False, "True for training, False for testing [False]")
+flags.DEFINE_integer("score_batch_size", 1, "Number of patches scored per sess.run [1]")
+flags.DEFINE_boolean("whole_frame", False, "Score whole frames with the fully-convolutional model instead of cutting patches, needs --fold_batch_norm [False]")
+flags.DEFINE_boolean("streaming", False, "Stream every frame of the test videos through overlapped decode/patch/score/write stages [False]")
+flags.DEFINE_string("test_dirs", "", "Streaming: comma-separated video directories to score, empty for all of them")
+flags.DEFINE_integer("stream_queue_size", 8, "Streaming: frames buffered between two stages [8]")
+flags.DEFINE_string("stream_output", None, "Streaming: csv file of the per-frame results, None to print them [None]")
+flags.DEFINE_string("profile_dir", None, "Write op-level Chrome traces and time/memory tables of the scoring batches here [None]")
+flags.DEFINE_integer("profile_start_step", 0, "Profiling: first traced scoring batch [0]")
+flags.DEFINE_integer("profile_steps", 5, "Profiling: number of traced scoring batches [5]")
+flags.DEFINE_boolean("fold_batch_norm", False, "Score with batch-norm on the moving averages, folded into the conv/deconv weights, so scores do not depend on the batch [False]")
+flags.DEFINE_string("map_mode", "min", "How overlapping patch scores make the per-pixel anomaly map [min, mean, max]")
+flags.DEFINE_boolean("incremental", False, "Streaming: only rescore patch locations that changed since they were last scored [False]")
+flags.DEFINE_float("change_threshold", 0.01, "Incremental: mean absolute pixel change (in [0, 1]) that triggers a rescore [0.01]")
+flags.DEFINE_integer("refresh_every", 10, "Incremental: rescore every location after this many frames [10]")
+flags.DEFINE_boolean("measure_drift", False, "Incremental: also rescore every frame in full to report the score drift [False]")
+flags.DEFINE_string("metrics_dir", None, "Streaming: export frame counts, latency and frames/s to metrics.jsonl / metrics.prom here [None]")
+flags.DEFINE_float("metrics_export_secs", 30., "Streaming: export the metrics every n seconds [30]")
 
 FLAGS = flags.FLAGS
 
@@ -49,6 +69,9 @@ def check_some_assertions():
 def main(_):
     print('Program is started at', time.clock())
     pp.pprint(flags.FLAGS.__flags)
+    if FLAGS.whole_frame and not FLAGS.fold_batch_norm:
+        raise Exception("[!] --whole_frame scores with the batch-norm moving averages, add --fold_batch_norm so the "
+                        "patch path and the anomaly threshold use them too")
 
     n_per_itr_print_results = 100
     n_fetch_data = 180
@@ -84,7 +107,8 @@ def main(_):
     #FLAGS.input_fname_pattern = '*'
     FLAGS.train = False
     FLAGS.epoch = 1
-    FLAGS.batch_size = 1
+    # the graph accepts any batch size; unless batch-norm is folded it uses batch statistics, so scores depend on it
+    FLAGS.batch_size = FLAGS.score_batch_size
 
 
     gpu_options = tf.GPUOptions(per_process_gpu_memory_fraction=0.1)
@@ -112,16 +136,19 @@ def main(_):
                     n_per_itr_print_results=n_per_itr_print_results,
                     kb_work_on_patch=kb_work_on_patch,
                     nd_input_frame_size = nd_input_frame_size,
-                    n_fetch_data=n_fetch_data)
+                    n_fetch_data=n_fetch_data,
+                    s_frame_store_dir=FLAGS.frame_store_dir,
+                    b_fold_batch_norm=FLAGS.fold_batch_norm)
 
         show_all_variables()
 
 
         print('--------------------------------------------------')
         print('Load Pretrained Model...')
-        tmp_ALOCC_model.f_check_checkpoint()
+        tmp_ALOCC_model.f_check_checkpoint(FLAGS.checkpoint_path)
 
         if FLAGS.dataset=='mnist':
+            from tensorflow.examples.tutorials.mnist import input_data
             mnist = input_data.read_data_sets(FLAGS.dataset_address)
 
             specific_idx_anomaly = np.where(mnist.train.labels != 6)[0]
@@ -138,6 +165,10 @@ def main(_):
             exit()
             #generated_data = tmp_ALOCC_model.feed2generator(data[0:FLAGS.batch_size])
 
+        if FLAGS.streaming:
+            stream_test_dirs(tmp_ALOCC_model, FLAGS.dataset_address)
+            return
+
         # else in UCDS (depends on infrustructure)
         tmp_lst_image_paths = []
         for s_image_dirs in sorted(glob(os.path.join(FLAGS.dataset_address, 'Test[0-9][0-9][0-9]'))):
@@ -159,32 +190,87 @@ def main(_):
         #images =read_lst_images(lst_image_paths,nd_patch_size,nd_patch_step,b_work_on_patch=False)
         images = read_lst_images_without_noise2(lst_image_paths, nd_patch_size, nd_patch_step)
 
-        lst_prob = process_frame(images,tmp_ALOCC_model)
+        if FLAGS.whole_frame:
+            tmp_ALOCC_model.build_frame_model(images.shape[1:3])
+        profiler = None
+        if FLAGS.profile_dir:
+            profiler = StepProfiler(FLAGS.profile_dir, sess.graph, FLAGS.profile_start_step, FLAGS.profile_steps)
+        lst_prob = process_frame(images,tmp_ALOCC_model,b_whole_frame=FLAGS.whole_frame,profiler=profiler)
+        if profiler is not None:
+            profiler.write_summary()
 
         print('pseudocode test is finished')
 
             # This code for just check output for readers
             # ...
 
-def process_frame(frames_src,sess):
-    nd_patch,nd_location = get_image_patches(frames_src,sess.patch_size,sess.patch_step)
-
-    print(np.array(nd_patch).shape)
-
-    frame_patches = nd_patch.transpose([1,0,2,3])
-    print('frame patches :{}\npatches size:{}'.format(len(frame_patches[0]),(frame_patches.shape[2],frame_patches.shape[3])))
-
-    lst_prob = sess.f_test_frozen_model(frame_patches)
-    lst_prob = np.array(lst_prob).reshape((-1))
-    print(list(nd_location))
-    print(list(lst_prob))
-    count=0
-    lst_anomaly=[]
-    for i in nd_location:
-        if lst_prob[count]<1e-30:
-            lst_anomaly.append(i)
-        count+=1
-    print(lst_anomaly)
+def stream_test_dirs(model, s_dataset_dir):
+    """
+    Score every frame of the test videos with the streaming pipeline (see streaming.py) and report its throughput
+    """
+    lst_video_dirs = [s for s in FLAGS.test_dirs.split(',') if s]
+    if FLAGS.whole_frame:
+        s_video, s_frame_path = next(iter_frame_paths(s_dataset_dir, lst_video_dirs))
+        model.build_frame_model(read_image(s_frame_path).shape)
+
+    incremental_scorer = None
+    if FLAGS.incremental:
+        incremental_scorer = IncrementalScorer(model, FLAGS.change_threshold, FLAGS.refresh_every, FLAGS.measure_drift)
+
+    registry = None
+    if FLAGS.metrics_dir:
+        registry = MetricsRegistry(os.path.join(FLAGS.metrics_dir, 'metrics.jsonl'),
+                                   os.path.join(FLAGS.metrics_dir, 'metrics.prom'), FLAGS.metrics_export_secs)
+
+    pipeline = StreamingPipeline(build_detection_stages(model, FLAGS.whole_frame, incremental_scorer=incremental_scorer,
+                                                        s_map_mode=FLAGS.map_mode),
+                                 FLAGS.stream_queue_size, registry)
+    writer = DetectionWriter(FLAGS.stream_output)
+    try:
+        dic_stats = pipeline.run(iter_frame_paths(s_dataset_dir, lst_video_dirs), writer)
+    finally:
+        writer.close()
+        if registry is not None:
+            registry.close()
+    print(format_stats(dic_stats))
+    print('stage busy time (s): {}'.format(dic_stats['stage_busy_sec']))
+    if incremental_scorer is not None:
+        dic_stats['incremental'] = incremental_scorer.stats()
+        print('incremental scoring: {}'.format(dic_stats['incremental']))
+    return dic_stats
+
+def process_frame(frames_src,sess,b_whole_frame=False,profiler=None):
+    if b_whole_frame:
+        # one run of the fully-convolutional model per frame (see ALOCC_Model.build_frame_model)
+        lst_prob = []
+        for frame in frames_src:
+            dic_results, nd_location = sess.f_score_frame(frame)
+            lst_prob.append(dic_results['D'])
+        lst_prob = np.concatenate(lst_prob)
+        nd_location = nd_location.tolist()
+    else:
+        nd_patch,nd_location = get_image_patches(frames_src,sess.patch_size,sess.patch_step)
+
+        print(np.array(nd_patch).shape)
+
+        frame_patches = nd_patch.transpose([1,0,2,3])
+        print('frame patches :{}\npatches size:{}'.format(len(frame_patches[0]),(frame_patches.shape[2],frame_patches.shape[3])))
+
+        lst_prob = sess.f_test_frozen_model(frame_patches, profiler)
+    # one row of D per frame, one anomaly map and region list per frame
+    nd_prob = np.array(lst_prob).reshape((-1, len(nd_location)))
+    nd_location = np.array(nd_location)
+    mapper = AnomalyMapper(np.array(frames_src).shape[1:3], sess.patch_size, sess.patch_step)
+    lst_anomaly = []
+    lst_regions = []
+    for n_frame, nd_frame_prob in enumerate(nd_prob):
+        nd_map, lst_frame_regions = mapper(nd_frame_prob, FLAGS.map_mode, F_ANOMALY_THRESHOLD)
+        lst_anomaly.append(nd_location[nd_frame_prob < F_ANOMALY_THRESHOLD])
+        lst_regions.append(lst_frame_regions)
+        print('frame {}: {} patches, {} anomalous, min D {:.6g}, regions {}'.format(
+            n_frame, len(nd_frame_prob), len(lst_anomaly[-1]), nd_frame_prob.min(),
+            [dic_region['bbox'] for dic_region in lst_frame_regions]))
+    return lst_anomaly, lst_regions
     #  This code for just check output for readers
     # ...
 
@@ -0,0 +1,54 @@
+"""
+fold_batch_norm: a conv/deconv with the folded weights gives the conv/deconv followed by the
+inference-mode batch_norm. The reference ops are the numpy ones of numpy_engine.
+"""
+import numpy as np
+import pytest
+
+from numpy_engine import batch_norm, conv2d, deconv2d, fold_batch_norm
+
+
+def _bn_values(rng, n_channels):
+    return {'gamma': rng.uniform(0.5, 2., n_channels), 'beta': rng.randn(n_channels),
+            'moving_mean': rng.randn(n_channels), 'moving_variance': rng.uniform(0.1, 3., n_channels)}
+
+
+@pytest.mark.parametrize('s_padding', ['VALID', 'SAME'])
+def test_fold_conv2d(s_padding):
+    rng = np.random.RandomState(0)
+    x = rng.randn(2, 9, 9, 3)
+    w = rng.randn(5, 5, 3, 4)
+    biases = rng.randn(4)
+    dic_bn = _bn_values(rng, 4)
+
+    nd_expected = batch_norm(conv2d(x, w, biases, s_padding), dic_bn, s_mode='moving')
+    w_folded, biases_folded = fold_batch_norm(w, biases, n_output_axis=3, **dic_bn)
+    np.testing.assert_allclose(conv2d(x, w_folded, biases_folded, s_padding), nd_expected, rtol=1e-10, atol=1e-10)
+
+
+@pytest.mark.parametrize('s_padding', ['VALID', 'SAME'])
+def test_fold_deconv2d(s_padding):
+    rng = np.random.RandomState(1)
+    x = rng.randn(2, 7, 7, 4)
+    w = rng.randn(5, 5, 3, 4)
+    biases = rng.randn(3)
+    dic_bn = _bn_values(rng, 3)
+
+    nd_expected = batch_norm(deconv2d(x, w, biases, s_padding), dic_bn, s_mode='moving')
+    w_folded, biases_folded = fold_batch_norm(w, biases, n_output_axis=2, **dic_bn)
+    np.testing.assert_allclose(deconv2d(x, w_folded, biases_folded, s_padding), nd_expected, rtol=1e-10, atol=1e-10)
+
+
+def test_fold_keeps_dtype():
+    rng = np.random.RandomState(2)
+    w = rng.randn(5, 5, 1, 2).astype(np.float32)
+    biases = np.zeros(2, np.float32)
+    w_folded, biases_folded = fold_batch_norm(w, biases, **_bn_values(rng, 2))
+    assert w_folded.dtype == np.float32 and biases_folded.dtype == np.float32
+
+
+def test_ops_fold_batch_norm():
+    # the graph code folds the checkpoint values with the same function
+    pytest.importorskip('tensorflow')
+    import ops
+    assert ops.fold_batch_norm is fold_batch_norm
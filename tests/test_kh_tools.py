@@ -0,0 +1,175 @@
+"""
+kh_tools: patch extraction against the original while-loop version, anomaly maps against a per-pixel loop,
+parallel and uint8 readers against the serial float readers.
+"""
+import os
+
+import numpy as np
+import pytest
+
+import kh_tools
+
+
+def _get_image_patches_loop(image_src, nd_patch_size, nd_stride):
+    # the while-loop get_image_patches that the strided version replaced
+    image_src = np.array(image_src)
+    n_frame_h, n_frame_w = image_src[0].shape[0:2]
+    lst_patches = []
+    lst_locations = []
+    i = 0
+    b_continue_h = True
+    while i < n_frame_h and b_continue_h:
+        start_h = min(i, n_frame_h - nd_patch_size[0])
+        j = 0
+        b_continue_w = True
+        while j < n_frame_w and b_continue_w:
+            start_w = min(j, n_frame_w - nd_patch_size[1])
+            lst_patches.append(np.array(image_src[:, start_h:start_h + nd_patch_size[0], start_w:start_w + nd_patch_size[1]]))
+            lst_locations.append([start_h, start_w])
+            j += nd_stride[1]
+            if j > n_frame_w:
+                b_continue_w = False
+        i += nd_stride[0]
+        if i > n_frame_h:
+            b_continue_h = False
+    return np.array(lst_patches), lst_locations
+
+
+@pytest.mark.parametrize('nd_frame_size, nd_patch_size, nd_stride', [
+    ((140, 360), (45, 45), (10, 10)),
+    ((140, 360), (45, 45), (25, 25)),
+    ((28, 28), (28, 28), (28, 28)),
+    ((50, 61), (9, 12), (7, 5)),
+    ((45, 90), (45, 45), (45, 45)),
+])
+def test_get_image_patches(nd_frame_size, nd_patch_size, nd_stride):
+    nd_frames = np.random.RandomState(0).uniform(0, 1, (3,) + nd_frame_size)
+    nd_patches, lst_locations = kh_tools.get_image_patches(nd_frames, nd_patch_size, nd_stride)
+    nd_expected, lst_expected = _get_image_patches_loop(nd_frames, nd_patch_size, nd_stride)
+    assert lst_locations == lst_expected
+    assert nd_patches.shape == nd_expected.shape
+    np.testing.assert_array_equal(nd_patches, nd_expected)
+
+
+def test_get_image_patches_channels_and_uint8():
+    nd_frames = np.random.RandomState(1).randint(0, 256, (2, 30, 40, 3)).astype(np.uint8)
+    nd_patches, lst_locations = kh_tools.get_image_patches(nd_frames, (10, 10), (8, 8))
+    nd_expected, lst_expected = _get_image_patches_loop(nd_frames, (10, 10), (8, 8))
+    assert lst_locations == lst_expected
+    assert nd_patches.dtype == np.uint8
+    np.testing.assert_array_equal(nd_patches, nd_expected)
+
+
+def test_get_image_patches_view():
+    nd_frames = np.random.RandomState(2).uniform(0, 1, (2, 50, 60))
+    nd_windows, nd_locations = kh_tools.get_image_patches_view(nd_frames, (20, 20), (15, 15))
+    nd_patches, lst_locations = kh_tools.get_image_patches(nd_frames, (20, 20), (15, 15))
+    assert nd_locations.tolist() == lst_locations
+    assert not nd_windows.flags.writeable
+    for k, (n_h, n_w) in enumerate(lst_locations):
+        np.testing.assert_array_equal(nd_windows[:, n_h, n_w], nd_patches[k])
+
+
+def test_get_patch_locations_cached():
+    nd_locations = kh_tools.get_patch_locations((140, 360), (45, 45), (10, 10))
+    assert kh_tools.get_patch_locations(np.array([140, 360]), [45, 45], (10, 10)) is nd_locations
+    assert not nd_locations.flags.writeable
+
+
+def _anomaly_map_loop(nd_frame_size, nd_locations, nd_patch_size, nd_scores, fn_reduce):
+    # every pixel reduces the scores of the distinct patches covering it
+    nd_map = np.full(nd_frame_size, np.nan, dtype=np.float32)
+    dic_patches = {}
+    for (n_h, n_w), f_score in zip(nd_locations.tolist(), nd_scores):
+        dic_patches.setdefault((n_h, n_w), f_score)
+    for y in range(nd_frame_size[0]):
+        for x in range(nd_frame_size[1]):
+            lst_scores = [f_score for (n_h, n_w), f_score in dic_patches.items()
+                          if n_h <= y < n_h + nd_patch_size[0] and n_w <= x < n_w + nd_patch_size[1]]
+            if lst_scores:
+                nd_map[y, x] = fn_reduce(lst_scores)
+    return nd_map
+
+
+@pytest.mark.parametrize('s_mode, fn_reduce', [('mean', np.mean), ('max', np.max), ('min', np.min)])
+@pytest.mark.parametrize('nd_frame_size, nd_patch_size, nd_stride', [
+    ((40, 70), (15, 15), (10, 10)),
+    ((30, 33), (8, 5), (10, 7)),
+])
+def test_anomaly_mapper_map(s_mode, fn_reduce, nd_frame_size, nd_patch_size, nd_stride):
+    mapper = kh_tools.AnomalyMapper(nd_frame_size, nd_patch_size, nd_stride)
+    nd_locations = kh_tools.get_patch_locations(nd_frame_size, nd_patch_size, nd_stride)
+    nd_scores = np.random.RandomState(3).uniform(0, 1, len(nd_locations)).astype(np.float32)
+    np.testing.assert_allclose(mapper.map(nd_scores, s_mode),
+                               _anomaly_map_loop(nd_frame_size, nd_locations, nd_patch_size, nd_scores, fn_reduce),
+                               rtol=1e-5, atol=1e-6)
+
+
+def test_anomaly_mapper_regions():
+    pytest.importorskip('scipy')
+    mapper = kh_tools.AnomalyMapper((40, 70), (15, 15), (10, 10))
+    nd_map = np.ones((40, 70), np.float32)
+    nd_map[2:5, 3:9] = 0.1
+    nd_map[30:40, 60:70] = 0.05
+    lst_regions = sorted(mapper.regions(nd_map, f_threshold=0.5), key=lambda dic_region: dic_region['bbox'])
+    assert lst_regions == [{'bbox': (2, 3, 5, 9), 'area': 18, 'score': pytest.approx(0.1)},
+                           {'bbox': (30, 60, 40, 70), 'area': 100, 'score': pytest.approx(0.05)}]
+
+
+@pytest.fixture
+def lst_frame_paths(tmp_path, monkeypatch):
+    # frames are served by a FrameStore (spawned reader workers get it too), the files only have to exist
+    lst_paths = []
+    for i in range(5):
+        s_path = str(tmp_path / 'Train001' / '{:03d}.tif'.format(i))
+        os.makedirs(os.path.dirname(s_path), exist_ok=True)
+        with open(s_path, 'w') as f:
+            f.write(str(i))
+        lst_paths.append(s_path)
+    monkeypatch.setattr(kh_tools, 'read_image_crop', lambda s_path, nd_crop=None: np.random.RandomState(
+        int(os.path.basename(s_path)[:3])).randint(0, 256, (40, 70)).astype(np.uint8))
+    kh_tools.set_frame_store(kh_tools.FrameStore(str(tmp_path / 'store'), lst_paths))
+    yield lst_paths
+    kh_tools.set_frame_store(None)
+
+
+@pytest.mark.parametrize('n_workers', [1, 2])
+def test_read_lst_images_parallel(lst_frame_paths, n_workers):
+    lst_expected, lst_expected_locations = kh_tools.read_lst_images(lst_frame_paths, (15, 15), (10, 10))
+    nd_slices, lst_locations = kh_tools.read_lst_images_parallel(lst_frame_paths, (15, 15), (10, 10), n_workers=n_workers,
+                                                                 n_chunksize=2)
+    assert lst_locations == lst_expected_locations
+    np.testing.assert_array_equal(nd_slices, np.array(lst_expected))
+
+    nd_frames = kh_tools.read_lst_images_parallel(lst_frame_paths, None, None, b_work_on_patch=False, n_workers=n_workers)
+    np.testing.assert_array_equal(nd_frames, kh_tools.read_lst_images(lst_frame_paths, None, None, b_work_on_patch=False))
+
+
+def test_read_lst_images_w_noise_parallel(lst_frame_paths):
+    nd_frames = kh_tools.read_lst_images(lst_frame_paths, None, None, b_work_on_patch=False)
+    nd_noisy = kh_tools.read_lst_images_w_noise2_parallel(lst_frame_paths, None, None, n_workers=1, n_seed=7)
+    # the noise only depends on the seed, not on the number of workers
+    np.testing.assert_array_equal(
+        kh_tools.read_lst_images_w_noise2_parallel(lst_frame_paths, None, None, n_workers=2, n_seed=7), nd_noisy)
+    assert nd_noisy.shape == nd_frames.shape and nd_noisy.min() >= 0. and nd_noisy.max() <= 1.
+    nd_inside = (nd_noisy > 0.) & (nd_noisy < 1.)
+    assert abs((nd_noisy - nd_frames)[nd_inside].std() - 0.155) < 0.02
+
+    nd_slices, lst_locations = kh_tools.read_lst_images_w_noise_parallel(lst_frame_paths, (15, 15), (10, 10), n_workers=2,
+                                                                         n_seed=7)
+    nd_expected, lst_expected = kh_tools.get_image_patches(nd_noisy, (15, 15), (10, 10))
+    assert lst_locations == lst_expected * len(lst_frame_paths)
+    np.testing.assert_array_equal(nd_slices.reshape(len(lst_frame_paths), -1, 1, 15, 15)[:, :, 0],
+                                  nd_expected.transpose(1, 0, 2, 3))
+
+
+@pytest.mark.parametrize('n_workers', [1, 2])
+def test_read_lst_patches_uint8(lst_frame_paths, n_workers):
+    lst_expected, lst_expected_locations = kh_tools.read_lst_images(lst_frame_paths, (15, 15), (10, 10))
+    nd_patches, lst_locations = kh_tools.read_lst_patches_uint8(lst_frame_paths, (15, 15), (10, 10), n_workers=n_workers,
+                                                                n_chunksize=2)
+    assert nd_patches.dtype == np.uint8
+    assert lst_locations == lst_expected_locations
+    nd_float = kh_tools.to_float_images(nd_patches)
+    assert nd_float.dtype == np.float32
+    np.testing.assert_allclose(nd_float, np.array(lst_expected)[:, 0], rtol=1e-6)
@@ -0,0 +1,115 @@
+"""
+metrics: histogram statistics against numpy, and the JSONL / Prometheus text exports of MetricsRegistry.
+"""
+import json
+import threading
+
+import numpy as np
+import pytest
+
+from metrics import MetricsRegistry
+
+LST_BUCKETS = [0.1, 0.5, 1., 5.]
+
+
+def _quantile_loop(nd_values, f_q):
+    # smallest bucket bound holding at least f_q of the values, the max when only the overflow bucket does
+    for f_bound in LST_BUCKETS:
+        if np.count_nonzero(nd_values <= f_bound) >= f_q * len(nd_values):
+            return f_bound
+    return nd_values.max()
+
+
+def test_histogram():
+    nd_values = np.random.RandomState(0).exponential(1., 500)
+    histogram = MetricsRegistry().histogram('latency', lst_buckets=LST_BUCKETS)
+    for f_value in nd_values:
+        histogram.observe(f_value)
+
+    dic_snapshot = histogram.snapshot()
+    assert dic_snapshot['count'] == 500
+    assert dic_snapshot['sum'] == pytest.approx(nd_values.sum())
+    assert dic_snapshot['mean'] == pytest.approx(nd_values.mean())
+    assert (dic_snapshot['min'], dic_snapshot['max']) == (nd_values.min(), nd_values.max())
+    dic_expected = {str(f_bound): int(np.count_nonzero(nd_values <= f_bound)) for f_bound in LST_BUCKETS}
+    assert dic_snapshot['buckets'] == dict(dic_expected, **{'+Inf': 500})
+    for f_q, s_key in [(0.5, 'p50'), (0.9, 'p90'), (0.99, 'p99')]:
+        assert dic_snapshot[s_key] == _quantile_loop(nd_values, f_q)
+        assert histogram.quantile(f_q) == dic_snapshot[s_key]
+
+
+def test_empty_histogram():
+    dic_snapshot = MetricsRegistry().histogram('latency').snapshot()
+    assert dic_snapshot['count'] == 0
+    assert np.isnan(dic_snapshot['mean']) and np.isnan(dic_snapshot['p90'])
+
+
+def test_registry_types():
+    registry = MetricsRegistry()
+    assert registry.counter('frames') is registry.counter('frames')
+    with pytest.raises(ValueError):
+        registry.gauge('frames')
+
+
+def test_concurrent_updates():
+    registry = MetricsRegistry()
+    counter = registry.counter('frames')
+    histogram = registry.histogram('latency', lst_buckets=LST_BUCKETS)
+
+    def fn_update():
+        for _ in range(5000):
+            counter.inc()
+            histogram.observe(0.3)
+    lst_threads = [threading.Thread(target=fn_update) for _ in range(4)]
+    for thread in lst_threads:
+        thread.start()
+    while any(thread.is_alive() for thread in lst_threads):
+        dic_snapshot = registry.snapshot()['latency']
+        # an export never sees half an update
+        assert dic_snapshot['buckets']['+Inf'] == dic_snapshot['count']
+        assert dic_snapshot['sum'] == pytest.approx(0.3 * dic_snapshot['count'])
+    for thread in lst_threads:
+        thread.join()
+    assert registry.snapshot()['frames'] == 20000
+    assert registry.snapshot()['latency']['count'] == 20000
+
+
+def test_export(tmp_path):
+    s_jsonl_path = str(tmp_path / 'log' / 'metrics.jsonl')
+    s_prometheus_path = str(tmp_path / 'log' / 'metrics.prom')
+    registry = MetricsRegistry(s_jsonl_path, s_prometheus_path, f_export_secs=1e9)
+    registry.counter('frames_total', 'Frames scored').inc(3)
+    registry.gauge('g_loss').set(0.25)
+    histogram = registry.histogram('step_seconds', 'Step time', lst_buckets=[0.1, 1.])
+    for f_value in [0.05, 0.5, 2.]:
+        histogram.observe(f_value)
+
+    assert not registry.maybe_export(1)
+    registry.export(7)
+    registry.counter('frames_total').inc()
+    registry.close(8)
+
+    with open(s_jsonl_path) as f:
+        lst_records = [json.loads(s_line) for s_line in f]
+    assert [dic_record['step'] for dic_record in lst_records] == [7, 8]
+    assert [dic_record['metrics']['frames_total'] for dic_record in lst_records] == [3, 4]
+    assert lst_records[0]['metrics']['g_loss'] == 0.25
+    assert lst_records[0]['metrics']['step_seconds']['buckets'] == {'0.1': 1, '1.0': 2, '+Inf': 3}
+
+    with open(s_prometheus_path) as f:
+        s_text = f.read()
+    assert s_text == '\n'.join([
+        '# HELP alocc_frames_total Frames scored',
+        '# TYPE alocc_frames_total counter',
+        'alocc_frames_total 4.0',
+        '# TYPE alocc_g_loss gauge',
+        'alocc_g_loss 0.25',
+        '# HELP alocc_step_seconds Step time',
+        '# TYPE alocc_step_seconds histogram',
+        'alocc_step_seconds_bucket{le="0.1"} 1',
+        'alocc_step_seconds_bucket{le="1.0"} 2',
+        'alocc_step_seconds_bucket{le="+Inf"} 3',
+        'alocc_step_seconds_sum 2.55',
+        'alocc_step_seconds_count 3',
+    ]) + '\n'
+    assert registry.format_line(['g_loss', 'step_seconds', 'missing']) == 'g_loss: 0.25, step_seconds: 0.85 (p90 2)'
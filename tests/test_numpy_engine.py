@@ -0,0 +1,114 @@
+"""
+numpy_engine: im2col convolutions against direct loops, and the checkpoint reader on the checkpoint of the repository.
+"""
+import os
+import shutil
+
+import numpy as np
+import pytest
+
+import numpy_engine
+
+S_CHECKPOINT_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'checkpoint', 'UCSD_128_45_45')
+
+
+def _conv2d_loop(x, w, biases, s_padding):
+    n_kh, n_kw, _, n_out = w.shape
+    if s_padding == 'SAME':
+        x = np.pad(x, [(0, 0), ((n_kh - 1) // 2, n_kh // 2), ((n_kw - 1) // 2, n_kw // 2), (0, 0)], 'constant')
+    n_batch, n_h, n_w, _ = x.shape
+    output = np.zeros((n_batch, n_h - n_kh + 1, n_w - n_kw + 1, n_out))
+    for i in range(output.shape[1]):
+        for j in range(output.shape[2]):
+            output[:, i, j] = np.tensordot(x[:, i:i + n_kh, j:j + n_kw], w, axes=3)
+    return output + biases
+
+
+def _deconv2d_loop(x, w, biases, s_padding):
+    # every input pixel adds its filter-weighted copy to the output, SAME crops the VALID output
+    n_kh, n_kw, n_out, _ = w.shape
+    n_batch, n_h, n_w, _ = x.shape
+    output = np.zeros((n_batch, n_h + n_kh - 1, n_w + n_kw - 1, n_out))
+    for i in range(n_h):
+        for j in range(n_w):
+            output[:, i:i + n_kh, j:j + n_kw] += np.einsum('nc,hwoc->nhwo', x[:, i, j], w)
+    if s_padding == 'SAME':
+        output = output[:, (n_kh - 1) // 2:(n_kh - 1) // 2 + n_h, (n_kw - 1) // 2:(n_kw - 1) // 2 + n_w]
+    return output + biases
+
+
+@pytest.mark.parametrize('s_padding', ['VALID', 'SAME'])
+@pytest.mark.parametrize('tpl_kernel', [(5, 5), (4, 3)])
+def test_conv2d(s_padding, tpl_kernel):
+    rng = np.random.RandomState(0)
+    x = rng.randn(3, 11, 10, 2)
+    w = rng.randn(tpl_kernel[0], tpl_kernel[1], 2, 4)
+    biases = rng.randn(4)
+    np.testing.assert_allclose(numpy_engine.conv2d(x, w, biases, s_padding), _conv2d_loop(x, w, biases, s_padding),
+                               rtol=1e-10, atol=1e-10)
+
+
+def test_conv2d_chunks():
+    # a chunk budget smaller than one sample still gives the whole batch
+    rng = np.random.RandomState(1)
+    x = rng.randn(5, 9, 9, 2)
+    w = rng.randn(5, 5, 2, 3)
+    biases = rng.randn(3)
+    np.testing.assert_allclose(numpy_engine.conv2d(x, w, biases, 'SAME', n_max_chunk_bytes=1),
+                               _conv2d_loop(x, w, biases, 'SAME'), rtol=1e-10, atol=1e-10)
+
+
+@pytest.mark.parametrize('s_padding', ['VALID', 'SAME'])
+@pytest.mark.parametrize('tpl_kernel', [(5, 5), (4, 3)])
+def test_deconv2d(s_padding, tpl_kernel):
+    rng = np.random.RandomState(2)
+    x = rng.randn(3, 7, 8, 4)
+    w = rng.randn(tpl_kernel[0], tpl_kernel[1], 2, 4)
+    biases = rng.randn(2)
+    np.testing.assert_allclose(numpy_engine.deconv2d(x, w, biases, s_padding), _deconv2d_loop(x, w, biases, s_padding),
+                               rtol=1e-10, atol=1e-10)
+
+
+def test_latest_checkpoint(tmp_path):
+    assert numpy_engine.latest_checkpoint(S_CHECKPOINT_DIR) == os.path.join(S_CHECKPOINT_DIR, 'ALOCC_Model.model-5')
+    assert numpy_engine.latest_checkpoint(str(tmp_path)) is None
+
+
+def test_bundle_reader_index():
+    reader = numpy_engine.BundleReader(os.path.join(S_CHECKPOINT_DIR, 'ALOCC_Model.model-1'))
+    assert reader.n_shards == 1
+    assert reader.dic_entries['discriminator/d_h0_conv/w']['shape'] == (5, 5, 1, 16)
+    assert reader.dic_entries['discriminator/d_bn1/moving_mean']['shape'] == (32,)
+    for s_name in reader.names():
+        dic_entry = reader.dic_entries[s_name]
+        assert dic_entry['size'] == int(np.prod(dic_entry['shape'])) * np.dtype(dic_entry['dtype']).itemsize
+
+
+def test_bundle_reader_values(tmp_path):
+    # the repository ships the .index files only, write a data shard matching the offsets of the index
+    s_prefix = str(tmp_path / 'ALOCC_Model.model-1')
+    shutil.copy(os.path.join(S_CHECKPOINT_DIR, 'ALOCC_Model.model-1.index'), s_prefix + '.index')
+    reader = numpy_engine.BundleReader(s_prefix)
+    n_total = max(dic_entry['offset'] + dic_entry['size'] for dic_entry in reader.dic_entries.values())
+    buffer = bytearray(n_total)
+    rng = np.random.RandomState(3)
+    dic_expected = {}
+    for s_name in ['discriminator/d_h0_conv/w', 'discriminator/d_bn1/gamma']:
+        dic_entry = reader.dic_entries[s_name]
+        dic_expected[s_name] = rng.randn(*dic_entry['shape']).astype(np.dtype(dic_entry['dtype']).newbyteorder('<'))
+        buffer[dic_entry['offset']:dic_entry['offset'] + dic_entry['size']] = dic_expected[s_name].tobytes()
+    with open(s_prefix + '.data-00000-of-00001', 'wb') as f:
+        f.write(bytes(buffer))
+
+    for s_name, nd_expected in dic_expected.items():
+        np.testing.assert_array_equal(reader.get_tensor(s_name), nd_expected)
+    dic_values = numpy_engine.read_values(s_prefix, fn_keep=lambda s_name: s_name in dic_expected)
+    assert sorted(dic_values) == sorted(dic_expected)
+
+
+def test_read_values_npz(tmp_path):
+    s_path = str(tmp_path / 'weights.npz')
+    np.savez(s_path, **{'discriminator/d_h0_conv/w': np.ones((5, 5, 1, 16), np.float32), 'g': np.zeros(2)})
+    dic_values = numpy_engine.read_values(s_path, fn_keep=lambda s_name: s_name.startswith('discriminator/'))
+    assert list(dic_values) == ['discriminator/d_h0_conv/w']
+    assert dic_values['discriminator/d_h0_conv/w'].shape == (5, 5, 1, 16)
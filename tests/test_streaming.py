@@ -0,0 +1,134 @@
+"""
+streaming: order and error propagation of StreamingPipeline, and the rescoring decisions of IncrementalScorer.
+"""
+import os
+import time
+
+import numpy as np
+import pytest
+
+pytest.importorskip('six')
+import streaming  # noqa: E402
+from metrics import MetricsRegistry  # noqa: E402
+
+
+def _sleep_then(fn):
+    # uneven stage times, so that the stages run out of step
+    def fn_stage(n_item):
+        time.sleep(0.002 * (n_item % 3))
+        return fn(n_item)
+    return fn_stage
+
+
+def test_pipeline_keeps_order():
+    lst_out = []
+    pipeline = streaming.StreamingPipeline([('double', _sleep_then(lambda n: 2 * n)), ('inc', _sleep_then(lambda n: n + 1))],
+                                           n_queue_size=2)
+    dic_stats = pipeline.run(iter(range(50)), lst_out.append)
+    assert lst_out == [2 * n + 1 for n in range(50)]
+    assert dic_stats['n_frames'] == 50
+    assert sorted(dic_stats['stage_busy_sec']) == ['double', 'inc', 'sink']
+    assert 0 <= dic_stats['latency_p50'] <= dic_stats['latency_p99'] <= dic_stats['latency_max']
+
+
+def test_pipeline_registry():
+    registry = MetricsRegistry(f_export_secs=1e9)
+    streaming.StreamingPipeline([('id', lambda n: n)], registry=registry).run(iter(range(20)))
+    dic_snapshot = registry.snapshot()
+    assert dic_snapshot['stream_frames_total'] == 20
+    assert dic_snapshot['stream_latency_seconds']['count'] == 20
+
+
+def _fail_at(n_fail):
+    def fn(n_item):
+        if n_item == n_fail:
+            raise ValueError('item {}'.format(n_item))
+        return n_item
+    return fn
+
+
+@pytest.mark.parametrize('n_stage', [0, 1])
+def test_pipeline_stage_error(n_stage):
+    lst_stages = [('a', lambda n: n), ('b', lambda n: n)]
+    lst_stages[n_stage] = (lst_stages[n_stage][0], _fail_at(5))
+    # small queues: the other stages must not stay blocked on a full queue after the error
+    with pytest.raises(ValueError, match='item 5'):
+        streaming.StreamingPipeline(lst_stages, n_queue_size=1).run(iter(range(1000)))
+
+
+def test_pipeline_sink_error():
+    with pytest.raises(ValueError, match='item 3'):
+        streaming.StreamingPipeline([('a', lambda n: n)], n_queue_size=1).run(iter(range(1000)), _fail_at(3))
+
+
+def test_pipeline_input_error():
+    def iter_inputs():
+        yield 0
+        yield 1
+        raise IOError('listing failed')
+    lst_out = []
+    with pytest.raises(IOError, match='listing failed'):
+        streaming.StreamingPipeline([('a', lambda n: n)]).run(iter_inputs(), lst_out.append)
+
+
+def test_iter_frame_paths(tmp_path):
+    for s_video in ['Test002', 'Test001', 'Train001']:
+        for s_frame in ['002.tif', '001.tif']:
+            os.makedirs(str(tmp_path / s_video), exist_ok=True)
+            open(str(tmp_path / s_video / s_frame), 'w').close()
+    lst_items = [(s_video, os.path.basename(s_path)) for s_video, s_path in streaming.iter_frame_paths(str(tmp_path))]
+    assert lst_items == [('Test001', '001.tif'), ('Test001', '002.tif'), ('Test002', '001.tif'), ('Test002', '002.tif')]
+    assert [s_video for s_video, _ in streaming.iter_frame_paths(str(tmp_path), ['Test002'])] == ['Test002', 'Test002']
+
+
+class _MeanModel(object):
+    # D of a patch is its mean pixel, the scored patch counts are recorded
+    def __init__(self):
+        self.lst_batch_sizes = []
+
+    def f_score_patches(self, nd_patches):
+        self.lst_batch_sizes.append(len(nd_patches))
+        return {'D': np.asarray(nd_patches).mean(axis=(1, 2))}
+
+
+def test_incremental_scorer():
+    model = _MeanModel()
+    scorer = streaming.IncrementalScorer(model, f_change_threshold=0.01, n_refresh_every=3)
+    nd_patches = np.random.RandomState(0).uniform(0, 1, (6, 5, 5)).astype(np.float32)
+
+    np.testing.assert_allclose(scorer.score(nd_patches, 'Test001'), nd_patches.mean(axis=(1, 2)), rtol=1e-6)
+    # one location changes above the threshold, one below: only the first is rescored
+    nd_next = nd_patches.copy()
+    nd_next[2] += 0.1
+    nd_next[4] += 0.001
+    nd_scores = scorer.score(nd_next, 'Test001')
+    assert model.lst_batch_sizes == [6, 1]
+    assert nd_scores[2] == pytest.approx(nd_next[2].mean(), rel=1e-6)
+    assert nd_scores[4] == pytest.approx(nd_patches[4].mean(), rel=1e-6)
+
+    # nothing changed: nothing rescored, then the refresh rescores every location
+    scorer.score(nd_next, 'Test001')
+    scorer.score(nd_next, 'Test001')
+    assert model.lst_batch_sizes == [6, 1, 6]
+    np.testing.assert_allclose(scorer.score(nd_next, 'Test001'), nd_next.mean(axis=(1, 2)), rtol=1e-6)
+
+    # a new video starts from a full scoring
+    scorer.score(nd_next, 'Test002')
+    assert model.lst_batch_sizes == [6, 1, 6, 6]
+    dic_stats = scorer.stats()
+    assert dic_stats['n_frames'] == 6 and dic_stats['n_refreshes'] == 3
+    assert dic_stats['skip_rate'] == pytest.approx(1. - 19. / 36.)
+
+
+def test_incremental_scorer_drift():
+    model = _MeanModel()
+    scorer = streaming.IncrementalScorer(model, f_change_threshold=0.5, n_refresh_every=10, b_measure_drift=True)
+    nd_patches = np.zeros((4, 5, 5), np.float32)
+    scorer.score(nd_patches)
+    nd_patches[1] += 0.2
+    scorer.score(nd_patches)
+    dic_stats = scorer.stats()
+    assert dic_stats['drift_max'] == pytest.approx(0.2)
+    assert dic_stats['drift_mean'] == pytest.approx(0.2 / 8)
+    # the kept D of 0 is an anomaly, the full rescoring of 0.2 is not
+    assert dic_stats['decision_flips'] == 1
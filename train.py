@@ -1,6 +1,7 @@
 import os
 import numpy as np
 from models import ALOCC_Model
+from distributed import train_data_parallel
 from utils import pp, visualize, to_json, show_all_variables
 import tensorflow as tf
 
@@ -22,7 +23,35 @@ flags.DEFINE_string("input_fname_pattern", "*", "Glob pattern of filename of inp
 flags.DEFINE_string("checkpoint_dir", "checkpoint", "Directory name to save the checkpoints [checkpoint]")
 flags.DEFINE_string("log_dir", "log", "Directory name to save the log [log]")
 flags.DEFINE_string("sample_dir", "samples", "Directory name to save the image samples [samples]")
+flags.DEFINE_string("frame_store_dir", None, "Directory of the decoded-frame store, None to decode frames on every read [None]")
 flags.DEFINE_boolean("train", True, "True for training, False for testing [False]")
+flags.DEFINE_boolean("input_pipeline", False, "Train on batches of a prefetching tf.data pipeline instead of slicing numpy arrays, with --fused_step they go into the graph without a host round trip [False]")
+flags.DEFINE_integer("n_input_threads", 4, "Parallel decode/patch calls of the tf.data pipeline [4]")
+flags.DEFINE_integer("n_shuffle_buffer", 10000, "Shuffle buffer (in samples) of the tf.data pipeline [10000]")
+flags.DEFINE_boolean("fused_step", False, "UCSD: update D and G and fetch every logged metric in one sess.run per step. This also trains D, which the default UCSD step (G update only) never does [False]")
+flags.DEFINE_integer("scalar_summary_every", 1, "Write loss scalar summaries every n steps, 0 to disable [1]")
+flags.DEFINE_integer("histogram_summary_every", 100, "Write gradient histogram summaries every n steps, 0 to disable [100]")
+flags.DEFINE_integer("image_summary_every", 500, "Write input/generated image summaries every n steps, 0 to disable [500]")
+flags.DEFINE_integer("summary_queue_size", 100, "Summaries waiting for the background event writer before new ones are dropped [100]")
+flags.DEFINE_float("noise_sigma", 0.155, "Std of the Gaussian noise added to the inputs in the graph to make z [0.155]")
+flags.DEFINE_integer("noise_seed", None, "Seed of that noise, None for a random seed [None]")
+flags.DEFINE_integer("n_reader_workers", 1, "UCSD: worker processes decoding/patching the training frames, 1 to read them in this process [1]")
+flags.DEFINE_string("validation_frames", "./dataset/UCSD_Anomaly_Dataset.v1p2/UCSDped2/Test/Test004/068.tif",
+                    "UCSD: comma-separated frames scored after every epoch, empty to skip validation")
+flags.DEFINE_integer("validation_stride", 10, "Patch stride in the validation frames [10]")
+flags.DEFINE_boolean("async_validation", False, "Score the validation frames in a background thread on a weight snapshot [False]")
+flags.DEFINE_string("profile_dir", None, "Write op-level Chrome traces and time/memory tables of a window of steps here, None to disable [None]")
+flags.DEFINE_integer("profile_start_step", 10, "Profiling: first traced step [10]")
+flags.DEFINE_integer("profile_steps", 5, "Profiling: number of traced steps [5]")
+flags.DEFINE_string("metrics_dir", None, "Directory of metrics.jsonl and metrics.prom (Prometheus text format), None for log_dir [None]")
+flags.DEFINE_float("metrics_export_secs", 30., "Export the step metrics every n seconds [30]")
+flags.DEFINE_float("print_every_secs", 10., "Print and log the step metrics at most every n seconds, 0 for every step [10]")
+flags.DEFINE_boolean("async_checkpoint", True, "Write checkpoints in a background thread from a snapshot of the weights [True]")
+flags.DEFINE_integer("checkpoint_every_steps", 0, "Also checkpoint every n steps inside an epoch, 0 for epoch ends only [0]")
+flags.DEFINE_boolean("export_weights", False, "Also export the model weights without the Adam slots to <checkpoint>.weights.npz [False]")
+flags.DEFINE_boolean("resume", True, "Continue the epoch, batch, frame sample and RNG states of the latest checkpoint [True]")
+flags.DEFINE_integer("n_train_workers", 1, "UCSD: data-parallel training in n local worker processes, 1 to train in this process [1]")
+flags.DEFINE_integer("n_threads_per_worker", 0, "Data-parallel: TensorFlow threads of every worker, 0 for #cores / n_train_workers [0]")
 FLAGS = flags.FLAGS
 
 
@@ -109,13 +138,19 @@ def main(_):
                     n_per_itr_print_results=n_per_itr_print_results,
                     kb_work_on_patch=kb_work_on_patch,
                     nd_input_frame_size = nd_input_frame_size,
-                    n_fetch_data=n_fetch_data)
+                    n_fetch_data=n_fetch_data,
+                    s_frame_store_dir=FLAGS.frame_store_dir,
+                    f_noise_sigma=FLAGS.noise_sigma,
+                    n_noise_seed=FLAGS.noise_seed)
 
         #show_all_variables()
 
         if FLAGS.train:
             print('Program is on Train Mode')
-            tmp_model.train(FLAGS)
+            if FLAGS.n_train_workers > 1:
+                train_data_parallel(tmp_model, FLAGS)
+            else:
+                tmp_model.train(FLAGS)
         else:
             if not tmp_model.load(FLAGS.checkpoint_dir)[0]:
                 print('Program is on Test Mode')
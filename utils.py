@@ -6,13 +6,15 @@ import math
 import json
 import random
 import pprint
-import scipy.misc
+import threading
+import time
 import numpy as np
 from time import gmtime, strftime
-from six.moves import xrange
-import matplotlib.pyplot as plt
+from six.moves import xrange, queue
 import tensorflow as tf
-import tensorflow.contrib.slim as slim
+
+# scipy.misc, matplotlib and tf.contrib.slim are slow to import and only needed to read, write or
+# analyze images and variables, so the functions below import them on first use
 
 pp = pprint.PrettyPrinter()
 
@@ -22,6 +24,7 @@ def conv_out_size_same(size, stride):
   return int(math.ceil(float(size) / float(stride)))
 
 def show_all_variables():
+  import tensorflow.contrib.slim as slim
   model_vars = tf.trainable_variables()
   slim.model_analyzer.analyze_vars(model_vars, print_info=True)
 def get_image(image_path, input_height, input_width,
@@ -56,6 +59,7 @@ def save_images(images, size, image_path):
   return imsave(inverse_transform(images), size, image_path)
 
 def imread(path, grayscale = False):
+  import scipy.misc
   if (grayscale):
     #print(path)
     return scipy.misc.imread(path, flatten = True).astype(np.float)
@@ -93,6 +97,7 @@ def merge(images, size):
                      'must have dimensions: HxW or HxWx3 or HxWx4')
 
 def imsave(images, size, path):
+  import scipy.misc
   image = np.squeeze(merge(images, size))
   return scipy.misc.imsave(path, image)
 
@@ -100,6 +105,7 @@ def center_crop(x, crop_h, crop_w,
                 resize_h=64, resize_w=64):
   if crop_w is None:
     crop_w = crop_h
+  import scipy.misc
   h, w = x.shape[:2]
   j = int(round((h - crop_h)/2.))
   i = int(round((w - crop_w)/2.))
@@ -113,6 +119,7 @@ def transform(image, input_height, input_width,
       image, input_height, input_width, 
       resize_height, resize_width)
   else:
+    import scipy.misc
     cropped_image = scipy.misc.imresize(image, [resize_height, resize_width])
   return np.array(cropped_image)/127.5 - 1.
 
@@ -323,6 +330,143 @@ def montage(images, saveto='montage.png'):
                 this_img = images[this_filter]
                 m[1 + i + i * img_h:1 + i + (i + 1) * img_h,
                   1 + j + j * img_w:1 + j + (j + 1) * img_w] = this_img
+    import matplotlib.pyplot as plt
     plt.imsave(arr=m, fname=saveto)
     return m
 
+
+
+class SummaryPolicy(object):
+  """
+  Step intervals at which each kind of summary ('scalar', 'histogram', 'image') is evaluated.
+  An interval of 0 disables that kind.
+  """
+  def __init__(self, n_scalar_every=1, n_histogram_every=100, n_image_every=500):
+    self.dic_every = {'scalar': n_scalar_every, 'histogram': n_histogram_every, 'image': n_image_every}
+
+  def is_due(self, s_kind, n_step):
+    n_every = self.dic_every[s_kind]
+    return n_every > 0 and n_step % n_every == 0
+
+  def due_summaries(self, n_step, dic_summaries, lst_candidates=None):
+    """
+    :param dic_summaries: kind -> list of summary ops
+    :param lst_candidates: optional subset of ops to choose from
+    :return: the summary ops that have to be evaluated at n_step
+    """
+    lst_due = []
+    for s_kind, lst_ops in dic_summaries.items():
+      if self.is_due(s_kind, n_step):
+        lst_due.extend([op for op in lst_ops if lst_candidates is None or op in lst_candidates])
+    return lst_due
+
+
+class AsyncSummaryWriter(object):
+  """
+  Hands serialized summaries to a background thread that owns the event file writer.
+  add_summary and flush never block the caller: when the bounded queue is full the summary is dropped and counted.
+  A flush sets a flag the thread acts on once its queue is empty, so it is never dropped like a summary.
+  """
+  _WAKE = object()
+  _CLOSE = object()
+
+  def __init__(self, writer, n_max_queue=100, f_flush_secs=30.):
+    self.writer = writer
+    self.f_flush_secs = f_flush_secs
+    self.n_dropped = 0
+    self.flush_requested = threading.Event()
+    self.queue = queue.Queue(maxsize=n_max_queue)
+    self.thread = threading.Thread(target=self._run, name='AsyncSummaryWriter')
+    self.thread.daemon = True
+    self.thread.start()
+
+  def add_summary(self, summary, global_step=None):
+    try:
+      self.queue.put_nowait((summary, global_step))
+    except queue.Full:
+      self.n_dropped += 1
+
+  def flush(self):
+    """
+    Flush the event file once the summaries queued so far are written
+    """
+    self.flush_requested.set()
+    try:
+      # wakes the thread if it is idle, a full queue means it is busy and sees the flag after the next item
+      self.queue.put_nowait(self._WAKE)
+    except queue.Full:
+      pass
+
+  def close(self):
+    self.queue.put(self._CLOSE)
+    self.thread.join()
+    if self.n_dropped:
+      print(' [!] {} summaries dropped, summary queue was full'.format(self.n_dropped))
+
+  def _run(self):
+    f_last_flush = time.time()
+    while True:
+      item = self.queue.get()
+      if item is self._CLOSE:
+        break
+      if item is not self._WAKE:
+        self.writer.add_summary(*item)
+      # a requested flush waits for the summaries queued before it
+      if (self.flush_requested.is_set() and self.queue.empty()) or time.time() - f_last_flush > self.f_flush_secs:
+        self.flush_requested.clear()
+        self.writer.flush()
+        f_last_flush = time.time()
+    self.writer.flush()
+    self.writer.close()
+
+
+def score_in_batches(sess, dic_output_tensors, nd_patches, lst_outputs, n_batch_size, profiler=None):
+  """
+  Run nd_patches through a scoring graph, one sess.run per batch for all requested outputs.
+  A short last batch is filled up with the tail of the previous batch and only the new rows are kept, so no patch
+  is dropped and every batch has n_batch_size patches for the batch-norm statistics (a graph with a fixed batch
+  dimension also gets repeated patches when there are fewer than n_batch_size).
+  :param dic_output_tensors: output name -> (output tensor, input placeholder it is computed from)
+  :param nd_patches: (N, h, w) or (N, h, w, c) patches fed to every input placeholder,
+                     or dict input placeholder -> patches (same N) to feed different patches to each input
+  :param profiler: profiling.StepProfiler tracing the batches of its window (batch index as the step), None for no tracing
+  :return: dict output name -> numpy array with N rows, aligned with nd_patches
+  """
+  lst_fetches = [dic_output_tensors[s_output][0] for s_output in lst_outputs]
+  lst_feeds = set(dic_output_tensors[s_output][1] for s_output in lst_outputs)
+  if not isinstance(nd_patches, dict):
+    nd_patches = {feed: nd_patches for feed in lst_feeds}
+
+  dic_feed_patches = {}
+  for feed in lst_feeds:
+    nd_feed_patches = np.asarray(nd_patches[feed], dtype=np.float32)
+    if nd_feed_patches.ndim == 3:
+      nd_feed_patches = nd_feed_patches[..., np.newaxis]
+    dic_feed_patches[feed] = nd_feed_patches
+  n_patches = len(next(iter(dic_feed_patches.values())))
+
+  dic_results = {}
+  for s_output, tensor in zip(lst_outputs, lst_fetches):
+    dic_results[s_output] = np.empty([n_patches] + tensor.get_shape().as_list()[1:], dtype=np.float32)
+
+  b_fixed_batch = any(feed.get_shape()[0].value is not None for feed in lst_feeds)
+  if b_fixed_batch and n_patches < n_batch_size:
+    for feed in lst_feeds:
+      dic_feed_patches[feed] = np.resize(dic_feed_patches[feed], (n_batch_size,) + dic_feed_patches[feed].shape[1:])
+  n_fed_patches = max(n_patches, n_batch_size) if b_fixed_batch else n_patches
+
+  for n_start in xrange(0, n_patches, n_batch_size):
+    # the last batch is shifted back so that it stays full, rows before n_start are already scored
+    n_batch_start = max(0, min(n_start, n_fed_patches - n_batch_size))
+    n_keep = min(n_start + n_batch_size, n_patches) - n_start
+    n_offset = n_start - n_batch_start
+
+    feed_dict = {feed: dic_feed_patches[feed][n_batch_start:n_batch_start + n_batch_size] for feed in lst_feeds}
+    dic_run_kwargs = profiler.run_kwargs(n_start // n_batch_size) if profiler is not None else {}
+    lst_batch_results = sess.run(lst_fetches, feed_dict=feed_dict, **dic_run_kwargs)
+    if profiler is not None:
+      profiler.record(n_start // n_batch_size, dic_run_kwargs, 'score')
+    for s_output, batch_result in zip(lst_outputs, lst_batch_results):
+      dic_results[s_output][n_start:n_start + n_keep] = batch_result[n_offset:n_offset + n_keep]
+
+  return dic_results
@@ -0,0 +1,143 @@
+"""
+Per-epoch validation of ALOCC_Model on a fixed set of frames.
+
+ValidationSet decodes and patches the frames once and keeps them in memory, with one fixed noisy copy so
+the losses of different epochs are comparable. Validator copies the training weights into its own
+inference-only graph and scores the whole set there in one batched pass; with b_background=True the pass
+runs in a background thread on that weight snapshot while training goes on.
+"""
+import threading
+import time
+
+import numpy as np
+import tensorflow as tf
+
+from kh_tools import read_lst_patches_uint8, to_float_images
+from utils import score_in_batches
+
+
+def sigmoid_cross_entropy(nd_logits, nd_labels):
+    """
+    numpy version of tf.nn.sigmoid_cross_entropy_with_logits
+    """
+    return np.maximum(nd_logits, 0) - nd_logits * nd_labels + np.log1p(np.exp(-np.abs(nd_logits)))
+
+
+class ValidationSet(object):
+    """
+    Patches of the validation frames, clean (the D inputs) and noisy (the z of G), decoded once
+    """
+    def __init__(self, lst_frame_paths, nd_patch_size, nd_patch_step, f_noise_sigma=0.155, n_seed=0):
+        self.lst_frame_paths = list(lst_frame_paths)
+        nd_patches, self.lst_locations = read_lst_patches_uint8(self.lst_frame_paths, nd_patch_size, nd_patch_step)
+        self.patches = to_float_images(nd_patches[..., np.newaxis])
+
+        rng = np.random.RandomState(n_seed)
+        self.noisy_patches = np.clip(self.patches + rng.normal(0, f_noise_sigma, self.patches.shape), 0, 1).astype(np.float32)
+
+    def __len__(self):
+        return len(self.patches)
+
+
+class Validator(object):
+    """
+    Scores a ValidationSet with a snapshot of the weights of a training ALOCC_Model.
+
+    submit() takes the snapshot in the calling thread (one sess.run between two training steps), then scores
+    it either right away or in a background thread. Only one pass runs at a time: submit() first waits for
+    the previous one. Every result dict goes to fn_callback, from the thread that scored it.
+    """
+    def __init__(self, model, validation_set, n_batch_size=64, b_background=False, fn_callback=None, config=None):
+        self.validation_set = validation_set
+        self.n_batch_size = n_batch_size
+        self.b_background = b_background
+        self.fn_callback = fn_callback
+        self.r_alpha = model.r_alpha
+        self.train_sess = model.sess
+        self.thread = None
+
+        self.graph = tf.Graph()
+        self.sess = tf.Session(graph=self.graph, config=config)
+        with self.graph.as_default():
+            # same class and geometry as the training model, scoring outputs only
+            self.eval_model = model.__class__(self.sess,
+                                              input_height=model.input_height, input_width=model.input_width,
+                                              output_height=model.output_height, output_width=model.output_width,
+                                              gf_dim=model.gf_dim, df_dim=model.df_dim, c_dim=model.c_dim,
+                                              r_alpha=model.r_alpha, is_training=False, b_inference_only=True)
+            lst_eval_vars = tf.global_variables()
+            self.lst_placeholders = [tf.placeholder(var.dtype.base_dtype, var.get_shape()) for var in lst_eval_vars]
+            self.load_op = tf.group(*[tf.assign(var, placeholder)
+                                      for var, placeholder in zip(lst_eval_vars, self.lst_placeholders)])
+
+        dic_train_vars = {var.op.name: var for var in model.sess.graph.get_collection(tf.GraphKeys.GLOBAL_VARIABLES)}
+        self.lst_train_vars = [dic_train_vars[var.op.name] for var in lst_eval_vars]
+
+        self.dic_output_tensors = {'D_logits': (self.eval_model.D_logits, self.eval_model.inputs),
+                                   'D_logits_': (self.eval_model.D_logits_, self.eval_model.z),
+                                   'G': (self.eval_model.G, self.eval_model.z),
+                                   'G_logits': (self.eval_model.G_, self.eval_model.z)}
+
+    def snapshot(self):
+        """
+        :return: current values of the training weights that the validation graph needs
+        """
+        return self.train_sess.run(self.lst_train_vars)
+
+    def validate(self, lst_values, n_epoch=None, n_step=None):
+        """
+        Load lst_values into the validation graph and score the whole validation set
+        :return: dict with the epoch and step, the losses of the training objective, the D outputs and the generated patches
+        """
+        f_start = time.time()
+        self.sess.run(self.load_op, feed_dict=dict(zip(self.lst_placeholders, lst_values)))
+
+        dic_patches = {self.eval_model.inputs: self.validation_set.patches,
+                       self.eval_model.z: self.validation_set.noisy_patches}
+        dic_outputs = score_in_batches(self.sess, self.dic_output_tensors, dic_patches,
+                                       list(self.dic_output_tensors), self.n_batch_size)
+
+        nd_d_logits_ = dic_outputs['D_logits_']
+        dic_result = {
+            'epoch': n_epoch,
+            'step': n_step,
+            'd_loss_fake': np.mean(sigmoid_cross_entropy(nd_d_logits_, 0.)),
+            'd_loss_real': np.mean(sigmoid_cross_entropy(dic_outputs['D_logits'], 1.)),
+            'g_loss': np.mean(sigmoid_cross_entropy(nd_d_logits_, 1.)) + self.r_alpha * 3 * np.mean(
+                sigmoid_cross_entropy(dic_outputs['G_logits'], self.validation_set.patches)),
+            'D': 1. / (1. + np.exp(-dic_outputs['D_logits'])),
+            'D_': 1. / (1. + np.exp(-nd_d_logits_)),
+            'G': dic_outputs['G'],
+        }
+        dic_result['sec'] = time.time() - f_start
+
+        if self.fn_callback is not None:
+            self.fn_callback(dic_result)
+        return dic_result
+
+    def submit(self, n_epoch=None, n_step=None):
+        """
+        Validate the current weights, in the background if b_background
+        :return: the result dict, or None when it is computed in the background
+        """
+        self.wait()
+        lst_values = self.snapshot()
+        if not self.b_background:
+            return self.validate(lst_values, n_epoch, n_step)
+
+        self.thread = threading.Thread(target=self.validate, args=(lst_values, n_epoch, n_step), name='alocc-validation')
+        self.thread.daemon = True
+        self.thread.start()
+        return None
+
+    def wait(self):
+        """
+        Block until the background pass, if any, is done
+        """
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+
+    def close(self):
+        self.wait()
+        self.sess.close()